@@ -3,11 +3,14 @@ import time
 
 from train import *
 
-# Initialize the model
-model = bigram().to(device)
-
 # Load the model's state dictionary
 state = torch.load('D:\\GPT2\\bible_wigets_inter100000.pth', map_location=device)
+# the vocab is stored in the checkpoint, older checkpoints fall back to the cached corpus vocab
+chars = state['chars'] if 'chars' in state else load_corpus()[1]
+encode, decode = make_codec(chars)
+
+# Initialize the model
+model = bigram(len(chars)).to(device)
 model_state_dict = state['model_state_dict']
 model.load_state_dict(model_state_dict)
 loss_value = state['loss']  # Extract the loss value
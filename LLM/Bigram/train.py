@@ -1,3 +1,10 @@
+import os
+import sys
+import json
+import inspect
+import threading
+from contextlib import nullcontext
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
@@ -11,6 +18,10 @@ eval_interval = 300
 lr = 3e-4
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 eval_iters = 200
+eval_batch_size = 512 # eval keeps no activations for backward, so it can use bigger batches than training
+eval_async = False # evaluate a snapshot of the weights in a background thread while training continues
+dtype = 'float32' # 'bfloat16' to opt in to bf16 autocast for forward/backward (train and eval), the weights stay fp32
+use_compile = False # torch.compile the bigram model
 n_embd = 384
 n_head = 6
 n_layer = 6
@@ -31,52 +42,152 @@ dropout = 0.2
 # dropout = 0.2
 # ------
 
-torch.manual_seed(1337)
-
-with open('bible.txt', 'r', encoding='utf-8') as f:
-    text = f.read()
+device_type = 'cuda' if device == 'cuda' else 'cpu'
 
-# unique chars
-chars = sorted(list(set(text)))
-vocab_size = len(chars)
-
-# mapping
-stoi = {ch:i for i, ch in enumerate(chars)}
-itos = {i:ch for i, ch in enumerate(chars)}
-encode = lambda s: [stoi[c] for c in s]
-decode = lambda l: ''.join([itos[i] for i in l])
+torch.manual_seed(1337)
 
-# train and val splits
-data = torch.tensor(encode(text), dtype=torch.long)
-n = int(0.9*len(data))
-train = data[:n]
-val = data[n:]
+corpus_path = 'bible.txt'
+
+def make_codec(chars):
+    # lookup tables instead of a dict lookup per character: code point -> id and id -> code point,
+    # the text goes through numpy as utf-32 so the whole corpus is encoded in one indexing op
+    itos_cp = np.array([ord(c) for c in chars], dtype=np.uint32)
+    stoi_lut = np.full(int(itos_cp.max()) + 1, -1, dtype=np.int32)
+    stoi_lut[itos_cp] = np.arange(len(chars))
+
+    def encode(s):
+        cp = np.frombuffer(s.encode('utf-32-le'), dtype=np.uint32)
+        known = cp < len(stoi_lut)
+        ids = np.where(known, stoi_lut[np.where(known, cp, 0)], -1)
+        assert (ids >= 0).all(), 'text contains characters outside the vocab'
+        return ids.astype(np.uint8 if len(chars) <= 256 else np.int32)
+
+    def decode(l):
+        return itos_cp[np.asarray(l, dtype=np.int64)].tobytes().decode('utf-32-le')
+
+    return encode, decode
+
+def load_corpus(path=corpus_path):
+    # the encoded corpus is cached next to the text as uint8 (.u8.npy, memory mapped) together with its vocab,
+    # only the first run (or a changed bible.txt) reads and encodes the raw text
+    base = os.path.splitext(path)[0]
+    data_path, vocab_path = base + '.u8.npy', base + '.vocab.json'
+    if os.path.exists(data_path) and os.path.exists(vocab_path):
+        with open(vocab_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if not os.path.exists(path) or (meta['size'], meta['mtime']) == (os.stat(path).st_size, os.stat(path).st_mtime):
+            return np.load(data_path, mmap_mode='r'), meta['chars']
+
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    # unique chars
+    chars = sorted(list(set(text)))
+    assert len(chars) <= 256, f'{len(chars)} unique characters do not fit in uint8'
+    encode, decode = make_codec(chars)
+    np.save(data_path, encode(text))
+    with open(vocab_path, 'w', encoding='utf-8') as f:
+        json.dump({'chars': chars, 'size': os.stat(path).st_size, 'mtime': os.stat(path).st_mtime}, f)
+    return np.load(data_path, mmap_mode='r'), chars
+
+# train and val splits are loaded in __main__, both live on the device for the whole run as uint8
+offsets = torch.arange(block_size + 1, device=device) # (T+1)
+prefetch = device == 'cuda' # sample the next batch on a side stream while the current step runs
 
 # data loading
 def get_batch(split):   
     # generate samll batches
+    # one gather of (B, T+1) windows straight on the device instead of stacking B slices on the host
     data = train if split == 'train' else val
-    ix = torch.randint(len(data) - block_size, (batch_size,))
-    x = torch.stack([data[i: i + block_size] for i in ix])
-    y = torch.stack([data [i+1:i+block_size+1] for i in ix])
-    x ,y = x.to(device), y.to(device)
+    ix = torch.randint(len(data) - block_size, (batch_size,), device=device)
+    return gather_batch(data, ix)
+
+def gather_batch(data, ix):
+    xy = data[ix[:, None] + offsets].long() # (B, T+1)
+    x = xy[:, :-1].contiguous()
+    y = xy[:, 1:].contiguous()
     return x,y
 
-@torch.no_grad() # not to call loss.backward()
-def estimate_loss():
+
+class BatchPrefetcher:
+    # keeps one batch in flight: the gather for step i+1 is queued on a side cuda stream during step i
+    def __init__(self, split):
+        self.split = split
+        self.stream = torch.cuda.Stream() if device == 'cuda' else None
+        self.next = self._sample()
+
+    def _sample(self):
+        if self.stream is None:
+            return get_batch(self.split)
+        with torch.cuda.stream(self.stream):
+            return get_batch(self.split)
+
+    def get_batch(self):
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            for t in self.next:
+                t.record_stream(torch.cuda.current_stream())
+        x, y = self.next
+        self.next = self._sample()
+        return x, y
+
+def build_eval_batches(seed=1337):
+    # the held-out windows are drawn once, so every eval scores the same eval_iters * batch_size windows
+    # (regrouped into eval_batch_size batches) and the numbers are comparable between steps
+    g = torch.Generator(device=device)
+    g.manual_seed(seed)
+    n_batches = max(1, eval_iters * batch_size // eval_batch_size)
+    return {split: torch.randint(len(data) - block_size, (n_batches, eval_batch_size), device=device, generator=g)
+            for split, data in [('train', train), ('val', val)]}
+
+@torch.inference_mode() # not to call loss.backward()
+def estimate_loss(eval_model=None):
+    # the loss is summed on the device, the only sync is when the caller reads the result
+    eval_model = model if eval_model is None else eval_model
     out = {}
-    model.eval()
+    eval_model.eval()
     for split in ['train', 'val']:
-        losses = torch.zeros(eval_iters)
-        for k in range(eval_iters):
-            X, Y = get_batch(split)
-            logits, loss = model(X, Y)
-            losses[k] = loss.item()
-        out[split] = losses.mean()
-    model.train()
+        data = train if split == 'train' else val
+        loss_sum = torch.zeros((), device=device)
+        for ix in eval_batches[split]:
+            X, Y = gather_batch(data, ix)
+            with autocast(dtype): # same precision as train_step, so train and eval losses compare
+                logits, loss = eval_model(X, Y)
+            loss_sum += loss
+        out[split] = loss_sum / len(eval_batches[split])
+    eval_model.train()
     return out
 
 
+class AsyncEvaluator:
+    # runs estimate_loss on a copy of the weights in a background thread (own cuda stream), training only waits
+    # for the weight copy and for the previous eval if it is still running
+    def __init__(self, vocab_size):
+        self.snapshot = bigram(vocab_size).to(device)
+        self.stream = torch.cuda.Stream() if device == 'cuda' else None
+        self.thread = None
+
+    def submit(self, step):
+        self.wait()
+        self.snapshot.load_state_dict(m.state_dict())
+        if self.stream is not None:
+            self.stream.wait_stream(torch.cuda.current_stream())
+        self.thread = threading.Thread(target=self._run, args=(step,))
+        self.thread.start()
+
+    def _run(self, step):
+        if self.stream is not None:
+            with torch.cuda.stream(self.stream):
+                losses = estimate_loss(self.snapshot)
+        else:
+            losses = estimate_loss(self.snapshot)
+        print(f"step {step}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
 class Head(nn.Module):
     # one head of self-attension
     def __init__(self, head_size):
@@ -152,7 +263,7 @@ class Block(nn.Module):
     
 class bigram(nn.Module):
     
-    def __init__(self):
+    def __init__(self, vocab_size):
         super().__init__()
         #  each token directly reads off the logits for the next token from a loopup table
         self.token_embdding_table = nn.Embedding(vocab_size, n_embd)
@@ -213,43 +324,123 @@ class bigram(nn.Module):
 
 
 
-# train the network
-model = bigram()
-m = model.to(device)
+def autocast(dtype):
+    # bf16 autocast on cpu and gpu, float32 runs plain
+    if dtype == 'float32':
+        return nullcontext()
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16)
+
+def make_optimizer(params):
+    # fused AdamW does the whole update in one kernel instead of one per parameter tensor
+    fused_available = 'fused' in inspect.signature(torch.optim.AdamW).parameters
+    params = list(params)
+    if fused_available:
+        try:
+            return torch.optim.AdamW(params, lr=lr, fused=True)
+        except RuntimeError: # fused not implemented for this device in this torch version
+            pass
+    return torch.optim.AdamW(params, lr=lr)
+
+def train_step(model, ops, xb, yb, dtype):
+    with autocast(dtype):
+        logits, loss = model(xb, yb)
+    ops.zero_grad(set_to_none=True)
+    loss.backward()
+    ops.step()
+    return loss
+
+def benchmark_modes(vocab_size, iters=50, warmup=5):
+    # same model and batch in every precision / compile combination, reports iterations and tokens per second
+    for dtype_name, compiled in [('float32', False), ('bfloat16', False), ('float32', True), ('bfloat16', True)]:
+        torch.manual_seed(1337)
+        bench_model = bigram(vocab_size).to(device)
+        step_model = torch.compile(bench_model) if compiled else bench_model
+        bench_ops = make_optimizer(bench_model.parameters())
+        xb, yb = get_batch('train')
+        for _ in range(warmup): # includes the compile
+            train_step(step_model, bench_ops, xb, yb, dtype_name)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        t0 = time.time()
+        for _ in range(iters):
+            loss = train_step(step_model, bench_ops, xb, yb, dtype_name)
+        loss.item()
+        dt = time.time() - t0
+        print(f'{dtype_name:8s} compile={str(compiled):5s} | {iters / dt:.2f} it/sec | {iters * batch_size * block_size / dt:.2f} tok/sec | fused AdamW: {bench_ops.defaults.get("fused")}')
+
 state_name = 'bible_wigets_inter100000.pth'
 import time
 
 if __name__ == '__main__': # only executes when run this script to prevent the output script to execute the trainning loop
     print(f'using {device}')
+    data, chars = load_corpus()
+    vocab_size = len(chars)
+    encode, decode = make_codec(chars)
+    n = int(0.9*len(data))
+    train = torch.from_numpy(np.ascontiguousarray(data[:n])).to(device)
+    val = torch.from_numpy(np.ascontiguousarray(data[n:])).to(device)
+
+    torch.set_float32_matmul_precision('high')
+    if '--bench' in sys.argv: # python train.py --bench
+        benchmark_modes(vocab_size)
+        sys.exit()
+
+    # train the network
+    model = bigram(vocab_size)
+    m = model.to(device) # the raw model, for saving and eval snapshots
     print(sum(p.numel() for p in m.parameters())/1e6, 'M parameters')
+    if use_compile:
+        model = torch.compile(m)
 
-    ops  = torch.optim.AdamW(m.parameters(), lr=lr)
+    ops  = make_optimizer(m.parameters())
+    print(f'dtype: {dtype} | compile: {use_compile} | fused AdamW: {ops.defaults.get("fused")}')
+    # data overhead per iteration, should be noise next to the model step
+    t0 = time.time()
+    for _ in range(100):
+        get_batch('train')
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    print(f'get_batch: {(time.time() - t0) * 10:.4f}ms per batch')
+
+    train_batches = BatchPrefetcher('train') if prefetch else None
+    eval_batches = build_eval_batches()
+    evaluator = AsyncEvaluator(vocab_size) if eval_async else None
+    time_eval = 0.0 # wall time the training loop spends on (or waiting for) eval
     t0 = time.time()
     for iter in range(max_iters):
         # sample batches
         if iter % eval_interval == 0:
-            losses = estimate_loss()
-            print(f'step {iter}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}')
+            te = time.time()
+            if eval_async:
+                evaluator.submit(iter)
+            else:
+                losses = estimate_loss()
+                print(f'step {iter}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}')
+            time_eval += time.time() - te
 
-        xb ,yb = get_batch('train')
+        xb ,yb = train_batches.get_batch() if prefetch else get_batch('train')
 
         # evl
-        logits, loss = model(xb, yb)
-        ops.zero_grad(set_to_none=True)
-        loss.backward()
-        ops.step()
+        loss = train_step(model, ops, xb, yb, dtype)
 
+    if eval_async:
+        te = time.time()
+        evaluator.wait()
+        time_eval += time.time() - te
     t1 = time.time()
     time_train = (t1 - t0) * 1000
     
     print(f'It took {time_train} to train')
+    print(f'{max_iters / (t1 - t0):.2f} it/sec | {max_iters * batch_size * block_size / (t1 - t0):.2f} tok/sec')
+    print(f'eval took {time_eval * 1000:.2f}ms, {time_eval * 1000 / time_train * 100:.2f}% of the wall time')
     
     # save the model 
     state = {
-    'model_state_dict': model.state_dict(),
+    'model_state_dict': m.state_dict(),
     'optimizer_state_dict': ops.state_dict(),  # Optional: save optimizer state
     'loss': loss.item(),  # Save the last loss value
-    'epoch': iter  # Optional: save the current epoch or iteration
+    'epoch': iter,  # Optional: save the current epoch or iteration
+    'chars': chars, # the vocab, so inference never has to read bible.txt
     }
 
     torch.save(state, f'{state_name}')
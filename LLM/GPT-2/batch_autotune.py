@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+# picks the micro batch B (and so the gradient accumulation) for train_gpt2.py on this machine: doubles B through
+# the divisors of total_batch_size / (T * world_size) until a forward + backward does not fit anymore, times a few
+# of the largest ones that fit, and keeps the fastest. total_batch_size is always preserved exactly
+# (B * T * gard_accum_steps * world_size == total_batch_size).
+#
+# the optimizer step and the gradient all-reduce happen once per step whatever B is, so micro step tok/sec is
+# what decides. the result is cached in a json file under a fingerprint of the hardware, torch version, model
+# config and batch settings, so only the first run on a machine pays for the probing
+#
+# python3 batch_autotune.py                  # tune the 124M model for this machine and print the timings
+# python3 batch_autotune.py --retune --T 512 # ignore the cache
+import os
+import gc
+import json
+import time
+import hashlib
+import platform
+import dataclasses
+import torch
+import torch.distributed as dist
+
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autotune_cache.json')
+
+
+def hardware_fingerprint(device, model_config, T, total_batch_size, world_size, max_B=None):
+    # everything that changes which B fits and which is fastest. returns (key, description)
+    if device.startswith('cuda'):
+        props = torch.cuda.get_device_properties(device)
+        hardware = {'device': props.name, 'memory': props.total_memory, 'capability': f'{props.major}.{props.minor}',
+                    'cuda': torch.version.cuda}
+    else:
+        hardware = {'device': platform.processor() or platform.machine(), 'cpus': os.cpu_count(),
+                    'threads': torch.get_num_threads()}
+    description = {
+        **hardware,
+        'torch': torch.__version__,
+        'model': dataclasses.asdict(model_config),
+        'T': T,
+        'total_batch_size': total_batch_size,
+        'world_size': world_size,
+        'max_B': max_B,
+    }
+    key = hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()[:16]
+    return key, description
+
+
+def micro_batch_candidates(total_batch_size, T, world_size, max_B=None):
+    # every B that keeps total_batch_size exact, smallest first
+    assert total_batch_size % (T * world_size) == 0, f'total_batch_size {total_batch_size} is not divisible by T*world_size = {T}*{world_size}'
+    rows = total_batch_size // (T * world_size)
+    return [b for b in range(1, rows + 1) if rows % b == 0 and (max_B is None or b <= max_B)]
+
+
+def is_oom(e):
+    if isinstance(e, torch.cuda.OutOfMemoryError):
+        return True
+    # the cpu allocator raises a plain RuntimeError
+    return isinstance(e, RuntimeError) and ('out of memory' in str(e) or "can't allocate memory" in str(e))
+
+
+def micro_step(model, B, T, device, device_type):
+    # one training micro step on random tokens, like the train loop: bf16 autocast forward, backward
+    x = torch.randint(model.config.vocab_size, (B, T + 1), device=device)
+    with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+        logits, loss = model(x[:, :-1], x[:, 1:])
+    loss.backward()
+
+
+def probe(model, B, T, device, device_type, reserve_bytes, headroom, steps):
+    # None if B does not fit, else micro step tok/sec (first step is warmup)
+    if device_type == 'cuda':
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+    try:
+        times = []
+        for _ in range(steps + 1):
+            t0 = time.time()
+            micro_step(model, B, T, device, device_type)
+            if device_type == 'cuda':
+                torch.cuda.synchronize()
+            times.append(time.time() - t0)
+        if device_type == 'cuda':
+            # the probe has no optimizer state or DDP buckets yet, they need to fit next to the peak as well
+            total = torch.cuda.get_device_properties(device).total_memory
+            if torch.cuda.max_memory_allocated(device) + reserve_bytes > headroom * total:
+                return None
+        return B * T * steps / sum(times[1:])
+    except Exception as e:
+        if not is_oom(e):
+            raise
+        return None
+    finally:
+        model.zero_grad(set_to_none=True)
+        gc.collect()
+        if device_type == 'cuda':
+            torch.cuda.empty_cache()
+
+
+def load_cache(cache_file):
+    if not os.path.exists(cache_file):
+        return {}
+    with open(cache_file) as f:
+        return json.load(f)
+
+
+def save_cache(cache_file, cache):
+    tmp = cache_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp, cache_file)
+
+
+def autotune_micro_batch(model, T, total_batch_size, world_size, device, device_type, max_B=None, candidates=3,
+                         steps=3, reserve_bytes=None, headroom=0.9, cpu_max_B=8, cache_file=CACHE_FILE,
+                         retune=False, verbose=True):
+    """
+    Pick the micro batch size for training model on this machine.
+
+    Inputs:
+    - model: the raw GPT, not DDP wrapped and not compiled yet: every probed B would be a new shape, recompile, and
+      use up dynamo's recompile limit before training starts. its grads are cleared, the weights are not touched
+    - T, total_batch_size, world_size: as in train_gpt2.py, total_batch_size must be divisible by T * world_size
+    - max_B: upper bound for B. on cpu it defaults to cpu_max_B: running out of host memory usually gets the process
+      killed instead of raising, so cpu probing can not rely on catching the error
+    - candidates: how many of the largest fitting B are timed
+    - steps: timed micro steps per candidate, after one warmup step
+    - reserve_bytes: gpu memory to keep free for the optimizer state, default 8 bytes per parameter (AdamW moments)
+    - headroom: fraction of the gpu memory the peak + reserve may use
+
+    Returns a tuple of:
+    - B: micro batch size
+    - gard_accum_steps: total_batch_size // (B * T * world_size)
+    """
+    if device_type == 'cpu' and max_B is None:
+        max_B = cpu_max_B
+    distributed = dist.is_available() and dist.is_initialized()
+    if reserve_bytes is None:
+        reserve_bytes = 8 * sum(p.numel() for p in model.parameters())
+    key, description = hardware_fingerprint(device, model.config, T, total_batch_size, world_size, max_B)
+    cache = load_cache(cache_file)
+    if distributed and dist.get_rank() != 0:
+        B = 0 # rank 0 tunes alone: ranks probing the same cores (cpu / gloo) at once would skew each other's timings
+    elif key in cache and not retune:
+        B = cache[key]['B']
+        if verbose:
+            print(f'autotune: cached micro batch {B} for {description["device"]} ({key})')
+    else:
+        was_training = model.training
+        model.train()
+        timings = {}
+        fitting = []
+        for b in micro_batch_candidates(total_batch_size, T, world_size, max_B):
+            tok_per_sec = probe(model, b, T, device, device_type, reserve_bytes, headroom, 1)
+            if tok_per_sec is None:
+                break
+            fitting.append(b)
+            if verbose:
+                print(f'autotune: micro batch {b:4d} fits')
+        assert fitting, f'not even a micro batch of 1 x {T} tokens fits on {device}'
+        for b in fitting[-candidates:]:
+            tok_per_sec = probe(model, b, T, device, device_type, reserve_bytes, headroom, steps)
+            if tok_per_sec is not None:
+                timings[b] = tok_per_sec
+            if verbose:
+                accum = total_batch_size // (b * T * world_size)
+                print(f'autotune: B {b:4d} x accum {accum:4d} | ' + (f'{tok_per_sec:.0f} tok/sec' if tok_per_sec else 'did not fit'))
+        model.train(was_training)
+        # the fastest, larger B on a tie (fewer micro steps, fewer python/launch overheads)
+        B = max(timings, key=lambda b: (timings[b], b)) if timings else fitting[0]
+        cache[key] = {'B': B, 'tok_per_sec': timings, 'fingerprint': description, 'time': time.time()}
+        save_cache(cache_file, cache)
+    if distributed:
+        b = torch.tensor([B], device=device)
+        dist.broadcast(b, 0)
+        B = int(b.item())
+        if device_type == 'cuda' and dist.get_rank() != 0:
+            # each rank has its own gpu, which may have less free memory than rank 0's: fall back to the largest
+            # candidate that fits here
+            for c in reversed(micro_batch_candidates(total_batch_size, T, world_size, B)):
+                if probe(model, c, T, device, device_type, reserve_bytes, headroom, 1) is not None:
+                    B = c
+                    break
+            else:
+                raise RuntimeError(f'autotune: rank {dist.get_rank()} does not fit even a micro batch of 1 x {T} tokens '
+                                   f'on {device} (rank 0 picked {B})')
+        # every rank has to run the same B, the smallest choice fits everywhere
+        b = torch.tensor([B], device=device)
+        dist.all_reduce(b, op=dist.ReduceOp.MIN)
+        B = int(b.item())
+    gard_accum_steps = total_batch_size // (B * T * world_size)
+    if verbose:
+        print(f'autotune: micro batch {B}, gradient accumulation {gard_accum_steps}')
+    return B, gard_accum_steps
+
+
+if __name__ == '__main__':
+    import argparse
+    from train_gpt2 import GPT, GPTConfig
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--T", type=int, default=1024)
+    parser.add_argument("--total_batch_size", type=int, default=524288)
+    parser.add_argument("--max_B", type=int, default=None)
+    parser.add_argument("--retune", action="store_true", help="probe again even if this machine is in the cache")
+    parser.add_argument("--cache_file", type=str, default=CACHE_FILE)
+    args = parser.parse_args()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    device_type = 'cuda' if device.startswith('cuda') else 'cpu'
+    torch.set_float32_matmul_precision('high')
+    model = GPT(GPTConfig(vocab_size=50304)).to(device)
+    autotune_micro_batch(model, args.T, args.total_batch_size, 1, device, device_type, max_B=args.max_B,
+                         cache_file=args.cache_file, retune=args.retune)
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+# gradient communication for DDP: a comm hook that all-reduces the gradient buckets in bf16/fp16 (half the bytes
+# of fp32) and counts what goes over the wire, tunable bucket size, and one all_reduce for several scalar metrics
+#
+# DDP already overlaps the bucket all-reduces with backward: a bucket is sent as soon as all its grads are ready,
+# so smaller buckets start communicating earlier and larger ones have less per call overhead
+#
+# python3 ddp_comm.py --world_size 2   # gloo on cpu: bytes and step time for fp32/bf16/fp16 and a few bucket sizes
+import os
+import time
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+comm_dtypes = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+class CommState:
+    # passed to the hook by DDP, also where the bytes are counted
+
+    def __init__(self, process_group=None, dtype=None):
+        self.process_group = process_group
+        self.world_size = dist.get_world_size(process_group)
+        self.dtype = dtype
+        self.bytes = 0
+        self.num_calls = 0
+
+    def reset(self):
+        self.bytes = 0
+        self.num_calls = 0
+
+
+def compress_hook(state, bucket):
+    # same scheme as torch's fp16_compress_hook/bf16_compress_hook: cast, divide by world size before the sum
+    # so fp16 can not overflow, all_reduce, cast back into the fp32 bucket
+    buffer = bucket.buffer()
+    tensor = buffer if state.dtype is None else buffer.to(state.dtype)
+    tensor.div_(state.world_size)
+    state.bytes += tensor.numel() * tensor.element_size()
+    state.num_calls += 1
+    fut = dist.all_reduce(tensor, group=state.process_group, async_op=True).get_future()
+
+    def decompress(fut):
+        out = fut.value()[0]
+        if state.dtype is None:
+            return out
+        buffer.copy_(out)
+        return buffer
+
+    return fut.then(decompress)
+
+
+def wrap_ddp(model, device_ids=None, comm_dtype='fp32', bucket_cap_mb=25):
+    """
+    DDP with the counting/compressing hook registered.
+    comm_dtype: 'fp32', 'bf16' or 'fp16'. bucket_cap_mb: DDP's bucket size (its default is 25)
+    returns (ddp_model, state), state.bytes counts the gradient bytes sent by this rank
+    """
+    # gradient_as_bucket_view: grads live in the buckets, no extra copy in and out of them
+    model = DDP(model, device_ids=device_ids, bucket_cap_mb=bucket_cap_mb, gradient_as_bucket_view=True)
+    state = CommState(dtype=comm_dtypes[comm_dtype])
+    model.register_comm_hook(state, compress_hook)
+    return model, state
+
+
+def all_reduce_scalars(values, op=dist.ReduceOp.SUM, device='cpu', async_op=False):
+    """
+    all_reduce several scalars (python numbers or 0-dim tensors) in one call instead of one call each
+    returns the reduced values as a float64 tensor, or (tensor, work) with async_op, call work.wait() before reading
+    """
+    packed = torch.stack([torch.as_tensor(v, dtype=torch.float64, device=device).detach().reshape(()) for v in values])
+    work = dist.all_reduce(packed, op=op, async_op=async_op)
+    return (packed, work) if async_op else packed
+
+
+def _bench_worker(rank, world_size, steps, configs, port):
+    from train_gpt2 import GPT, GPTConfig
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.manual_seed(1337 + rank)
+    x = torch.randint(512, (4, 128))
+    for comm_dtype, bucket_cap_mb in configs:
+        torch.manual_seed(1337)
+        model, state = wrap_ddp(GPT(GPTConfig(block_size=128, vocab_size=512, n_layer=4, n_head=4, n_embd=256)),
+                                comm_dtype=comm_dtype, bucket_cap_mb=bucket_cap_mb)
+        ops = torch.optim.AdamW(model.parameters(), lr=1e-3)
+        times = []
+        for step in range(steps + 1):
+            if step == 1:
+                state.reset() # step 0 warms up and lets DDP rebuild its buckets
+            t0 = time.time()
+            ops.zero_grad(set_to_none=True)
+            logits, loss = model(x, x)
+            loss.backward()
+            ops.step()
+            loss_avg = all_reduce_scalars([loss]) / world_size # SUM / world size, gloo has no ReduceOp.AVG
+            times.append(time.time() - t0)
+        if rank == 0:
+            dt = sorted(times[1:])[len(times[1:]) // 2]
+            print(f'{comm_dtype:4s} bucket {bucket_cap_mb:5.1f}MB | {state.bytes / steps / 2**20:8.2f}MB/step | '
+                  f'{state.num_calls / steps:5.1f} calls/step | step {dt*1000:8.2f}ms | loss {loss_avg.item():.4f}')
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    import argparse
+    import torch.multiprocessing as mp
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--world_size", type=int, default=2)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--bucket_cap_mb", type=float, nargs='*', default=[1, 5, 25])
+    parser.add_argument("--port", type=int, default=29511)
+    args = parser.parse_args()
+    configs = [(d, b) for d in comm_dtypes for b in args.bucket_cap_mb]
+    mp.spawn(_bench_worker, args=(args.world_size, args.steps, configs, args.port), nprocs=args.world_size)
@@ -3,6 +3,7 @@ from datasets import load_dataset
 from tqdm import tqdm
 import numpy as np
 import multiprocessing as mp
+from shard_sampler import build_manifest
 # https://huggingface.co/datasets/HuggingFaceFW/fineweb-edu
 local_dir = 'edu_fineweb10B'
 remote_name = 'sample-10BT'
@@ -67,3 +68,5 @@ with mp.Pool(nprocs) as pool:
         filename = os.path.join(DATA_CACHE_DIR, f'edufineweb_{split}_{shard_index:06d}')
         write_datafile(filename, all_token_up[:token_count])
 
+# token counts and offsets of every shard, for shard_sampler.RandomWindowLoader
+build_manifest(DATA_CACHE_DIR)
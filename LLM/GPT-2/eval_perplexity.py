@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+# val loss / perplexity of our own log/model_*.pt checkpoints over the edufineweb_val_* shards
+# the shards are memory mapped and cut into non overlapping windows of T tokens, every worker process scores
+# its share of the windows in large batches, and each batch is read once and scored by every checkpoint
+#
+# python3 eval_perplexity.py log/model_05000.pt log/model_10000.pt log/model_19072.pt --workers 4
+# python3 eval_perplexity.py "log/model_*.pt" --max_tokens 10000000
+import os
+import glob
+import math
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from train_gpt2 import GPT
+
+
+def find_shards(data_root='edu_fineweb10B', split='val'):
+    shards = sorted(s for s in os.listdir(data_root) if f'edufineweb_{split}_' in s)
+    assert len(shards) > 0, f'no shards found for split {split} in {data_root}'
+    return [os.path.join(data_root, s) for s in shards]
+
+
+def make_windows(shards, T, max_tokens=None):
+    # (shard index, start) of every window of T inputs + 1 target, windows never cross a shard boundary
+    windows = []
+    for i, path in enumerate(shards):
+        n = len(np.load(path, mmap_mode='r'))
+        windows += [(i, start) for start in range(0, n - T, T)]
+    if max_tokens is not None:
+        windows = windows[:max(1, max_tokens // T)]
+    return windows
+
+
+def load_checkpoint(path, device):
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False) # the config is a pickled GPTConfig
+    model = GPT(checkpoint['config'])
+    model.load_state_dict(checkpoint['model'])
+    model.to(device)
+    model.eval()
+    return model, checkpoint.get('step')
+
+
+def worker(rank, args, checkpoints, shards, windows, results):
+    num_workers = args.workers
+    if args.device == 'cuda':
+        device = f'cuda:{rank % torch.cuda.device_count()}'
+        torch.cuda.set_device(device)
+    else:
+        device = 'cpu'
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+    device_type = 'cuda' if device.startswith('cuda') else 'cpu'
+    models = [load_checkpoint(path, device)[0] for path in checkpoints]
+    tokens = [np.load(path, mmap_mode='r') for path in shards]
+
+    # contiguous slice of the windows per worker, so each one reads its part of the shard sequentially
+    mine = windows[rank * len(windows) // num_workers:(rank + 1) * len(windows) // num_workers]
+    T = args.T
+    loss_sum = torch.zeros(len(models), dtype=torch.float64, device=device)
+    num_tokens = 0
+    with torch.inference_mode():
+        for b in range(0, len(mine), args.batch_size):
+            batch = np.stack([tokens[s][start:start + T + 1] for s, start in mine[b:b + args.batch_size]])
+            buf = torch.from_numpy(batch.astype(np.int64)).to(device, non_blocking=True)
+            x, y = buf[:, :-1], buf[:, 1:]
+            for i, model in enumerate(models):
+                with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+                    logits, loss = model(x, y)
+                loss_sum[i] += loss.double() * y.numel() # the loss is a mean over B*T
+            num_tokens += y.numel()
+    results.put((rank, loss_sum.cpu().tolist(), num_tokens))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoints", type=str, nargs='+', help="log/model_*.pt files, glob patterns are expanded")
+    parser.add_argument("--data_root", type=str, default="edu_fineweb10B")
+    parser.add_argument("--split", type=str, default="val")
+    parser.add_argument("-T", "--T", type=int, default=1024, help="window length, at most the block size")
+    parser.add_argument("-b", "--batch_size", type=int, default=32, help="windows per forward")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="worker processes")
+    parser.add_argument("--max_tokens", type=int, default=None, help="only score the first max_tokens of the split")
+    parser.add_argument("-d", "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    checkpoints = sorted({p for pattern in args.checkpoints for p in (glob.glob(pattern) or [pattern])})
+    shards = find_shards(args.data_root, args.split)
+    windows = make_windows(shards, args.T, args.max_tokens)
+    print(f'{len(checkpoints)} checkpoints | {len(shards)} {args.split} shards | {len(windows)} windows of {args.T} tokens | {args.workers} workers')
+
+    ctx = mp.get_context('spawn')
+    results = ctx.SimpleQueue()
+    t0 = time.time()
+    mp.spawn(worker, args=(args, checkpoints, shards, windows, results), nprocs=args.workers)
+    dt = time.time() - t0
+
+    loss_sum = np.zeros(len(checkpoints))
+    num_tokens = 0
+    for _ in range(args.workers):
+        rank, sums, n = results.get()
+        loss_sum += sums
+        num_tokens += n
+    print(f'{num_tokens} tokens in {dt:.2f}s | {num_tokens / dt:.0f} tok/sec read | {num_tokens * len(checkpoints) / dt:.0f} tok/sec scored')
+    for path, s in zip(checkpoints, loss_sum):
+        loss = s / num_tokens
+        print(f'{path} | loss {loss:.4f} | ppl {math.exp(loss):.2f}')
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+# export a trained GPT to TorchScript or ONNX for cpu inference, with the kv cache as explicit inputs/outputs:
+#   inputs  idx (B, T) int64, past_k / past_v (n_layer, B, n_head, P, head_size) float32
+#   outputs logits (B, vocab_size) of the last position, present_k / present_v (n_layer, B, n_head, P+T, head_size)
+# B, T and P are dynamic, P = 0 is the prefill. a <model>.json next to the export holds the config, so
+# run_exported.py only needs numpy + tiktoken (+ onnxruntime or torch for the graph), not train_gpt2.py
+#
+# python3 export_gpt2.py log/model_19072.pt --format onnx -o gpt2.onnx
+# python3 export_gpt2.py log/model_19072.pt --format torchscript -o gpt2.ts --bench
+import json
+import time
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+from train_gpt2 import GPT, KVCache, enc
+
+
+class ExportGPT(nn.Module):
+    # the same math as GPT.forward with a kv cache, written with plain tensors so it traces into a static graph
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.n_head = model.config.n_head
+        self.n_embd = model.config.n_embd
+
+    def forward(self, idx, past_k, past_v):
+        B, T = idx.size()
+        P = past_k.size(3)
+        C = self.n_embd
+        hs = C // self.n_head
+        pos = torch.arange(T, device=idx.device) + P
+        x = self.model.transformer.wte(idx) + self.model.transformer.wpe(pos)
+        # new token t (at position P+t) sees every cached token and the new ones up to itself
+        attn_mask = torch.arange(P + T, device=idx.device)[None, :] <= pos[:, None] # (T, P+T)
+        present_k, present_v = [], []
+        for i, block in enumerate(self.model.transformer.h):
+            attn = block.attn
+            q, k, v = attn.c_attn(block.ln_1(x)).split(C, dim=2)
+            q = q.view(B, T, self.n_head, hs).transpose(1, 2)
+            k = torch.cat((past_k[i], k.view(B, T, self.n_head, hs).transpose(1, 2)), dim=2)
+            v = torch.cat((past_v[i], v.view(B, T, self.n_head, hs).transpose(1, 2)), dim=2)
+            present_k.append(k)
+            present_v.append(v)
+            y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+            x = x + attn.c_proj(y.transpose(1, 2).contiguous().view(B, T, C))
+            x = x + block.mlp(block.ln_2(x))
+        x = self.model.transformer.ln_f(x[:, -1, :])
+        return self.model.lm_head(x), torch.stack(present_k), torch.stack(present_v)
+
+
+def example_inputs(config, B=2, T=3, P=2):
+    # P > 0 so no cache dimension is baked in as 0 while tracing
+    hs = config.n_embd // config.n_head
+    past = torch.zeros(config.n_layer, B, config.n_head, P, hs)
+    return torch.randint(config.vocab_size, (B, T)), past, past.clone()
+
+
+def export(model, path, fmt='onnx'):
+    model = model.float().eval().to('cpu')
+    wrapper = ExportGPT(model).eval()
+    inputs = example_inputs(model.config)
+    with torch.no_grad():
+        if fmt == 'torchscript':
+            traced = torch.jit.trace(wrapper, inputs, check_trace=False)
+            traced = torch.jit.freeze(traced)
+            traced.save(path)
+        elif fmt == 'onnx':
+            cache_axes = {1: 'batch', 3: 'past'}
+            torch.onnx.export(wrapper, inputs, path, opset_version=17,
+                              input_names=['idx', 'past_k', 'past_v'],
+                              output_names=['logits', 'present_k', 'present_v'],
+                              dynamic_axes={'idx': {0: 'batch', 1: 'seq'}, 'past_k': cache_axes, 'past_v': cache_axes,
+                                            'logits': {0: 'batch'},
+                                            'present_k': {1: 'batch', 3: 'total'}, 'present_v': {1: 'batch', 3: 'total'}})
+        else:
+            raise ValueError(f'unknown format {fmt}')
+    c = model.config
+    meta = {'format': fmt, 'n_layer': c.n_layer, 'n_head': c.n_head, 'n_embd': c.n_embd,
+            'block_size': c.block_size, 'vocab_size': c.vocab_size, 'n_vocab': enc.n_vocab}
+    with open(path + '.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+    return path
+
+
+@torch.no_grad()
+def check(model, wrapper_fn, B=2, T=5, steps=3):
+    # max abs logits difference between eager GPT + KVCache and an exported callable over a prefill and some decode steps
+    model = model.float().eval()
+    cache = KVCache(model.config.n_layer)
+    idx = torch.randint(enc.n_vocab, (B, T))
+    hs = model.config.n_embd // model.config.n_head
+    past_k = past_v = torch.zeros(model.config.n_layer, B, model.config.n_head, 0, hs).numpy()
+    diff = 0.0
+    for _ in range(steps):
+        logits, _ = model(idx, kv_cache=cache)
+        out, past_k, past_v = wrapper_fn(idx.numpy(), past_k, past_v)
+        diff = max(diff, (logits[:, -1, :] - torch.from_numpy(out)).abs().max().item())
+        idx = logits[:, -1, :].argmax(dim=-1, keepdim=True)
+    return diff
+
+
+@torch.no_grad()
+def eager_generate(model, tokens, num_return_sequences, max_new_tokens, top_k=50):
+    # the eager baseline for the benchmark, same loop as run_exported.generate
+    idx = torch.tensor(tokens, dtype=torch.long)[None].repeat(num_return_sequences, 1)
+    cache = KVCache(model.config.n_layer)
+    out = idx
+    for _ in range(max_new_tokens):
+        logits, _ = model(idx, kv_cache=cache)
+        probs = F.softmax(logits[:, -1, :enc.n_vocab], dim=-1)
+        topk_probs, topk_indices = torch.topk(probs, top_k, dim=-1)
+        idx = torch.gather(topk_indices, -1, torch.multinomial(topk_probs, 1))
+        out = torch.cat((out, idx), dim=1)
+    return out
+
+
+if __name__ == '__main__':
+    import argparse
+    from run_exported import ExportedModel, generate, prompts
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoint", type=str, help="log/model_*.pt")
+    parser.add_argument("--format", type=str, default="onnx", choices=["onnx", "torchscript"])
+    parser.add_argument("-o", "--output", type=str, default=None)
+    parser.add_argument("--bench", action="store_true", help="latency/throughput against eager on the same prompts")
+    parser.add_argument("--num_return_sequences", type=int, default=4)
+    parser.add_argument("--max_new_tokens", type=int, default=64)
+    args = parser.parse_args()
+
+    checkpoint = torch.load(args.checkpoint, map_location='cpu', weights_only=False)
+    model = GPT(checkpoint['config'])
+    model.load_state_dict(checkpoint['model'])
+    model.eval()
+    path = args.output or ('gpt2.onnx' if args.format == 'onnx' else 'gpt2.ts')
+    export(model, path, args.format)
+    exported = ExportedModel(path)
+    print(f'exported {args.checkpoint} to {path} | max abs logits diff vs eager: {check(model, exported.forward):.2e}')
+
+    if args.bench:
+        for name, fn in [('eager', lambda t: eager_generate(model, t, args.num_return_sequences, args.max_new_tokens)),
+                         (args.format, lambda t: generate(exported, t, args.num_return_sequences, args.max_new_tokens))]:
+            fn(enc.encode(prompts[0])) # warmup
+            latencies = []
+            for prompt in prompts:
+                t0 = time.time()
+                fn(enc.encode(prompt))
+                latencies.append(time.time() - t0)
+            total = sum(latencies)
+            num_tokens = len(prompts) * args.num_return_sequences * args.max_new_tokens
+            print(f'{name:12s} | mean latency {total / len(prompts) * 1000:.1f}ms per prompt | {num_tokens / total:.1f} tok/sec')
@@ -1,17 +1,21 @@
 import os
 import json
+import hashlib
 import requests
 import tiktoken
+import numpy as np
 from tqdm import tqdm
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
-from transformers import GPT2LMHeadModel
 
 DATA_CACHE_DIR = os.path.join(os.path.dirname(__file__), "hellaswag")
+# HELLASWAG_OFFLINE=1: never touch the network, fail if the local cache is missing or corrupt
+OFFLINE = os.environ.get('HELLASWAG_OFFLINE', '0') == '1'
 
 def download_file(url: str, fname: str, chunk_size=1024):
     resp = requests.get(url, stream=True)
+    resp.raise_for_status()
     total = int(resp.headers.get("Content-length", 0))
     with open(fname, "wb") as file, tqdm(
 
@@ -35,12 +39,44 @@ hellaswags = {
 
 enc = tiktoken.get_encoding('gpt2')
 
-def download(split):
+def sha256sum(fname, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def cached_checksum(split):
+    # sha256 of the local jsonl, None unless the file exists and still matches the checksum recorded at download
+    file_name = os.path.join(DATA_CACHE_DIR, f'hellaswag_{split}.jsonl')
+    if not (os.path.exists(file_name) and os.path.exists(file_name + '.sha256')):
+        return None
+    with open(file_name + '.sha256') as f:
+        expected = f.read().strip()
+    return expected if sha256sum(file_name) == expected else None
+
+def download(split, offline=None):
+    # only downloads when the local copy is missing or does not match its checksum, returns the checksum
+    offline = OFFLINE if offline is None else offline
+    checksum = cached_checksum(split)
+    if checksum is not None:
+        return checksum
+    file_name = os.path.join(DATA_CACHE_DIR, f'hellaswag_{split}.jsonl')
+    if offline:
+        raise FileNotFoundError(f'offline mode and no valid cached {file_name}, run once with the network to fill the cache')
     os.makedirs(DATA_CACHE_DIR, exist_ok=True)
     url = hellaswags[split]
-    file_name = os.path.join(DATA_CACHE_DIR, f'hellaswag_{split}.jsonl')
     print(f'Donwlaoding from {url} to {file_name}')
-    download_file(url,file_name)
+    # write to a temp file first, an interrupted download never looks like a valid cache. the temp names are per
+    # process: every DDP rank may fill a cold cache at once, each replace is atomic and writes the same content
+    tmp = f'{file_name}.{os.getpid()}.tmp'
+    download_file(url, tmp)
+    checksum = sha256sum(tmp)
+    with open(tmp + '.sha256', 'w') as f:
+        f.write(checksum + '\n')
+    os.replace(tmp, file_name)
+    os.replace(tmp + '.sha256', file_name + '.sha256')
+    return checksum
 
 def render_example(example):
    ctx = example['ctx']
@@ -75,15 +111,56 @@ def render_example(example):
    return data, tokens, mask, label
 
 
-def iterate_example(split):
-   download(split)
+def iterate_example(split, offline=None):
+   download(split, offline)
    with open(os.path.join(DATA_CACHE_DIR, f'hellaswag_{split}.jsonl'), 'r') as f:
       for line in f:
          example = json.loads(line)
          yield example
 
+def build_token_cache(split, checksum, offline=None):
+    # every example as flat uint16 tokens: ctx, then the 4 endings. offsets[i] is where example i starts and
+    # lengths[i] holds the ctx length and the 4 ending lengths, so rendering needs no json parsing or tokenizing
+    tokens, offsets, lengths, labels = [], [0], [], []
+    for example in iterate_example(split, offline):
+        ctx = enc.encode(example['ctx'])
+        ends = [enc.encode(" " + end) for end in example['endings']]
+        row = ctx + [t for end in ends for t in end]
+        tokens.extend(row)
+        offsets.append(offsets[-1] + len(row))
+        lengths.append([len(ctx)] + [len(end) for end in ends])
+        labels.append(example['label'])
+    cache_file = os.path.join(DATA_CACHE_DIR, f'hellaswag_{split}.tokens.npz')
+    tmp = f'{cache_file}.{os.getpid()}.tmp.npz' # per process, see download()
+    np.savez(tmp, tokens=np.array(tokens, dtype=np.uint16), offsets=np.array(offsets, dtype=np.int64),
+             lengths=np.array(lengths, dtype=np.int32), labels=np.array(labels, dtype=np.int8), checksum=np.array(checksum))
+    os.replace(tmp, cache_file)
+
+def iterate_rendered(split, offline=None):
+    # the same (tokens, mask, label) as render_example, read from the binary token cache built on first use
+    checksum = download(split, offline)
+    cache_file = os.path.join(DATA_CACHE_DIR, f'hellaswag_{split}.tokens.npz')
+    if not os.path.exists(cache_file) or str(np.load(cache_file)['checksum']) != checksum:
+        build_token_cache(split, checksum, offline)
+    cache = np.load(cache_file)
+    tokens, offsets, lengths, labels = cache['tokens'], cache['offsets'], cache['lengths'], cache['labels']
+    for i in range(len(labels)):
+        row = tokens[offsets[i]:offsets[i + 1]].astype(np.int64)
+        ctx_len, end_lens = int(lengths[i][0]), lengths[i][1:]
+        max_len = ctx_len + int(end_lens.max())
+        out = torch.zeros((4, max_len), dtype=torch.long)
+        mask = torch.zeros((4, max_len), dtype=torch.long)
+        start = ctx_len
+        for j, n in enumerate(end_lens):
+            out[j, :ctx_len] = torch.from_numpy(row[:ctx_len])
+            out[j, ctx_len:ctx_len + n] = torch.from_numpy(row[start:start + n])
+            mask[j, ctx_len:ctx_len + n] = 1
+            start += n
+        yield out, mask, int(labels[i])
+
 @torch.no_grad()
 def eval(model_type, device):
+   from transformers import GPT2LMHeadModel # only needed here, keeps importing this module cheap
    torch.set_float32_matmul_precision('high') # use tf32
    model = GPT2LMHeadModel.from_pretrained(model_type)
    model.to(device)
@@ -143,5 +220,7 @@ if __name__ == '__main__':
    parser = argparse.ArgumentParser()
    parser.add_argument("-m", "--model_type", type=str, default="gpt2", help="the model type to use")
    parser.add_argument("-d", "--device", type=str, default="cuda", help="the device to use")
+   parser.add_argument("--offline", action="store_true", help="only use the local cache, same as HELLASWAG_OFFLINE=1")
    args = parser.parse_args()
+   OFFLINE = OFFLINE or args.offline
    eval(args.model_type,args.device)
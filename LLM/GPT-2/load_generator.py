@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+# local load generator for serve_gpt2.py: fires requests from concurrent clients with random prompt/max_tokens
+# and reports client side throughput and latency next to the server's /metrics
+#
+# python3 load_generator.py --clients 8 --requests 64
+import json
+import random
+import threading
+import time
+import urllib.request
+
+prompts = [
+    "This is how Tesla FSD works, ",
+    "This is how Tesla's FSD and Autopilot system work: ",
+    "Hello, I'm a language model,",
+    "The history of the printing press",
+    "In the beginning",
+]
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def generate(url, prompt, max_tokens):
+    # returns (time to first token, total latency, number of tokens) measured on the client
+    data = json.dumps({'prompt': prompt, 'max_tokens': max_tokens}).encode()
+    req = urllib.request.Request(f'{url}/generate', data=data, headers={'Content-Type': 'application/json'})
+    t0 = time.time()
+    ttft = None
+    num_tokens = 0
+    with urllib.request.urlopen(req) as resp:
+        for line in resp:
+            msg = json.loads(line)
+            if 'token' in msg:
+                if ttft is None:
+                    ttft = time.time() - t0
+                num_tokens += 1
+    return ttft, time.time() - t0, num_tokens
+
+
+def client(url, n, min_tokens, max_tokens, results, seed):
+    rng = random.Random(seed)
+    for _ in range(n):
+        results.append(generate(url, rng.choice(prompts), rng.randint(min_tokens, max_tokens)))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8000")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=64, help="total requests over all clients")
+    parser.add_argument("--min_tokens", type=int, default=16)
+    parser.add_argument("--max_tokens", type=int, default=128)
+    args = parser.parse_args()
+
+    results = []
+    per_client = max(1, args.requests // args.clients)
+    threads = [threading.Thread(target=client, args=(args.url, per_client, args.min_tokens, args.max_tokens, results, i))
+               for i in range(args.clients)]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    dt = time.time() - t0
+
+    ttft = [r[0] for r in results if r[0] is not None]
+    latency = [r[1] for r in results]
+    num_tokens = sum(r[2] for r in results)
+    print(f'{len(results)} requests from {args.clients} clients in {dt:.2f}s')
+    print(f'throughput: {len(results) / dt:.2f} req/sec | {num_tokens / dt:.2f} tok/sec')
+    print(f'ttft p50: {percentile(ttft, 0.5)*1000:.2f}ms | p95: {percentile(ttft, 0.95)*1000:.2f}ms')
+    print(f'latency p50: {percentile(latency, 0.5)*1000:.2f}ms | p95: {percentile(latency, 0.95)*1000:.2f}ms')
+    with urllib.request.urlopen(f'{args.url}/metrics') as resp:
+        print(f'server metrics: {json.dumps(json.load(resp), indent=2)}')
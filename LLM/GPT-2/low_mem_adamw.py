@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+# AdamW with smaller moments: 'bf16' keeps exp_avg/exp_avg_sq in bfloat16 (4 bytes per param instead of 8),
+# '8bit' keeps them as int8/uint8 with one fp32 absmax scale per block of 256 values (~2 bytes per param), on log
+# spaced codes so a small moment next to a large one in the same block does not round to 0.
+# moments are written back with stochastic rounding, so small updates are not always rounded away.
+# the update runs on all tensors of a param group at once with the torch._foreach_* multi tensor ops, on cpu too
+#
+# python3 low_mem_adamw.py   # optimizer state memory and loss curves of fp32 AdamW vs bf16 vs 8bit on a tiny GPT
+import math
+import time
+import torch
+
+BLOCK = 256
+
+
+def stochastic_round_bf16(x):
+    # add random bits below the bf16 mantissa, then truncate: rounds up with probability equal to the remainder
+    bits = x.float().view(torch.int32)
+    noise = torch.randint_like(bits, 0, 1 << 16)
+    return ((bits + noise) & -65536).view(torch.float32).to(torch.bfloat16)
+
+
+def dynamic_code(signed):
+    # code -> fraction of the block absmax, sorted: 0 plus log spaced levels up to 1. with linear codes a value below
+    # absmax/255 rounds to 0, and a sqrt(v) of 0 turns the Adam denominator into eps and the update blows up.
+    # unsigned (uint8 c): 0 and 2^(-(255-c)/8), 8 levels per octave down to ~3e-10
+    # signed (int8 c, table index c+127): 0 and +-2^(-(127-|c|)/4), 4 levels per octave down to ~4e-10
+    if signed:
+        pos = 2.0 ** ((torch.arange(1, 128, dtype=torch.float32) - 127) / 4)
+        return torch.cat([-pos.flip(0), torch.zeros(1), pos])
+    return torch.cat([torch.zeros(1), 2.0 ** ((torch.arange(1, 256, dtype=torch.float32) - 255) / 8)])
+
+
+CODES = {True: dynamic_code(True), False: dynamic_code(False)}
+
+
+def quantize_blockwise(x, signed):
+    # x (n,) fp32 -> int8/uint8 codes and an fp32 absmax per block. stochastic rounding between the two nearest
+    # levels, with probability proportional to the distance, so the stored value is unbiased
+    n = x.numel()
+    pad = (-n) % BLOCK
+    blocks = torch.nn.functional.pad(x.float(), (0, pad)).view(-1, BLOCK)
+    code = CODES[signed].to(blocks.device)
+    scale = blocks.abs().amax(dim=1, keepdim=True).clamp(min=1e-30)
+    r = (blocks / scale).clamp(-1 if signed else 0, 1)
+    hi = torch.searchsorted(code, r.reshape(-1)).clamp(1, code.numel() - 1).view_as(r)
+    lo = hi - 1
+    p = (r - code[lo]) / (code[hi] - code[lo])
+    q = torch.where(torch.rand_like(r) < p, hi, lo)
+    if signed:
+        q = q - 127
+    return q.to(torch.int8 if signed else torch.uint8).view(-1)[:n], scale.view(-1)
+
+
+def dequantize_blockwise(q, scale, signed):
+    n = q.numel()
+    pad = (-n) % BLOCK
+    code = CODES[signed].to(q.device)
+    ix = q.long() + 127 if signed else q.long()
+    blocks = torch.nn.functional.pad(code[ix], (0, pad)).view(-1, BLOCK)
+    return (blocks * scale[:, None]).view(-1)[:n]
+
+
+class LowMemAdamW(torch.optim.Optimizer):
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.95), eps=1e-8, weight_decay=0.0, state_dtype='bf16'):
+        assert state_dtype in {'bf16', '8bit'}, f'unknown state_dtype {state_dtype}'
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, state_dtype=state_dtype)
+        super().__init__(params, defaults)
+
+    def init_state(self, p, state_dtype):
+        state = self.state[p]
+        state['step'] = 0
+        if state_dtype == 'bf16':
+            state['exp_avg'] = torch.zeros_like(p, dtype=torch.bfloat16)
+            state['exp_avg_sq'] = torch.zeros_like(p, dtype=torch.bfloat16)
+        else:
+            nblocks = -(-p.numel() // BLOCK)
+            state['exp_avg'] = torch.zeros(p.numel(), dtype=torch.int8, device=p.device)
+            state['exp_avg_scale'] = torch.zeros(nblocks, dtype=torch.float32, device=p.device)
+            # the second moment is stored as sqrt(v): same dynamic range as |m|, so 8 bits go a lot further
+            state['exp_avg_sq'] = torch.zeros(p.numel(), dtype=torch.uint8, device=p.device)
+            state['exp_avg_sq_scale'] = torch.zeros(nblocks, dtype=torch.float32, device=p.device)
+
+    def load_state_dict(self, state_dict):
+        # Optimizer.load_state_dict casts all tensor state (except step) to the param dtype, the int8/uint8 codes
+        # included, put every moment back in its compact dtype
+        super().load_state_dict(state_dict)
+        for group in self.param_groups:
+            if group['state_dtype'] == 'bf16':
+                dtypes = {'exp_avg': torch.bfloat16, 'exp_avg_sq': torch.bfloat16}
+            else:
+                dtypes = {'exp_avg': torch.int8, 'exp_avg_scale': torch.float32,
+                          'exp_avg_sq': torch.uint8, 'exp_avg_sq_scale': torch.float32}
+            for p in group['params']:
+                state = self.state.get(p)
+                if state:
+                    for name, dtype in dtypes.items():
+                        state[name] = state[name].to(dtype)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            params = [p for p in group['params'] if p.grad is not None]
+            if not params:
+                continue
+            state_dtype = group['state_dtype']
+            beta1, beta2 = group['betas']
+            for p in params:
+                if not self.state[p]:
+                    self.init_state(p, state_dtype)
+                self.state[p]['step'] += 1
+            states = [self.state[p] for p in params]
+            step = states[0]['step']
+            grads = [p.grad.float() for p in params]
+
+            # moments to fp32 working copies
+            if state_dtype == 'bf16':
+                m = [s['exp_avg'].float() for s in states]
+                v = [s['exp_avg_sq'].float() for s in states]
+            else:
+                m = [dequantize_blockwise(s['exp_avg'], s['exp_avg_scale'], True).view_as(p) for s, p in zip(states, params)]
+                v = [dequantize_blockwise(s['exp_avg_sq'], s['exp_avg_sq_scale'], False).view_as(p) for s, p in zip(states, params)]
+                torch._foreach_mul_(v, v) # stored as sqrt(v)
+
+            torch._foreach_mul_(m, beta1)
+            torch._foreach_add_(m, grads, alpha=1 - beta1)
+            torch._foreach_mul_(v, beta2)
+            torch._foreach_addcmul_(v, grads, grads, value=1 - beta2)
+
+            bias_correction1 = 1 - beta1 ** step
+            bias_correction2 = 1 - beta2 ** step
+            step_size = group['lr'] / bias_correction1
+            denom = torch._foreach_sqrt(v)
+            torch._foreach_div_(denom, math.sqrt(bias_correction2))
+            torch._foreach_add_(denom, group['eps'])
+            if group['weight_decay'] != 0:
+                torch._foreach_mul_(params, 1 - group['lr'] * group['weight_decay'])
+            torch._foreach_addcdiv_(params, m, denom, value=-step_size)
+
+            # write the moments back in their compact format
+            for s, mi, vi in zip(states, m, v):
+                if state_dtype == 'bf16':
+                    s['exp_avg'] = stochastic_round_bf16(mi)
+                    s['exp_avg_sq'] = stochastic_round_bf16(vi)
+                else:
+                    s['exp_avg'], s['exp_avg_scale'] = quantize_blockwise(mi.view(-1), True)
+                    s['exp_avg_sq'], s['exp_avg_sq_scale'] = quantize_blockwise(vi.view(-1).sqrt(), False)
+        return loss
+
+
+def state_bytes(optimizer):
+    return sum(t.numel() * t.element_size() for s in optimizer.state.values() for t in s.values() if torch.is_tensor(t))
+
+
+if __name__ == '__main__':
+    import argparse
+    from train_gpt2 import GPT, GPTConfig
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--lr", type=float, default=1e-3)
+    args = parser.parse_args()
+
+    config = GPTConfig(block_size=64, vocab_size=256, n_layer=2, n_head=4, n_embd=128)
+    # a fixed random bigram table as data, so the loss has something real to go down to
+    g = torch.Generator().manual_seed(0)
+    table = torch.randint(config.vocab_size, (config.vocab_size, 4), generator=g)
+
+    def batch(step, B=16, T=64):
+        g = torch.Generator().manual_seed(step)
+        x = torch.empty((B, T + 1), dtype=torch.long)
+        x[:, 0] = torch.randint(config.vocab_size, (B,), generator=g)
+        choice = torch.randint(4, (B, T), generator=g)
+        for t in range(T):
+            x[:, t + 1] = table[x[:, t], choice[:, t]]
+        return x[:, :-1], x[:, 1:]
+
+    for name in ['fp32', 'bf16', '8bit']:
+        torch.manual_seed(1337)
+        model = GPT(config)
+        ops = model.configure_optimizers(weight_decay=0.1, lr=args.lr, device='cpu', optim_state=name)
+        t0 = time.time()
+        losses = []
+        for step in range(args.steps):
+            x, y = batch(step)
+            ops.zero_grad(set_to_none=True)
+            logits, loss = model(x, y)
+            loss.backward()
+            ops.step()
+            losses.append(loss.item())
+        dt = time.time() - t0
+        tail = sum(losses[-20:]) / len(losses[-20:])
+        print(f'{name:5s} | state {state_bytes(ops) / 2**20:7.2f}MB | loss {losses[0]:.4f} -> {tail:.4f} (mean of last 20) | {dt:.2f}s')
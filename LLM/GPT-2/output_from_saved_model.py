@@ -2,14 +2,25 @@
 import torch
 import sys,time,os
 import torch.nn.functional as F
-from train_gpt2 import device, model,enc,ddp_rank,device_type,GPTConfig  
+from train_gpt2 import device, enc,device_type,GPT,GPTConfig  
+from speculative_decoding import speculative_generate, draft_from_target
+from sampling import Sampler, PrefixCache, generate_shared, make_generators
+ddp_rank = 0
 # Initialize the model
-def run():
+model = GPT(GPTConfig(vocab_size=50304))
+model.to(device)
+prefix_cache = PrefixCache() # prefilled prompts stay cached between run() calls
+def run(draft=None, gamma=4, sampler=None, prompt="This is how Tesla FSD works, "):
+    # draft: optional small GPT (or number of target layers to reuse) for speculative decoding
+    # sampler: sampling.Sampler for the plain loop and the speculative one (no repetition penalty / stop tokens there), defaults to top-k 50
     # Load the model's state dictionary
     state = torch.load('\path_tosaved_model\model_19072.pt', map_location='cpu')
     # state = torch.load('/home/ubuntu/GPT2/soph/seed0/epoch_1.pt', map_location=device)
     model_state_dict = state['model']
     model.load_state_dict(model_state_dict)
+    if prefix_cache.entries and state.get('step') != prefix_cache.step:
+        prefix_cache.entries.clear() # cached prompts were computed with other weights
+    prefix_cache.step = state.get('step')
     loss_value = state['val_loss']  # Extract the loss value
     epoch = state.get('step')
     print(f"Last loss value from training: {loss_value:.4f}")
@@ -22,28 +33,26 @@ def run():
  
     num_return_sequences = 50
     max_length = 500
-    tokens = enc.encode("This is how Tesla FSD works, ")
-    tokens = torch.tensor(tokens, dtype=torch.long)
+    prompt_tokens = enc.encode(prompt)
+    tokens = torch.tensor(prompt_tokens, dtype=torch.long)
     tokens = tokens.unsqueeze(0).repeat(num_return_sequences, 1)
     xgen = tokens.to(device)
     sample_rng = torch.Generator(device=device)
     sample_rng.manual_seed(42 + ddp_rank)
-    while xgen.size(1) < max_length:
-        # forward model to get the logits
-        with torch.no_grad():
-            with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
-
-                logits, loss = model(xgen) # (B,T,vocab_size)
-                # take the logits at the last position
-                logits = logits[:, -1,:] # (B, vocab_size)
-                # get probailities
-                probs = F.softmax(logits, dim=-1)
-                # do top-k sampling of 50 
-                topk_probs, topk_indices = torch.topk(probs, 50, dim=-1)
-                ix = torch.multinomial(topk_probs, 1, generator=sample_rng) # (B,1)
-                xcol = torch.gather(topk_indices,-1,ix) # (B,1)
-                # append tp the sequence
-                xgen = torch.cat((xgen, xcol), dim=1)
+    if sampler is None:
+        sampler = Sampler(top_k=50, vocab_size=enc.n_vocab)
+    if isinstance(draft, int):
+        draft = draft_from_target(model, draft).to(device).eval()
+    if draft is not None:
+        t0 = time.time()
+        # same sampler as the plain loop, the draft and target distributions are both built from it
+        xgen, stats = speculative_generate(model, draft, xgen, max_length, gamma, sampler, sample_rng=sample_rng, device_type=device_type)
+        print(f"speculative decoding: acceptance rate {stats['acceptance_rate']:.4f} | {stats['tokens_per_target_call']:.2f} tokens per target forward | {time.time() - t0:.2f}s")
+    else:
+        # temperature / top-k / top-p / repetition penalty / stop tokens all live in the sampler
+        generators = make_generators([42 + ddp_rank * num_return_sequences + i for i in range(num_return_sequences)], device)
+        # the prompt is prefilled once and its kv cache shared by all num_return_sequences rows
+        xgen = generate_shared(model, prompt_tokens, num_return_sequences, max_length, sampler, generators, device_type, prefix_cache)
 
     # with open('tesla2.txt', 'a') as f:    
     for i in range(num_return_sequences):
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+# text generation from a GPT exported by export_gpt2.py, without train_gpt2.py:
+# numpy + tiktoken, and onnxruntime for .onnx or torch.jit for a TorchScript export
+#
+# python3 run_exported.py gpt2.onnx --prompt "This is how Tesla FSD works, " --max_new_tokens 64
+import json
+import time
+import numpy as np
+import tiktoken
+
+prompts = [
+    "This is how Tesla FSD works, ",
+    "This is how Tesla's FSD and Autopilot system work: ",
+    "Hello, I'm a language model,",
+    "The history of the printing press",
+]
+
+
+class ExportedModel:
+
+    def __init__(self, path, num_threads=None):
+        with open(path + '.json') as f:
+            self.meta = json.load(f)
+        self.format = self.meta['format']
+        if self.format == 'onnx':
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            if num_threads:
+                options.intra_op_num_threads = num_threads
+            self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        else:
+            import torch
+            if num_threads:
+                torch.set_num_threads(num_threads)
+            self.module = torch.jit.load(path, map_location='cpu')
+
+    def empty_cache(self, B):
+        m = self.meta
+        return np.zeros((m['n_layer'], B, m['n_head'], 0, m['n_embd'] // m['n_head']), dtype=np.float32)
+
+    def forward(self, idx, past_k, past_v):
+        # idx (B,T) int64, past (n_layer,B,n_head,P,hs) -> last position logits (B,vocab_size), present_k, present_v
+        if self.format == 'onnx':
+            return tuple(self.session.run(None, {'idx': idx, 'past_k': past_k, 'past_v': past_v}))
+        import torch
+        with torch.inference_mode():
+            out = self.module(torch.from_numpy(idx), torch.from_numpy(past_k), torch.from_numpy(past_v))
+        return tuple(t.numpy() for t in out)
+
+
+def sample_top_k(logits, n_vocab, top_k, rng):
+    # logits (B, V) -> (B, 1), top-k sampling like run(), padding tokens past n_vocab never sampled
+    logits = logits[:, :n_vocab].astype(np.float64)
+    ix = np.argpartition(-logits, top_k - 1, axis=1)[:, :top_k]
+    top = np.take_along_axis(logits, ix, axis=1)
+    probs = np.exp(top - top.max(axis=1, keepdims=True))
+    probs /= probs.sum(axis=1, keepdims=True)
+    u = rng.random((logits.shape[0], 1))
+    choice = np.minimum((probs.cumsum(axis=1) < u).sum(axis=1, keepdims=True), top_k - 1)
+    return np.take_along_axis(ix, choice, axis=1)
+
+
+def generate(model, tokens, num_return_sequences=4, max_new_tokens=64, top_k=50, seed=42):
+    # the prompt is forwarded once (P = 0), then one token per step with the returned cache
+    rng = np.random.default_rng(seed)
+    idx = np.tile(np.asarray(tokens, dtype=np.int64)[None], (num_return_sequences, 1))
+    max_new_tokens = min(max_new_tokens, model.meta['block_size'] - idx.shape[1])
+    past_k = past_v = model.empty_cache(num_return_sequences)
+    out = [idx]
+    for _ in range(max_new_tokens):
+        logits, past_k, past_v = model.forward(idx, past_k, past_v)
+        idx = sample_top_k(logits, model.meta['n_vocab'], top_k, rng)
+        out.append(idx)
+    return np.concatenate(out, axis=1)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", type=str, help="gpt2.onnx or gpt2.ts from export_gpt2.py")
+    parser.add_argument("--prompt", type=str, default=None, help="defaults to the built in prompt set")
+    parser.add_argument("--num_return_sequences", type=int, default=4)
+    parser.add_argument("--max_new_tokens", type=int, default=64)
+    parser.add_argument("--top_k", type=int, default=50)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    enc = tiktoken.get_encoding('gpt2')
+    model = ExportedModel(args.model, args.threads)
+    for prompt in ([args.prompt] if args.prompt else prompts):
+        t0 = time.time()
+        out = generate(model, enc.encode(prompt), args.num_return_sequences, args.max_new_tokens, args.top_k)
+        dt = time.time() - t0
+        for i, row in enumerate(out):
+            print(f'sample {i}: {enc.decode(row.tolist())}')
+        print(f'{dt*1000:.1f}ms | {(out.shape[1] - len(enc.encode(prompt))) * out.shape[0] / dt:.1f} tok/sec')
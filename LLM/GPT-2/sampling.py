@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+# one sampler for every generation loop: temperature, top-k, top-p, repetition penalty and stop tokens,
+# all batched on the logits, with the padded vocab (50257..50303) masked out and one seeded rng per sequence
+# generate_shared prefills a prompt once and broadcasts its kv cache to every sequence that starts with it,
+# PrefixCache keeps prefilled prompts around so a repeated system prompt is not forwarded again on the next call
+#
+# python3 sampling.py   # per-token overhead against the old softmax -> topk(50) -> multinomial loop
+import time
+from collections import OrderedDict
+import torch
+from torch.nn import functional as F
+
+
+class Sampler:
+
+    def __init__(self, temperature=1.0, top_k=50, top_p=1.0, repetition_penalty=1.0, stop_tokens=(), vocab_size=50257):
+        # temperature 0 is greedy, top_k 0 / top_p 1.0 / repetition_penalty 1.0 switch those filters off
+        # vocab_size is the real tokenizer vocab, logits past it (the padding up to 50304) are never sampled
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.stop_tokens = list(stop_tokens)
+        self.vocab_size = vocab_size
+
+    def filter_logits(self, logits, history=None):
+        # logits (B, V) -> float logits with -inf on every token that can not be sampled
+        logits = logits.float()
+        if logits.size(-1) > self.vocab_size:
+            logits = logits.clone()
+            logits[:, self.vocab_size:] = float('-inf')
+        if self.repetition_penalty != 1.0 and history is not None:
+            # https://arxiv.org/abs/1909.05858: push down every token already in the sequence
+            score = logits.gather(-1, history)
+            score = torch.where(score > 0, score / self.repetition_penalty, score * self.repetition_penalty)
+            logits = logits.scatter(-1, history, score)
+        if self.temperature > 0:
+            logits = logits / self.temperature
+        if self.top_k > 0:
+            kth = torch.topk(logits, min(self.top_k, logits.size(-1)), dim=-1).values[:, -1:]
+            logits = logits.masked_fill(logits < kth, float('-inf'))
+        if self.top_p < 1.0:
+            # keep the smallest set of tokens whose probability adds up to top_p (always at least the first one)
+            sorted_logits, sorted_indices = torch.sort(logits, dim=-1, descending=True)
+            sorted_probs = F.softmax(sorted_logits, dim=-1)
+            remove = sorted_probs.cumsum(dim=-1) - sorted_probs > self.top_p
+            sorted_logits = sorted_logits.masked_fill(remove, float('-inf'))
+            logits = torch.empty_like(logits).scatter_(-1, sorted_indices, sorted_logits)
+        return logits
+
+    def __call__(self, logits, history=None, generators=None):
+        # logits (B, V), history (B, L) tokens so far, generators: one torch.Generator per row or None -> (B, 1)
+        logits = self.filter_logits(logits, history)
+        if self.temperature == 0:
+            return logits.argmax(dim=-1, keepdim=True)
+        probs = F.softmax(logits, dim=-1)
+        if generators is None:
+            return torch.multinomial(probs, 1)
+        # inverse cdf with one uniform per row, so a row's tokens only depend on its own seed and not on
+        # which other sequences share the batch
+        u = torch.cat([torch.rand(1, generator=g, device=g.device) for g in generators]).to(probs.device)
+        u = u.clamp(min=1e-12) # u == 0 would land on token 0 even if it was filtered out
+        cdf = probs.cumsum(dim=-1)
+        ix = torch.searchsorted(cdf, u[:, None] * cdf[:, -1:])
+        return ix.clamp(max=probs.size(-1) - 1)
+
+
+def make_generators(seeds, device):
+    generators = []
+    for seed in seeds:
+        g = torch.Generator(device=device)
+        g.manual_seed(seed)
+        generators.append(g)
+    return generators
+
+
+@torch.no_grad()
+def generate(model, idx, max_length, sampler, generators=None, device_type='cpu'):
+    # idx (B, T) prompt tokens -> (B, max_length). rows that hit a stop token keep repeating it until all rows are done
+    finished = torch.zeros(idx.size(0), dtype=torch.bool, device=idx.device)
+    stop = torch.tensor(sampler.stop_tokens, dtype=torch.long, device=idx.device)
+    while idx.size(1) < max_length:
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+            logits, loss = model(idx[:, -model.config.block_size:]) # (B,T,vocab_size)
+        xcol = sampler(logits[:, -1, :], history=idx, generators=generators) # (B,1)
+        if len(sampler.stop_tokens):
+            xcol = torch.where(finished[:, None], idx[:, -1:], xcol)
+            finished |= torch.isin(xcol[:, 0], stop)
+        idx = torch.cat((idx, xcol), dim=1)
+        if len(sampler.stop_tokens) and finished.all():
+            break
+    return idx
+
+
+@torch.no_grad()
+def generate_static(model, tokens, num_return_sequences, max_length, sampler, generators=None, device_type='cpu'):
+    # generation for a torch.compile'd model: every forward sees the same (num_return_sequences, max_length) window,
+    # right padded with 0 after the current position. attention is causal, so the padding never changes the logits
+    # at cur-1. it recomputes the whole window each step, which is fine for the short samples of the training loop
+    device = next(model.parameters()).device
+    tokens = list(tokens)
+    buf = torch.zeros((num_return_sequences, max_length), dtype=torch.long, device=device)
+    buf[:, :len(tokens)] = torch.tensor(tokens, dtype=torch.long, device=device)
+    finished = torch.zeros(num_return_sequences, dtype=torch.bool, device=device)
+    stop = torch.tensor(sampler.stop_tokens, dtype=torch.long, device=device)
+    for cur in range(len(tokens), max_length):
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+            logits, loss = model(buf)
+        xcol = sampler(logits[:, cur - 1, :], history=buf[:, :cur], generators=generators)
+        if len(sampler.stop_tokens):
+            xcol = torch.where(finished[:, None], buf[:, cur - 1:cur], xcol)
+            finished |= torch.isin(xcol[:, 0], stop)
+        buf[:, cur] = xcol[:, 0]
+        if len(sampler.stop_tokens) and finished.all():
+            buf[:, cur + 1:] = buf[:, cur:cur + 1]
+            break
+    return buf
+
+
+class PrefixCache:
+    # LRU of prefilled prompts: token tuple -> (KVCache of batch 1, logits of its last token)
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0 # prompt tokens that did not have to be forwarded again
+        self.misses = 0 # prompt tokens that were forwarded
+        self.step = None # free for the caller to tag which weights the entries were computed with
+
+    def longest_prefix(self, tokens):
+        best = None
+        for key in self.entries:
+            if len(key) <= len(tokens) and (best is None or len(key) > len(best)) and tuple(tokens[:len(key)]) == key:
+                best = key
+        return best
+
+    @torch.no_grad()
+    def prefill(self, model, tokens, device, device_type='cpu'):
+        # KVCache and last token logits (1, V) of tokens, forwarding only what is not cached yet
+        tokens = tuple(tokens)
+        key = self.longest_prefix(tokens)
+        if key is not None:
+            self.entries.move_to_end(key)
+            cache, logits = self.entries[key]
+            cache = cache.copy()
+        else:
+            cache, logits = model.make_kv_cache(), None
+        rest = tokens[len(key) if key is not None else 0:]
+        self.hits += len(tokens) - len(rest)
+        self.misses += len(rest)
+        if rest:
+            idx = torch.tensor(rest, dtype=torch.long, device=device)[None]
+            with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+                out, loss = model(idx, kv_cache=cache)
+            logits = out[:, -1, :]
+            self.entries[tokens] = (cache.copy(), logits)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return cache, logits
+
+
+@torch.no_grad()
+def generate_shared(model, tokens, num_return_sequences, max_length, sampler, generators=None, device_type='cpu', prefix_cache=None):
+    # same output shape as generate() on tokens repeated num_return_sequences times -> (num_return_sequences, max_length)
+    # but the prompt is forwarded once (or not at all on a prefix_cache hit) and after that one token per step
+    device = next(model.parameters()).device
+    tokens = list(tokens)
+    assert max_length <= model.config.block_size, f'max_length {max_length} is past the block size {model.config.block_size}'
+    if prefix_cache is None:
+        prefix_cache = PrefixCache(max_entries=1)
+    cache, logits = prefix_cache.prefill(model, tokens, device, device_type)
+    cache = cache.repeat(num_return_sequences)
+    logits = logits.expand(num_return_sequences, -1)
+    idx = torch.tensor(tokens, dtype=torch.long, device=device)[None].repeat(num_return_sequences, 1)
+    finished = torch.zeros(num_return_sequences, dtype=torch.bool, device=device)
+    stop = torch.tensor(sampler.stop_tokens, dtype=torch.long, device=device)
+    while idx.size(1) < max_length:
+        xcol = sampler(logits, history=idx, generators=generators) # (B,1)
+        if len(sampler.stop_tokens):
+            xcol = torch.where(finished[:, None], idx[:, -1:], xcol)
+            finished |= torch.isin(xcol[:, 0], stop)
+        idx = torch.cat((idx, xcol), dim=1)
+        if idx.size(1) == max_length or (len(sampler.stop_tokens) and finished.all()):
+            break
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+            out, loss = model(xcol, kv_cache=cache)
+        logits = out[:, -1, :]
+    return idx
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=50, help="num_return_sequences of run()")
+    parser.add_argument("--vocab_size", type=int, default=50304)
+    parser.add_argument("--iters", type=int, default=200)
+    parser.add_argument("-d", "--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    torch.manual_seed(1337)
+    logits = torch.randn(args.batch_size, args.vocab_size, device=args.device)
+    history = torch.randint(50257, (args.batch_size, 64), device=args.device)
+
+    def old_loop():
+        sample_rng = torch.Generator(device=args.device)
+        sample_rng.manual_seed(42)
+        def step():
+            probs = F.softmax(logits, dim=-1)
+            topk_probs, topk_indices = torch.topk(probs, 50, dim=-1)
+            ix = torch.multinomial(topk_probs, 1, generator=sample_rng)
+            return torch.gather(topk_indices, -1, ix)
+        return step
+
+    def new_sampler(sampler, seeded):
+        generators = make_generators(range(args.batch_size), args.device) if seeded else None
+        return lambda: sampler(logits, history, generators)
+
+    cases = [
+        ('old softmax->topk(50)->multinomial', old_loop()),
+        ('Sampler top_k=50', new_sampler(Sampler(top_k=50), False)),
+        ('Sampler top_k=50 seeded', new_sampler(Sampler(top_k=50), True)),
+        ('Sampler top_k=50 top_p=0.9 rep=1.2', new_sampler(Sampler(top_k=50, top_p=0.9, repetition_penalty=1.2), True)),
+        ('Sampler top_p=0.9 seeded', new_sampler(Sampler(top_k=0, top_p=0.9), True)),
+    ]
+    for name, step in cases:
+        for _ in range(5):
+            step()
+        t0 = time.time()
+        for _ in range(args.iters):
+            xcol = step()
+        xcol.tolist()
+        dt = (time.time() - t0) / args.iters
+        print(f'{name:38s} | {dt*1000:.3f}ms per token step | {dt*1e6/args.batch_size:.2f}us per sequence')
@@ -0,0 +1,274 @@
+#!/usr/bin/python3
+# local inference server for our GPT with continuous batching:
+# new requests are prefilled and merged into the running decode batch as soon as a slot frees up,
+# instead of waiting for the whole batch to finish like output_from_saved_model.run()
+#
+# python3 serve_gpt2.py --port 8000
+# curl -N -X POST localhost:8000/generate -d '{"prompt": "This is how Tesla FSD works, ", "max_tokens": 64}'
+# curl localhost:8000/metrics
+import os
+import glob
+import json
+import queue
+import threading
+import time
+import torch
+from torch.nn import functional as F
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from train_gpt2 import GPT, KVCache, enc
+from sampling import Sampler
+
+
+def load_latest_checkpoint(log_dir='log', device='cpu'):
+    # log/model_19072.pt style checkpoints written by train_gpt2.py, the highest step wins
+    paths = sorted(glob.glob(os.path.join(log_dir, 'model_*.pt')))
+    assert len(paths) > 0, f'no model_*.pt checkpoints found in {log_dir}'
+    checkpoint = torch.load(paths[-1], map_location='cpu')
+    model = GPT(checkpoint['config'])
+    model.load_state_dict(checkpoint['model'])
+    model.to(device)
+    model.eval()
+    print(f"loaded {paths[-1]} (step {checkpoint.get('step')}, val loss {checkpoint.get('val_loss', float('nan')):.4f})")
+    return model
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Request:
+
+    def __init__(self, prompt_tokens, max_tokens):
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.tokens = []
+        self.stream = queue.Queue() # generated token ids, None once the request is done
+        self.done = False
+        self.cancelled = False # the client went away, the engine drops the row on its next step
+        self.t_arrival = time.time()
+        self.t_first = None
+        self.t_done = None
+
+
+class Engine:
+
+    def __init__(self, model, max_batch_size=16, max_tokens=256, top_k=50, device='cpu', seed=42):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_tokens = max_tokens
+        # top-k over the real vocab, the padding tokens past enc.n_vocab are never sampled
+        self.sampler = Sampler(top_k=top_k, vocab_size=enc.n_vocab)
+        self.device = device
+        self.device_type = 'cuda' if device.startswith('cuda') else 'cpu'
+        self.eot = enc._special_tokens['<|endoftext|>']
+        self.sample_rng = torch.Generator(device=device)
+        self.sample_rng.manual_seed(seed)
+
+        self.waiting = queue.Queue()
+        self.running = [] # row i of self.cache belongs to self.running[i]
+        self.cache = None
+        self.last = None # (B,1) last token of each running row, the input of the next decode step
+
+        # metrics
+        self.lock = threading.Lock()
+        self.t_start = time.time()
+        self.busy_time = 0.0
+        self.num_generated = 0
+        self.num_finished = 0
+        self.num_cancelled = 0
+        self.num_steps = 0
+        self.batch_size_sum = 0
+        self.ttft = []
+        self.latency = []
+        self.tpot = [] # time per output token after the first one
+
+    def submit(self, prompt_tokens, max_tokens=None):
+        max_tokens = self.max_tokens if max_tokens is None else min(max_tokens, self.max_tokens)
+        # the positional embedding only goes up to block_size
+        max_tokens = min(max_tokens, self.model.config.block_size - len(prompt_tokens))
+        assert 0 < len(prompt_tokens) and max_tokens > 0, f'prompt of {len(prompt_tokens)} tokens does not fit block size {self.model.config.block_size}'
+        req = Request(prompt_tokens, max_tokens)
+        self.waiting.put(req)
+        return req
+
+    def cancel(self, req):
+        with self.lock:
+            if not req.done and not req.cancelled:
+                req.cancelled = True
+                self.num_cancelled += 1
+
+    def sample(self, logits):
+        # the sampler's filtered distribution, drawn with the engine's seeded rng, one row per request
+        logits = self.sampler.filter_logits(logits)
+        if self.sampler.temperature == 0:
+            return logits.argmax(dim=-1, keepdim=True)
+        return torch.multinomial(F.softmax(logits, dim=-1), 1, generator=self.sample_rng) # (B,1)
+
+    def emit(self, req, token):
+        now = time.time()
+        if req.t_first is None:
+            req.t_first = now
+        req.tokens.append(token)
+        req.stream.put(token)
+        with self.lock:
+            self.num_generated += 1
+        if len(req.tokens) >= req.max_tokens or token == self.eot:
+            req.done = True
+            req.t_done = now
+            req.stream.put(None)
+            with self.lock:
+                self.num_finished += 1
+                self.ttft.append(req.t_first - req.t_arrival)
+                self.latency.append(req.t_done - req.t_arrival)
+                if len(req.tokens) > 1:
+                    self.tpot.append((req.t_done - req.t_first) / (len(req.tokens) - 1))
+
+    @torch.inference_mode()
+    def step(self):
+        # 1. admit waiting requests into free slots: prefill each prompt into its own cache, sample its first token
+        admitted, caches, lasts = [], [], []
+        while len(self.running) + len(admitted) < self.max_batch_size and not self.waiting.empty():
+            req = self.waiting.get()
+            if req.cancelled:
+                continue
+            cache = KVCache(self.model.config.n_layer)
+            idx = torch.tensor(req.prompt_tokens, dtype=torch.long, device=self.device)[None]
+            with torch.autocast(device_type=self.device_type, dtype=torch.bfloat16):
+                logits, loss = self.model(idx, kv_cache=cache)
+            xcol = self.sample(logits[:, -1, :])
+            self.emit(req, xcol.item())
+            if not req.done:
+                admitted.append(req)
+                caches.append(cache)
+                lasts.append(xcol)
+        if admitted:
+            with self.lock:
+                self.running = self.running + admitted
+            self.cache = KVCache.cat(([self.cache] if self.cache is not None else []) + caches)
+            self.last = torch.cat(([self.last] if self.last is not None else []) + lasts, dim=0)
+
+        if not self.running:
+            return 0
+
+        # 2. one decode step for every running row
+        with torch.autocast(device_type=self.device_type, dtype=torch.bfloat16):
+            logits, loss = self.model(self.last, kv_cache=self.cache)
+        self.last = self.sample(logits[:, -1, :]) # (B,1)
+        for req, token in zip(self.running, self.last[:, 0].tolist()):
+            self.emit(req, token)
+        B = len(self.running)
+
+        # 3. retire finished and cancelled rows so their slots can be reused on the next step
+        keep = [i for i, req in enumerate(self.running) if not req.done and not req.cancelled]
+        if len(keep) < len(self.running):
+            with self.lock:
+                self.running = [self.running[i] for i in keep]
+            if keep:
+                self.cache.select(keep)
+                self.last = self.last[keep]
+            else:
+                self.cache, self.last = None, None
+        return B
+
+    def loop(self):
+        while True:
+            if not self.running and self.waiting.empty():
+                time.sleep(0.001)
+                continue
+            t0 = time.time()
+            B = self.step()
+            dt = time.time() - t0
+            with self.lock:
+                self.busy_time += dt
+                self.num_steps += 1
+                self.batch_size_sum += B
+
+    def metrics(self):
+        with self.lock:
+            elapsed = time.time() - self.t_start
+            return {
+                'requests_finished': self.num_finished,
+                'requests_cancelled': self.num_cancelled,
+                'requests_running': len(self.running),
+                'requests_waiting': self.waiting.qsize(),
+                'tokens_generated': self.num_generated,
+                'tok_per_sec': self.num_generated / max(elapsed, 1e-9),
+                'tok_per_busy_sec': self.num_generated / max(self.busy_time, 1e-9),
+                'mean_batch_size': self.batch_size_sum / max(self.num_steps, 1),
+                'ttft_p50_ms': percentile(self.ttft, 0.5) * 1000,
+                'ttft_p95_ms': percentile(self.ttft, 0.95) * 1000,
+                'latency_p50_ms': percentile(self.latency, 0.5) * 1000,
+                'latency_p95_ms': percentile(self.latency, 0.95) * 1000,
+                'tpot_p50_ms': percentile(self.tpot, 0.5) * 1000,
+            }
+
+
+def make_handler(engine):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = json.dumps(engine.metrics()).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path != '/generate':
+                self.send_error(404)
+                return
+            data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            try:
+                req = engine.submit(enc.encode(data.get('prompt', '')), data.get('max_tokens'))
+            except AssertionError as e:
+                self.send_error(400, str(e))
+                return
+            # stream one json line per token, the connection closing marks the end
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            try:
+                while True:
+                    token = req.stream.get()
+                    if token is None:
+                        break
+                    self.wfile.write((json.dumps({'token': token, 'text': enc.decode([token])}) + '\n').encode())
+                    self.wfile.flush()
+                self.wfile.write((json.dumps({'done': True, 'num_tokens': len(req.tokens),
+                                              'ttft_ms': (req.t_first - req.t_arrival) * 1000,
+                                              'latency_ms': (req.t_done - req.t_arrival) * 1000}) + '\n').encode())
+            except (BrokenPipeError, ConnectionResetError):
+                # client disconnected, stop decoding its sequence
+                engine.cancel(req)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log_dir", type=str, default="log", help="directory with the model_*.pt checkpoints")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch_size", type=int, default=16, help="max sequences in the running decode batch")
+    parser.add_argument("--max_tokens", type=int, default=256, help="upper limit on max_tokens per request")
+    parser.add_argument("--top_k", type=int, default=50)
+    parser.add_argument("-d", "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    model = load_latest_checkpoint(args.log_dir, args.device)
+    engine = Engine(model, args.max_batch_size, args.max_tokens, args.top_k, args.device)
+    threading.Thread(target=engine.loop, daemon=True).start()
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(engine))
+    print(f'serving on http://127.0.0.1:{args.port} (POST /generate, GET /metrics)')
+    server.serve_forever()
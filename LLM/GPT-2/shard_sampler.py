@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+# manifest of the edufineweb_{split}_*.npy shards (token count and offset of every shard, written once) and a loader
+# that draws B*T windows at random positions across all shards of a split, read through memory maps
+#
+# every epoch is one permutation of all blocks of block_T tokens (the T the loader was built with), the same on every
+# rank (seeded by seed, epoch and block_T). a block is cut into block_T // T windows, and rank r takes every
+# num_processes-th window of the permuted blocks, so ranks never overlap and a run is reproducible. a shorter T
+# (sequence length curriculum) only re-slices the same permutation, it does not draw a new one
+#
+# python3 shard_sampler.py edu_fineweb10B   # (re)build the manifest and print the totals
+import os
+import json
+import numpy as np
+import torch
+
+MANIFEST = 'manifest.json'
+
+
+def scan_shards(data_root):
+    files = sorted(f for f in os.listdir(data_root) if f.startswith('edufineweb_') and f.endswith('.npy'))
+    return {f: os.stat(os.path.join(data_root, f)) for f in files}
+
+
+def build_manifest(data_root='edu_fineweb10B'):
+    # the token count comes from the .npy header, the shard data itself is not read
+    shards = []
+    offsets = {}
+    for f, st in scan_shards(data_root).items():
+        split = f.split('_')[1]
+        tokens = int(np.load(os.path.join(data_root, f), mmap_mode='r').shape[0])
+        shards.append({'file': f, 'split': split, 'tokens': tokens, 'offset': offsets.get(split, 0),
+                       'size': st.st_size, 'mtime': st.st_mtime})
+        offsets[split] = offsets.get(split, 0) + tokens
+    manifest = {'shards': shards, 'total_tokens': offsets}
+    tmp = os.path.join(data_root, f'{MANIFEST}.{os.getpid()}.tmp') # per process, DDP ranks may rebuild it at once
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, os.path.join(data_root, MANIFEST))
+    return manifest
+
+
+def load_manifest(data_root='edu_fineweb10B'):
+    # rebuilt when a shard was added, removed or rewritten since the manifest was written
+    path = os.path.join(data_root, MANIFEST)
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+        on_disk = scan_shards(data_root)
+        listed = {s['file']: s for s in manifest['shards']}
+        if listed.keys() == on_disk.keys() and all(listed[f]['size'] == st.st_size and listed[f]['mtime'] == st.st_mtime
+                                                   for f, st in on_disk.items()):
+            return manifest
+    return build_manifest(data_root)
+
+
+class RandomWindowLoader:
+    # drop in for DataloaderLite: same B, T, next_batch() and reset(), windows in random order across shards
+
+    def __init__(self, B, T, process_rank, num_processes, split, data_root='edu_fineweb10B', seed=1337, verbose=True):
+        self.B = B
+        self.T = T
+        self.block_T = T # the unit of the permutation, set_shape can only go down from here
+        self.process_rank = process_rank
+        self.num_processes = num_processes
+        self.seed = seed
+        assert split in {'train', 'val'}
+        manifest = load_manifest(data_root)
+        shards = [s for s in manifest['shards'] if s['split'] == split]
+        assert len(shards) > 0, f'no shards found for split {split}'
+        self.paths = [os.path.join(data_root, s['file']) for s in shards]
+        self.shard_tokens = np.array([s['tokens'] for s in shards], dtype=np.int64)
+        self.tokens = [None] * len(shards) # memmaps, opened on first use
+        self.layout()
+        if verbose:
+            print(f"found {len(shards)} shards for split {split}: {manifest['total_tokens'][split]} tokens, "
+                  f"{self.num_windows} windows, {self.batches_per_epoch} batches per epoch and rank")
+        self.reset()
+
+    def layout(self):
+        # non overlapping blocks of block_T+1 tokens inside each shard, block b of the split lives in shard
+        # searchsorted(self.first_block, b, 'right') - 1. window w is the (w % per_block)-th T+1 token slice of
+        # block w // per_block of the permutation
+        assert self.T <= self.block_T, f'T {self.T} is longer than the {self.block_T} token blocks of the permutation'
+        blocks = (self.shard_tokens - 1) // self.block_T
+        self.first_block = np.concatenate([[0], np.cumsum(blocks)[:-1]])
+        self.num_blocks = int(blocks.sum())
+        self.per_block = self.block_T // self.T
+        self.num_windows = self.num_blocks * self.per_block
+        # the same number of batches on every rank, so DDP ranks stay in step
+        self.batches_per_epoch = self.num_windows // (self.B * self.num_processes)
+        assert self.batches_per_epoch > 0, f'{self.num_windows} windows of {self.T} tokens, less than one batch per rank'
+
+    def set_shape(self, B, T):
+        # new window size (sequence length curriculum): the same permutation of blocks cut into windows of the new T,
+        # picking up at the same fraction of the epoch, i.e. at the same block
+        done = self.batch / self.batches_per_epoch
+        self.B, self.T = B, T
+        self.layout()
+        self.batch = min(int(done * self.batches_per_epoch), self.batches_per_epoch)
+
+    def reset(self):
+        self.epoch = 0
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.perm = np.random.default_rng((self.seed, epoch, self.block_T)).permutation(self.num_blocks)
+        self.batch = 0
+
+    def windows(self, batch):
+        # (block, window in block) of the B windows of this rank's batch
+        i = np.arange(batch * self.B, (batch + 1) * self.B)
+        w = i * self.num_processes + self.process_rank # position in the epoch, the same on every rank
+        return self.perm[w // self.per_block], w % self.per_block
+
+    def shard(self, i):
+        if self.tokens[i] is None:
+            self.tokens[i] = np.load(self.paths[i], mmap_mode='r')
+        return self.tokens[i]
+
+    def next_batch(self):
+        B, T = self.B, self.T
+        if self.batch == self.batches_per_epoch:
+            self.set_epoch(self.epoch + 1)
+        blocks, sub = self.windows(self.batch)
+        self.batch += 1
+        shard_ix = np.searchsorted(self.first_block, blocks, side='right') - 1
+        starts = (blocks - self.first_block[shard_ix]) * self.block_T + sub * T
+        buf = np.empty((B, T + 1), dtype=np.uint16)
+        # read in file order, the page cache / disk readahead likes that better than the random batch order
+        for j in np.lexsort((starts, shard_ix)):
+            buf[j] = self.shard(shard_ix[j])[starts[j]:starts[j] + T + 1]
+        buf = torch.from_numpy(buf.astype(np.int64))
+        return buf[:, :-1], buf[:, 1:]
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'batch': self.batch, 'seed': self.seed, 'B': self.B, 'T': self.T, 'block_T': self.block_T}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.B, self.T = state.get('B', self.B), state.get('T', self.T)
+        self.block_T = state.get('block_T', self.block_T) # older states: the T this loader was built with
+        self.layout()
+        self.set_epoch(state['epoch'])
+        self.batch = state['batch']
+
+
+if __name__ == '__main__':
+    import sys
+    data_root = sys.argv[1] if len(sys.argv) > 1 else 'edu_fineweb10B'
+    manifest = build_manifest(data_root)
+    for split, n in manifest['total_tokens'].items():
+        print(f"{split}: {sum(s['split'] == split for s in manifest['shards'])} shards, {n} tokens")
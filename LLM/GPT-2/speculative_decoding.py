@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+# speculative sampling: a small draft GPT proposes gamma tokens, the big GPT checks all of them in one forward pass
+# https://arxiv.org/abs/2211.17192 (Leviathan et al.)
+# https://arxiv.org/abs/2302.01318 (Chen et al.)
+#
+# python3 speculative_decoding.py --target log/model_19072.pt --draft_layers 2
+# python3 speculative_decoding.py --target log/model_19072.pt --draft log/draft_model.pt
+import time
+import torch
+from torch.nn import functional as F
+from sampling import Sampler
+
+
+def check_sampler(sampler):
+    # the acceptance test needs the full next token distribution at every position: repetition penalty would need
+    # a different history per proposed position and stop tokens a per row cut, neither is implemented here
+    if sampler.repetition_penalty != 1.0 or sampler.stop_tokens:
+        raise ValueError('speculative decoding supports temperature, top_k and top_p, not repetition_penalty or stop_tokens')
+
+
+def sampler_probs(logits, sampler):
+    # the distribution sampler draws from (temperature / top-k / top-p, padded vocab masked), over the full vocab
+    # so the draft and target probabilities of a token can be compared directly. temperature 0 is one hot
+    shape = logits.shape
+    logits = sampler.filter_logits(logits.reshape(-1, shape[-1]))
+    if sampler.temperature == 0:
+        probs = F.one_hot(logits.argmax(dim=-1), shape[-1]).float()
+    else:
+        probs = F.softmax(logits, dim=-1)
+    return probs.view(shape)
+
+
+def topk_probs(logits, top_k=50, vocab_size=50257):
+    # softmax -> topk(50) -> multinomial as in run(), padding tokens past vocab_size never sampled
+    return sampler_probs(logits, Sampler(top_k=top_k, vocab_size=vocab_size))
+
+
+@torch.no_grad()
+def last_probs(model, idx, n_last, sampler, device_type):
+    # sampling probabilities for the last n_last positions of idx -> (B, n_last, vocab_size)
+    with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+        logits, loss = model(idx[:, -model.config.block_size:])
+    return sampler_probs(logits[:, -n_last:, :], sampler)
+
+
+@torch.no_grad()
+def sample_topk(model, xgen, max_length, sampler=None, sample_rng=None, device_type='cpu'):
+    # the plain one-forward-per-token loop from run(), kept here as the baseline. sampler defaults to top-k 50
+    sampler = Sampler(top_k=50) if sampler is None else sampler
+    while xgen.size(1) < max_length:
+        probs = last_probs(model, xgen, 1, sampler, device_type)[:, -1] # (B, vocab_size)
+        xcol = torch.multinomial(probs, 1, generator=sample_rng) # (B,1)
+        xgen = torch.cat((xgen, xcol), dim=1)
+    return xgen
+
+
+@torch.no_grad()
+def speculative_step(target, draft, xgen, gamma, sampler, sample_rng=None, device_type='cpu'):
+    B = xgen.size(0)
+
+    # 1. the draft proposes gamma tokens, one cheap forward each
+    xdraft = xgen
+    q = []
+    for _ in range(gamma):
+        probs = last_probs(draft, xdraft, 1, sampler, device_type)[:, -1] # (B, vocab_size)
+        xcol = torch.multinomial(probs, 1, generator=sample_rng) # (B,1)
+        q.append(probs)
+        xdraft = torch.cat((xdraft, xcol), dim=1)
+    q = torch.stack(q, dim=1) # (B, gamma, vocab_size)
+    draft_tokens = xdraft[:, -gamma:] # (B, gamma)
+
+    # 2. one target forward over prefix + proposals gives gamma + 1 next token distributions
+    p = last_probs(target, xdraft, gamma + 1, sampler, device_type) # (B, gamma+1, vocab_size)
+
+    # 3. keep proposal i with probability min(1, p_i(x) / q_i(x)), q_i(x) > 0 because x was sampled from q_i
+    p_tok = p[:, :gamma].gather(-1, draft_tokens.unsqueeze(-1)).squeeze(-1) # (B, gamma)
+    q_tok = q.gather(-1, draft_tokens.unsqueeze(-1)).squeeze(-1) # (B, gamma)
+    r = torch.rand((B, gamma), generator=sample_rng, device=xgen.device)
+    accepted = r < p_tok / q_tok
+    n_accept = accepted.long().cumprod(dim=1).sum(dim=1) # (B,) length of the accepted run of each row
+
+    # 4. every row emits n + 1 tokens so the batch stays rectangular. the rows are sampled independently,
+    # so cutting a row at another row's first rejection does not change its own distribution
+    n = int(n_accept.min())
+    if n < gamma:
+        # rows rejected at n resample from the residual norm(max(0, p - q)), rows that accepted n keep the draft token
+        residual = (p[:, n] - q[:, n]).clamp(min=0)
+        residual = torch.where(residual.sum(dim=-1, keepdim=True) > 0, residual, p[:, n])
+        xfix = torch.multinomial(residual, 1, generator=sample_rng) # (B,1)
+        xlast = torch.where((n_accept > n).unsqueeze(-1), draft_tokens[:, n:n+1], xfix)
+    else:
+        # everything accepted, the target gives one bonus token for free
+        xlast = torch.multinomial(p[:, gamma], 1, generator=sample_rng) # (B,1)
+
+    xgen = torch.cat((xgen, draft_tokens[:, :n], xlast), dim=1)
+    return xgen, n_accept
+
+
+@torch.no_grad()
+def speculative_generate(target, draft, xgen, max_length, gamma=4, sampler=None, sample_rng=None, device_type='cpu'):
+    # sampler: sampling.Sampler, defaults to top-k 50 over the real vocab
+    sampler = Sampler(top_k=50) if sampler is None else sampler
+    check_sampler(sampler)
+    stats = {'proposed': 0, 'accepted': 0, 'target_calls': 0, 'new_tokens': 0}
+    start = xgen.size(1)
+    while xgen.size(1) < max_length:
+        xgen, n_accept = speculative_step(target, draft, xgen, gamma, sampler, sample_rng, device_type)
+        stats['proposed'] += gamma * xgen.size(0)
+        stats['accepted'] += n_accept.sum().item()
+        stats['target_calls'] += 1
+    stats['new_tokens'] = max_length - start
+    stats['acceptance_rate'] = stats['accepted'] / max(stats['proposed'], 1)
+    stats['tokens_per_target_call'] = stats['new_tokens'] / max(stats['target_calls'], 1)
+    return xgen[:, :max_length], stats
+
+
+def draft_from_target(target, n_layer):
+    # a draft that needs no extra training: the first n_layer blocks of the target plus its embeddings,
+    # final layernorm and (tied) lm_head, packed into a smaller GPTConfig
+    from dataclasses import replace
+    config = replace(target.config, n_layer=n_layer)
+    draft = type(target)(config)
+    sd = {k: v for k, v in target.state_dict().items()
+          if not k.startswith('transformer.h.') or int(k.split('.')[2]) < n_layer}
+    draft.load_state_dict(sd)
+    return draft
+
+
+def load_model(path, device):
+    from train_gpt2 import GPT
+    checkpoint = torch.load(path, map_location='cpu')
+    model = GPT(checkpoint['config'])
+    model.load_state_dict(checkpoint['model'])
+    model.to(device)
+    model.eval()
+    return model
+
+
+if __name__ == '__main__':
+    import argparse
+    from train_gpt2 import enc
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", type=str, required=True, help="target checkpoint, e.g. log/model_19072.pt")
+    parser.add_argument("--draft", type=str, default=None, help="draft checkpoint trained with a smaller GPTConfig")
+    parser.add_argument("--draft_layers", type=int, default=2, help="without --draft, use the first n target blocks as draft")
+    parser.add_argument("--gamma", type=int, default=4, help="tokens proposed by the draft per target forward")
+    parser.add_argument("--num_return_sequences", type=int, default=4)
+    parser.add_argument("--max_length", type=int, default=64)
+    parser.add_argument("--prompt", type=str, default="This is how Tesla FSD works, ")
+    parser.add_argument("-d", "--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    device = args.device
+    device_type = 'cuda' if device.startswith('cuda') else 'cpu'
+    target = load_model(args.target, device)
+    draft = load_model(args.draft, device) if args.draft else draft_from_target(target, args.draft_layers).to(device).eval()
+    print(f'target: {target.config}')
+    print(f'draft : {draft.config}')
+
+    tokens = torch.tensor(enc.encode(args.prompt), dtype=torch.long)
+    tokens = tokens.unsqueeze(0).repeat(args.num_return_sequences, 1).to(device)
+
+    sample_rng = torch.Generator(device=device)
+    sample_rng.manual_seed(42)
+    t0 = time.time()
+    sampler = Sampler(top_k=50, vocab_size=enc.n_vocab)
+    xbase = sample_topk(target, tokens, args.max_length, sampler, sample_rng=sample_rng, device_type=device_type)
+    t_base = time.time() - t0
+
+    sample_rng.manual_seed(42)
+    t0 = time.time()
+    xspec, stats = speculative_generate(target, draft, tokens, args.max_length, args.gamma, sampler,
+                                        sample_rng=sample_rng, device_type=device_type)
+    t_spec = time.time() - t0
+
+    new_tokens = (args.max_length - tokens.size(1)) * args.num_return_sequences
+    print(f'baseline   : {t_base*1000:.2f}ms | tok/sec: {new_tokens / t_base:.2f}')
+    print(f'speculative: {t_spec*1000:.2f}ms | tok/sec: {new_tokens / t_spec:.2f}')
+    print(f"acceptance rate: {stats['acceptance_rate']:.4f} | tokens per target forward: {stats['tokens_per_target_call']:.2f} | speedup: {t_base / t_spec:.2f}x")
+    for i in range(args.num_return_sequences):
+        print(f'sample {i}: {enc.decode(xspec[i].tolist())}')
@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+# tensor parallel GPT inference (Megatron style) across processes: every block's c_attn and mlp c_fc are split by
+# columns (output features, whole heads for c_attn) and the two c_proj by rows (their input features), so each rank
+# only holds 1/world_size of the block weights and computes its heads / mlp slice locally. the partial c_proj outputs
+# are summed with one all_reduce per attention and one per mlp, embeddings, layernorms and lm_head stay replicated
+#
+# load_tensor_parallel() memory maps a checkpoint (torch.load(mmap=True)) and builds the model on the meta device,
+# so a rank only ever reads and copies its own slices: its peak is the replicated part plus 1/world_size of the blocks
+#
+# python3 tensor_parallel.py --world_sizes 1 2 4            # random 124M weights: outputs vs one process, latency
+# python3 tensor_parallel.py --model_type gpt2-xl --T 64 --world_sizes 1 5   # 25 heads. needs transformers, parent only
+import os
+import time
+import tempfile
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from torch.nn import functional as F
+
+
+def shard_range(n, rank, world_size):
+    assert n % world_size == 0, f'{n} does not split over {world_size} ranks'
+    size = n // world_size
+    return rank * size, (rank + 1) * size
+
+
+class RowParallelLinear(nn.Module):
+    # y = sum over ranks of x_local @ W[:, local].T, then the bias once
+
+    def __init__(self, in_features, out_features, group=None):
+        super().__init__()
+        self.weight = nn.Parameter(torch.empty(out_features, in_features), requires_grad=False)
+        self.bias = nn.Parameter(torch.empty(out_features), requires_grad=False)
+        self.group = group
+        self.world_size = dist.get_world_size(group)
+
+    def forward(self, x):
+        y = F.linear(x, self.weight)
+        if self.world_size > 1:
+            dist.all_reduce(y, group=self.group)
+        return y + self.bias
+
+
+class ParallelSelfAttention(nn.Module):
+    # CausalSelfAttention with only this rank's heads, weights come from shard_state_dict
+
+    def __init__(self, config, group=None):
+        super().__init__()
+        world_size = dist.get_world_size(group)
+        assert config.n_head % world_size == 0, f'n_head {config.n_head} does not split over {world_size} ranks'
+        self.n_head = config.n_head // world_size
+        self.n_embd = config.n_embd // world_size # local width
+        self.c_attn = nn.Linear(config.n_embd, 3 * self.n_embd).requires_grad_(False)
+        self.c_proj = RowParallelLinear(self.n_embd, config.n_embd, group)
+
+    def forward(self, x, kv_cache=None, layer=0):
+        # same as CausalSelfAttention.forward, the kv cache of each rank holds only its own heads
+        B, T, C = x.size()
+        q, k, v = self.c_attn(x).split(self.n_embd, dim=2)
+        hs = self.n_embd // self.n_head
+        q = q.view(B, T, self.n_head, hs).transpose(1, 2)
+        k = k.view(B, T, self.n_head, hs).transpose(1, 2)
+        v = v.view(B, T, self.n_head, hs).transpose(1, 2)
+        if kv_cache is None:
+            y = F.scaled_dot_product_attention(q, k, v, is_causal=True)
+        else:
+            k, v = kv_cache.update(layer, k, v)
+            attn_mask = kv_cache.attn_mask
+            y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, is_causal=attn_mask is None and k.size(2) == T)
+        y = y.transpose(1, 2).contiguous().view(B, T, self.n_embd)
+        return self.c_proj(y)
+
+
+class ParallelMLP(nn.Module):
+
+    def __init__(self, config, group=None):
+        super().__init__()
+        hidden = 4 * config.n_embd // dist.get_world_size(group)
+        self.c_fc = nn.Linear(config.n_embd, hidden).requires_grad_(False)
+        self.gelu = nn.GELU(approximate='tanh') # elementwise, so it runs on the column slice as is
+        self.c_proj = RowParallelLinear(hidden, config.n_embd, group)
+
+    def forward(self, x):
+        return self.c_proj(self.gelu(self.c_fc(x)))
+
+
+def shard_state_dict(state_dict, config, rank, world_size):
+    # GPT state dict -> this rank's state dict for the parallel blocks. only the slices are copied (.clone()), so on
+    # a memory mapped state dict nothing else is read. the causal mask buffers are dropped, sdpa does not use them
+    C = config.n_embd
+    hs = C // config.n_head
+    h0, h1 = shard_range(config.n_head, rank, world_size)
+    # c_attn output rows are [q | k | v], each C wide and head major, take our heads from each of the three
+    qkv = torch.cat([torch.arange(part * C + h0 * hs, part * C + h1 * hs) for part in range(3)])
+    f0, f1 = shard_range(4 * C, rank, world_size)
+    out = {}
+    for name, t in state_dict.items():
+        if name.endswith('.attn.bias') or name == 'transformer.wte.weight':
+            continue
+        if '.attn.c_attn.' in name:
+            t = t[qkv]
+        elif name.endswith('.attn.c_proj.weight'):
+            t = t[:, h0 * hs:h1 * hs]
+        elif '.mlp.c_fc.' in name:
+            t = t[f0:f1]
+        elif name.endswith('.mlp.c_proj.weight'):
+            t = t[:, f0:f1]
+        out[name] = t.clone()
+    out['transformer.wte.weight'] = out['lm_head.weight'] # tied, one copy
+    return out
+
+
+def parallel_blocks(model, group=None):
+    for block in model.transformer.h:
+        block.attn = ParallelSelfAttention(model.config, group)
+        block.mlp = ParallelMLP(model.config, group)
+
+
+def tensor_parallel(model, group=None):
+    """
+    Split the blocks of an in memory GPT in place across the ranks of group (default: the world), inference only.
+    Every rank must call this with identical weights (same seed or same checkpoint), the full block weights are
+    dropped afterwards, but they were all resident before: use load_tensor_parallel to never hold them.
+    Forward, kv_cache and generation code work unchanged on the result.
+    """
+    state = shard_state_dict(model.state_dict(), model.config, dist.get_rank(group), dist.get_world_size(group))
+    parallel_blocks(model, group)
+    model.load_state_dict(state)
+    return model.eval()
+
+
+def load_tensor_parallel(path, group=None):
+    """
+    Tensor parallel GPT from a checkpoint saved like train_gpt2.py does ({'model': state_dict, 'config': GPTConfig}).
+    The file is memory mapped and the model built without memory (meta device), so this rank reads and keeps only
+    the replicated weights and its own slices of the blocks.
+    """
+    from train_gpt2 import GPT
+    checkpoint = torch.load(path, map_location='cpu', mmap=True, weights_only=False) # the config is a pickled GPTConfig
+    config = checkpoint['config']
+    with torch.device('meta'):
+        model = GPT(config)
+        parallel_blocks(model, group)
+    state = shard_state_dict(checkpoint['model'], config, dist.get_rank(group), dist.get_world_size(group))
+    model.load_state_dict(state, assign=True)
+    model.transformer.wte.weight = model.lm_head.weight # assign=True replaces both parameters, tie them again
+    return model.eval()
+
+
+def build_model(model_type, seed=1337):
+    from train_gpt2 import GPT, GPTConfig
+    if model_type is not None:
+        return GPT.from_pretrained(model_type).eval()
+    torch.manual_seed(seed)
+    return GPT(GPTConfig()).eval()
+
+
+def greedy(model, x, new_tokens):
+    # prefill + greedy decode with a kv cache, returns (tokens, prefill seconds, decode seconds per token)
+    kv_cache = model.make_kv_cache()
+    t0 = time.time()
+    logits, _ = model(x, kv_cache=kv_cache)
+    t1 = time.time()
+    out = [x]
+    for _ in range(new_tokens):
+        nxt = logits[:, -1].argmax(dim=-1, keepdim=True)
+        out.append(nxt)
+        logits, _ = model(nxt, kv_cache=kv_cache)
+    t2 = time.time()
+    return torch.cat(out, dim=1), t1 - t0, (t2 - t1) / max(new_tokens, 1)
+
+
+def median(xs):
+    return sorted(xs)[len(xs) // 2]
+
+
+def _worker(rank, world_size, args, path, x, ref_logits, ref_tokens, results):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(args.port + world_size)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    # the same cores split between the ranks, so more ranks do not get more compute
+    torch.set_num_threads(max(1, args.threads // world_size))
+    model = load_tensor_parallel(path)
+    with torch.inference_mode():
+        logits, _ = model(x)
+        forward_times, prefill_times, decode_times = [], [], []
+        for _ in range(args.iters):
+            dist.barrier()
+            t0 = time.time()
+            model(x)
+            forward_times.append(time.time() - t0)
+        for _ in range(max(1, args.iters // 4)):
+            dist.barrier()
+            tokens, prefill, decode = greedy(model, x, args.new_tokens)
+            prefill_times.append(prefill)
+            decode_times.append(decode)
+    if rank == 0:
+        results.put({
+            'world_size': world_size,
+            'threads': torch.get_num_threads(),
+            'params': sum(p.numel() for p in model.parameters()),
+            'max_diff': (logits - ref_logits).abs().max().item(),
+            'allclose': torch.allclose(logits, ref_logits, rtol=1e-4, atol=1e-4),
+            'tokens_match': torch.equal(tokens, ref_tokens),
+            'forward': median(forward_times),
+            'prefill': median(prefill_times),
+            'decode': median(decode_times),
+        })
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    import argparse
+    import torch.multiprocessing as mp
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", type=str, default=None, help="gpt2 ... gpt2-xl, default random 124M weights")
+    parser.add_argument("--checkpoint", type=str, default=None, help="a log/model_*.pt checkpoint instead of --model_type")
+    parser.add_argument("--world_sizes", type=int, nargs='*', default=[1, 2, 4])
+    parser.add_argument("--B", type=int, default=1)
+    parser.add_argument("--T", type=int, default=128)
+    parser.add_argument("--new_tokens", type=int, default=32)
+    parser.add_argument("--iters", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=os.cpu_count())
+    parser.add_argument("--port", type=int, default=29531)
+    args = parser.parse_args()
+
+    # reference: the unsplit model in this process with all threads. the workers load from a checkpoint file:
+    # the given one, or the reference weights saved to a temp file once
+    torch.set_num_threads(args.threads)
+    tmp = None
+    if args.checkpoint is not None:
+        from train_gpt2 import GPT
+        path = args.checkpoint
+        checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+        model = GPT(checkpoint['config']).eval()
+        model.load_state_dict(checkpoint['model'])
+        del checkpoint
+    else:
+        model = build_model(args.model_type)
+        tmp = tempfile.NamedTemporaryFile(suffix='.pt', delete=False)
+        tmp.close()
+        path = tmp.name
+        torch.save({'model': model.state_dict(), 'config': model.config}, path)
+    # whole heads per rank and an even mlp split, fail before the reference run and the spawned workers
+    bad = [w for w in args.world_sizes if model.config.n_head % w or (4 * model.config.n_embd) % w]
+    if bad:
+        if tmp is not None:
+            os.remove(path)
+        ok = [w for w in range(1, model.config.n_head + 1) if model.config.n_head % w == 0 and (4 * model.config.n_embd) % w == 0]
+        parser.error(f'--world_sizes {bad} do not split {model.config.n_head} heads / {4 * model.config.n_embd} mlp '
+                     f'features evenly, pick from {ok}')
+    x = torch.randint(model.config.vocab_size, (args.B, args.T), generator=torch.Generator().manual_seed(0))
+    with torch.inference_mode():
+        ref_logits, _ = model(x)
+        t0 = time.time()
+        model(x)
+        ref_forward = time.time() - t0
+        ref_tokens, ref_prefill, ref_decode = greedy(model, x, args.new_tokens)
+    ref_logits, ref_tokens = ref_logits.clone(), ref_tokens.clone() # plain tensors, inference tensors do not pickle into spawn
+    num_params = sum(p.numel() for p in model.parameters())
+    del model
+    print(f'single process | {args.threads} threads | {num_params / 1e6:.1f}M params | forward {ref_forward*1000:.1f}ms | '
+          f'decode {ref_decode*1000:.1f}ms/token')
+
+    ctx = mp.get_context('spawn')
+    results = ctx.SimpleQueue()
+    base = None
+    try:
+        for world_size in args.world_sizes:
+            mp.spawn(_worker, args=(world_size, args, path, x, ref_logits, ref_tokens, results), nprocs=world_size)
+            r = results.get()
+            base = base or r
+            print(f"{r['world_size']} ranks x {r['threads']:2d} threads | {r['params'] / 1e6:6.1f}M params per rank | "
+                  f"forward {r['forward']*1000:8.1f}ms ({base['forward'] / r['forward']:.2f}x) | "
+                  f"prefill {r['prefill']*1000:8.1f}ms | decode {r['decode']*1000:7.1f}ms/token "
+                  f"({base['decode'] / r['decode']:.2f}x) | max |diff| {r['max_diff']:.2e} allclose {r['allclose']} | "
+                  f"greedy tokens match {r['tokens_match']}")
+    finally:
+        if tmp is not None:
+            os.remove(path)
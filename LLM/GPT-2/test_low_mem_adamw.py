@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+# checks of the 8bit optimizer state against fp32: the quantization round trip and AdamW steps on gradients whose
+# magnitudes differ by orders of magnitude inside one block (where linear codes rounded sqrt(v) to 0)
+#
+# python3 -m pytest test_low_mem_adamw.py   # or python3 test_low_mem_adamw.py
+import torch
+from low_mem_adamw import LowMemAdamW, quantize_blockwise, dequantize_blockwise
+
+
+def spread(n, decades=6):
+    # magnitudes from ~1 down to 10^-decades, mixed inside every block
+    return (0.5 + torch.rand(n)) * 10 ** (-decades * torch.rand(n))
+
+
+def test_round_trip_unsigned():
+    torch.manual_seed(0)
+    x = spread(4096)
+    q, scale = quantize_blockwise(x, False)
+    assert q.dtype == torch.uint8 and scale.dtype == torch.float32
+    y = dequantize_blockwise(q, scale, False)
+    assert (y > 0).all(), 'a small sqrt(v) rounded to 0'
+    # every value lands on one of the two levels around it, 2^(1/8) apart
+    assert ((y - x).abs() / x).max() < 2 ** (1 / 8) - 1 + 1e-5
+    # stochastic rounding is unbiased
+    ys = torch.stack([dequantize_blockwise(*quantize_blockwise(x, False), False) for _ in range(200)])
+    assert ((ys.mean(0) - x).abs() / x).max() < 0.03
+
+
+def test_round_trip_signed():
+    torch.manual_seed(0)
+    x = spread(4096) * torch.where(torch.rand(4096) < 0.5, -1.0, 1.0)
+    q, scale = quantize_blockwise(x, True)
+    assert q.dtype == torch.int8
+    y = dequantize_blockwise(q, scale, True)
+    assert (torch.sign(y) == torch.sign(x)).all()
+    assert ((y - x).abs() / x.abs()).max() < 2 ** (1 / 4) - 1 + 1e-5
+
+
+def test_steps_match_adamw():
+    torch.manual_seed(0)
+    lr = 1e-3
+    kwargs = dict(lr=lr, betas=(0.9, 0.95), eps=1e-8, weight_decay=0.1)
+    p = torch.randn(8, 512)
+    ref = p.clone().requires_grad_()
+    low = p.clone().requires_grad_()
+    opt_ref = torch.optim.AdamW([ref], **kwargs)
+    opt_low = LowMemAdamW([low], state_dtype='8bit', **kwargs)
+    scale = 10 ** (-4 * torch.rand(512)) # a fixed gradient magnitude per column, 4 decades inside every block
+    for step in range(10):
+        g = torch.randn(8, 512) * scale
+        ref.grad, low.grad = g.clone(), g.clone()
+        ref_before, low_before = ref.detach().clone(), low.detach().clone()
+        opt_ref.step()
+        opt_low.step()
+        d_ref, d_low = ref.detach() - ref_before, low.detach() - low_before
+        err = (d_low - d_ref).abs()
+        # an Adam update is a few lr at most, a zeroed sqrt(v) made it g / eps
+        assert err.max() < lr, f'step {step}: update off by {err.max().item() / lr:.2f} lr'
+        assert (d_low - d_ref).norm() < 0.25 * d_ref.norm(), f'step {step}: update norm off by more than 25%'
+
+
+def test_state_dict_round_trip():
+    torch.manual_seed(0)
+    p = torch.randn(1000, requires_grad=True)
+    opt = LowMemAdamW([p], state_dtype='8bit')
+    p.grad = torch.randn(1000)
+    opt.step()
+    state = {k: v.clone() for k, v in opt.state[p].items() if torch.is_tensor(v)}
+    opt2 = LowMemAdamW([p], state_dtype='8bit')
+    opt2.load_state_dict(opt.state_dict())
+    for name, t in state.items():
+        assert opt2.state[p][name].dtype == t.dtype, name
+        assert torch.equal(opt2.state[p][name], t), name
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_'):
+            fn()
+            print(f'{name}: ok')
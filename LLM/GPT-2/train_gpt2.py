@@ -8,16 +8,116 @@ import torch
 from dataclasses import dataclass
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
+from sampling import Sampler, PrefixCache, generate_shared, generate_static, make_generators
+from ddp_comm import wrap_ddp, all_reduce_scalars
+from shard_sampler import RandomWindowLoader
+from low_mem_adamw import LowMemAdamW
+from batch_autotune import autotune_micro_batch
 import math
 import inspect
-from helloswag import render_example,iterate_example
 # https://github.com/karpathy/build-nanogpt
 import os
+import threading
 from torch.distributed import init_process_group, destroy_process_group
 from torch.nn.parallel import DistributedDataParallel as DDP
 # DDP disctriburted data parallel
 from torch.nn.parallel.distributed import dist
 
+class KVCache:
+    # keys/values of every token already forwarded, per layer, so generation only has to forward the new tokens.
+    # rows can have different lengths: shorter rows are left padded and self.mask marks the real columns
+    def __init__(self, n_layer):
+        self.k = [None] * n_layer # (B, n_head, T_cache, head_size)
+        self.v = [None] * n_layer
+        self.mask = None # (B, T_cache) bool, None while no row has padding
+        self.pos = None # (B,) position of the next token of each row
+        self.attn_mask = None # (B, 1, T, T_cache + T) for the forward in progress
+
+    def __len__(self):
+        return 0 if self.k[0] is None else self.k[0].size(2)
+
+    def begin(self, B, T, device):
+        # called once per forward before the blocks run: positions of the new tokens and their attention mask
+        if self.pos is None:
+            self.pos = torch.zeros(B, dtype=torch.long, device=device)
+        past = len(self)
+        pos = self.pos[:, None] + torch.arange(T, device=device) # (B, T)
+        if self.mask is not None or (past > 0 and T > 1):
+            cols = torch.arange(past + T, device=device)
+            attn_mask = cols[None, :] <= past + torch.arange(T, device=device)[:, None] # causal (T, past+T)
+            attn_mask = attn_mask[None, None]
+            if self.mask is not None:
+                self.mask = torch.cat((self.mask, self.mask.new_ones(self.mask.size(0), T)), dim=1)
+                attn_mask = attn_mask & self.mask[:, None, None, :]
+            self.attn_mask = attn_mask
+        else:
+            self.attn_mask = None
+        self.pos = self.pos + T
+        return pos
+
+    def update(self, layer, k, v):
+        if self.k[layer] is not None:
+            k = torch.cat((self.k[layer], k), dim=2)
+            v = torch.cat((self.v[layer], v), dim=2)
+        self.k[layer], self.v[layer] = k, v
+        return k, v
+
+    def select(self, rows):
+        # keep only the given batch rows (e.g. drop finished sequences) and cut the columns nobody uses anymore
+        rows = torch.as_tensor(rows, dtype=torch.long, device=self.pos.device)
+        self.k = [k.index_select(0, rows) for k in self.k]
+        self.v = [v.index_select(0, rows) for v in self.v]
+        self.pos = self.pos.index_select(0, rows)
+        if self.mask is not None:
+            self.mask = self.mask.index_select(0, rows)
+            used = self.mask.any(dim=0).nonzero()
+            start = int(used[0]) if len(used) else self.mask.size(1)
+            self.k = [k[:, :, start:] for k in self.k]
+            self.v = [v[:, :, start:] for v in self.v]
+            self.mask = self.mask[:, start:]
+            if self.mask.all():
+                self.mask = None
+        return self
+
+    def copy(self):
+        # new cache sharing the tensors: update() concatenates into new tensors, so the source is never modified
+        out = KVCache(len(self.k))
+        out.k, out.v = list(self.k), list(self.v)
+        out.mask, out.pos = self.mask, self.pos
+        return out
+
+    def repeat(self, n):
+        # every row n times in a row (row i -> rows i*n .. i*n+n-1), a batch of 1 is broadcast without a copy
+        def rep(t):
+            if t is None:
+                return None
+            return t.expand(n, *t.shape[1:]) if t.size(0) == 1 else t.repeat_interleave(n, dim=0)
+        out = KVCache(len(self.k))
+        out.k = [rep(k) for k in self.k]
+        out.v = [rep(v) for v in self.v]
+        out.mask, out.pos = rep(self.mask), rep(self.pos)
+        return out
+
+    @staticmethod
+    def cat(caches):
+        # stack several caches along the batch, left padding the shorter ones
+        T = max(len(c) for c in caches)
+        out = KVCache(len(caches[0].k))
+        masks = []
+        for c in caches:
+            mask = c.mask if c.mask is not None else c.pos.new_ones(c.pos.size(0), len(c), dtype=torch.bool)
+            masks.append(torch.cat((mask.new_zeros(mask.size(0), T - len(c)), mask), dim=1))
+        for layer in range(len(out.k)):
+            out.k[layer] = torch.cat([F.pad(c.k[layer], (0, 0, T - len(c), 0)) for c in caches], dim=0)
+            out.v[layer] = torch.cat([F.pad(c.v[layer], (0, 0, T - len(c), 0)) for c in caches], dim=0)
+        out.pos = torch.cat([c.pos for c in caches], dim=0)
+        out.mask = torch.cat(masks, dim=0)
+        if out.mask.all():
+            out.mask = None
+        return out
+
+
 class CausalSelfAttention(nn.Module):
 
     def __init__(self, config):
@@ -30,7 +130,7 @@ class CausalSelfAttention(nn.Module):
         self.n_embd = config.n_embd
         self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size)).view(1,1,config.block_size, config.block_size))
 
-    def forward(self,x):
+    def forward(self,x, kv_cache=None, layer=0):
         B,T,C = x.size()
         qkv = self.c_attn(x)
 
@@ -39,7 +139,13 @@ class CausalSelfAttention(nn.Module):
         q = q.view(B,T,self.n_head, C // self.n_head).transpose(1,2)
         v = v.view(B,T, self.n_head, C // self.n_head).transpose(1,2)
         
-        y = F.scaled_dot_product_attention(q,k,v,is_causal=True)
+        if kv_cache is None:
+            y = F.scaled_dot_product_attention(q,k,v,is_causal=True)
+        else:
+            # new queries attend to everything cached so far plus themselves
+            k, v = kv_cache.update(layer, k, v)
+            attn_mask = kv_cache.attn_mask
+            y = F.scaled_dot_product_attention(q,k,v,attn_mask=attn_mask, is_causal=attn_mask is None and k.size(2) == T)
 
         y   = y.transpose(1,2).contiguous().view(B,T,C)
         # y = F.scaled_dot_product_attention(q, k,v,is_causal=True)
@@ -74,12 +180,28 @@ class Block(nn.Module):
         self.ln_2 = nn.LayerNorm(config.n_embd)
         self.mlp  = MLP(config)
 
-    def forward(self,x ):
-        x  = x + self.attn(self.ln_1(x)) # 
+    def forward(self,x, kv_cache=None, layer=0):
+        x  = x + self.attn(self.ln_1(x), kv_cache, layer) # 
         x  = x + self.mlp(self.ln_2(x))
         return x
 
 
+def _cross_entropy_chunk(x, weight, targets):
+    logits = F.linear(x, weight) # (B, chunk, vocab_size)
+    return F.cross_entropy(logits.float().view(-1, logits.size(-1)), targets.reshape(-1), reduction='sum')
+
+def chunked_cross_entropy(x, weight, targets, chunk_size):
+    # lm_head + cross entropy over chunk_size positions at a time. each chunk is checkpointed, so its logits are
+    # freed right after the forward and recomputed in backward: only one (B, chunk, vocab_size) block is ever alive
+    # instead of the full (B, T, vocab_size) logits and their gradient. weight is the tied wte/lm_head matrix and
+    # collects its gradient from every chunk through autograd as usual
+    B, T, C = x.size()
+    loss_sum = 0.0
+    for i in range(0, T, chunk_size):
+        loss_sum = loss_sum + checkpoint(_cross_entropy_chunk, x[:, i:i+chunk_size], weight, targets[:, i:i+chunk_size], use_reentrant=False)
+    return loss_sum / (B * T)
+
+
 #-------------------
 @dataclass
 class GPTConfig:
@@ -112,6 +234,8 @@ class GPT(nn.Module):
 
         # init params
         self.apply(self._init_weights)
+        # sequence positions per lm_head + cross entropy chunk when the loss is computed without logits
+        self.loss_chunk_size = 128
 
     def _init_weights(self, module):
         if isinstance(module, nn.Linear):
@@ -131,20 +255,30 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight,mean=0.0, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def make_kv_cache(self):
+        return KVCache(self.config.n_layer)
+
+    def forward(self, idx, targets=None, kv_cache=None, return_logits=False):
         # idx -> shape of B, T
+        # kv_cache -> optional KVCache, idx is then only the new tokens after what is already cached
+        # with targets the logits come back as None unless return_logits=True
         B,T = idx.size()
         assert T <= self.config.block_size , f"Cant forward sequnce of lenegt {T},block size is {self.config.block_size} "
         # forward tokne and pos embedding
         pos = torch.arange(0, T, dtype=torch.long, device=idx.device) # shape (T)
+        if kv_cache is not None:
+            pos = kv_cache.begin(B, T, idx.device) # shape (B, T), every row counts from its own first real token
         pos_emb = self.transformer.wpe(pos) # pos emb for shape (T, n_embd)
         tok_emb = self.transformer.wte(idx) # tok emb for shape(B,T,n_embd)
         x = tok_emb + pos_emb
         # forward the blocks of the transformer
-        for block in self.transformer.h:
-            x = block(x)
+        for i, block in enumerate(self.transformer.h):
+            x = block(x, kv_cache, i)
         # forwarsd the final layernorm and the classifer
         x = self.transformer.ln_f(x)
+        if targets is not None and not return_logits:
+            # training/val loss without the full (B, T, vocab_size) logits, see chunked_cross_entropy
+            return None, chunked_cross_entropy(x, self.lm_head.weight, targets, self.loss_chunk_size)
         logits = self.lm_head(x) # (B, T, vocab_size->number of possible tokens)
         loss = None
         if targets is not None:
@@ -194,7 +328,8 @@ class GPT(nn.Module):
 
         return model
     
-    def configure_optimizers(self, weight_decay, lr, device):
+    def configure_optimizers(self, weight_decay, lr, device, optim_state='fp32'):
+        # optim_state: 'fp32' torch AdamW, 'bf16' or '8bit' LowMemAdamW moments (4 or ~2 bytes per param instead of 8)
         param_dict = {pn: p for pn, p in self.named_parameters()}
         param_dict = {pn: p for pn, p in param_dict.items() if p.requires_grad}
         
@@ -212,13 +347,19 @@ class GPT(nn.Module):
             print(f"num decayed parameter tensors: {len(decay_params)}, with {num_decay_params:,} params")
             print(f"num no-decayed parameter tensors: {len(nodecay_params)}, with {num_nodecay_params:,} params")
 
+        if optim_state != 'fp32':
+            if master_process:
+                print(f"Using LowMemAdamW with {optim_state} moments")
+            return LowMemAdamW(ops_group, lr=lr, betas=(0.9, 0.95), eps=1e-8, state_dtype=optim_state)
+
         # create adamw ops
         # fuses all kernels for one update instead of mutiple kernles to reduce kernel overheat
         fused_available = 'fused' in inspect.signature(torch.optim.AdamW).parameters
         use_fused = fused_available and 'cuda' in device
         if master_process:
             print(f"Using fused AdamW: {use_fused}")
-        optimizers = torch.optim.AdamW(ops_group, lr=lr, betas=(0.9, 0.95), eps=1e-8,fused=use_fused)
+        # without fused kernels (cpu) at least take the multi tensor foreach path instead of a loop over params
+        optimizers = torch.optim.AdamW(ops_group, lr=lr, betas=(0.9, 0.95), eps=1e-8,fused=use_fused, foreach=not use_fused)
         return optimizers
 
 
@@ -232,6 +373,7 @@ device = 'cpu'
 if torch.cuda.is_available():
     device = 'cuda'
     
+device_type = 'cuda' if device.startswith('cuda') else 'cpu'
 print(f'Using->: {device}')
 # model = GPT.from_pretrained('gpt2')
 torch.manual_seed(1337)
@@ -243,6 +385,9 @@ import tiktoken
 
 import numpy as np
 
+enc = tiktoken.get_encoding('gpt2')
+master_process = True # overwritten by the ddp setup below when launched as a training run
+
 def load_tokens(filename):
     npt = np.load(filename)
     ppt = torch.tensor(npt, dtype=torch.long)
@@ -292,110 +437,163 @@ class DataloaderLite:
             self.current_position = B * T * self.process_rank
         return x, y
 
-# y = buf[1:].view(B,T)
-
-#------------------------------------------
-
-
-ddp = int(os.environ.get('RANK', -1)) != -1
-if ddp:
-    assert torch.cuda.is_available(), "for now l thin we need cuda for DDP"
-    init_process_group(backend='nccl')
-    ddp_rank = int(os.environ['RANK'])
-    ddp_local_rank = int(os.environ['LOCAL_RANK'])
-    ddp_world_size = int(os.environ['WORLD_SIZE'])
-    device = f'cuda : {ddp_local_rank}'
-    torch.cuda.set_device(device)
-    master_process = ddp_rank == 0 # logging , checkpointing
-else:
-    ddp_rank = 0
-    ddp_local_rank = 0
-    ddp_world_size = 1
-    master_process = True
-
-    device = 'cpu'
-    if torch.cuda.is_available():
-        device = 'cuda'
-    # elif hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
-    #     device = 'mps'
-        print(f'using devive: {device}') 
-#------------------------------------------
-# we need to put B = 0.5 M paramters but our GPU is samll, so below code solves this problem by using gardient accumulation
-# row x is (B,T) B=5, T=8
-device_type = 'cuda' if device.startswith('cuda') else 'cpu'
-torch.manual_seed(1337)
-if torch.cuda.is_available():
-    torch.cuda.manual_seed(1337)
-
-
-total_batch_size = 524288 # 2**19, 0.5M number of tokens
-B = 32 # micro batch size
-T = 1024 # GPT2 1024 sequence length
-# (B * T) = 16384 per forward and backward
-assert total_batch_size % (B * T * ddp_world_size)  == 0, 'Make sure total_batch_size is devisible by B * T * ddp_world_size'
-gard_accum_steps = total_batch_size // (B * T * ddp_world_size)
-# gard_accum_steps = 5
-if master_process:
-    print(f"total desiered batch size : {total_batch_size}")
-    print(f"=> calculated gardient accumulation steps: {gard_accum_steps}")
-
-#------------------------------------------
-train_loader = DataloaderLite(B=B,T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split='train')
-val_loader = DataloaderLite(B=B,T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split='val')
-
-torch.set_float32_matmul_precision('high')
-checkpoint_path = 'log/model_19000.pt'
-checkpoint = torch.load(checkpoint_path, map_location='cpu') # map_location='cpu' avoids GPU memory exhustion
-# create model
-model = GPT(GPTConfig(vocab_size=50304)) # defualt config using 124M paramters
-model.to(device)
-use_compile = False
-if use_compile:
-    model = torch.compile(model)
-if ddp:
-    model = DDP(model, device_ids=[ddp_local_rank])
-raw_model = model.module if ddp else model # always contains the 'raw' unwrapped model
-raw_model.load_state_dict(checkpoint['model'])
-max_lr = 6e-4
-min_lr = max_lr * 0.1
-
-# warmup_steps = 5
-# max_steps = 5
-# detect_step = 5
-
-warmup_steps = 715
-saved_step = 19000
-max_steps = 19073 - saved_step # saved previous step and the model and continue from here to train 
-detect_step = 500
-
-print(f'warmup_steps {warmup_steps}')
-print(f'max_steps {max_steps}')
-print(f'detect_step {detect_step}')
-
-# testing on a signle batch and its overfitting well,so next needs to create a data loader to load all the batches
-# ops = torch.optim.AdamW(model.parameters(), lr=3e-4, betas=(0.9, 0.95), eps=1e-8) # gpt3 hyper params
-
-def get_most_likely_row(tokens,mask, logits):
-      shift_logits = (logits[..., :-1, :]).contiguous()
-      shift_tokens = (tokens[..., 1:]).contiguous()
-    
-      flat_shift_logits = shift_logits.view(-1, shift_logits.size(-1))
-      flat_shift_tokens = shift_tokens.view(-1)
+    def set_shape(self, B, T):
+        # switch the window size in place (sequence length curriculum), each rank keeps reading from the same shared
+        # position, only its offset within the B*T*num_processes stride changes
+        base = self.current_position - self.B * self.T * self.process_rank
+        self.B, self.T = B, T
+        self.current_position = base + B * T * self.process_rank
+        if self.current_position + (B * T * self.num_processes + 1) > len(self.tokens):
+            self.current_shard = (self.current_shard + 1) % len(self.shards)
+            self.tokens = load_tokens(self.shards[self.current_shard])
+            self.current_position = B * T * self.process_rank
 
-      shift_losses = F.cross_entropy(flat_shift_logits, flat_shift_tokens, reduction='none')
-      shift_losses = shift_losses.view(tokens.size(0), -1)
+# y = buf[1:].view(B,T)
 
-      # now get the average loss just for the completion region (where mask == 1), in each row    
-      shift_mask = (mask[...,1:]).contiguous() # we must shift mask, so we start at the last prompt token
-      masked_shift_losses = shift_losses * shift_mask
+class CachedValSet:
+    # the val loss always uses the same windows (val_loader.reset() + val_loss_steps batches), so they are read
+    # from disk once and kept on the device instead of reloading shard 0 and copying every batch each eval
+    def __init__(self, loader, steps, device):
+        loader.reset()
+        xs, ys = [], []
+        for _ in range(steps):
+            x, y = loader.next_batch()
+            xs.append(x)
+            ys.append(y)
+        self.x = torch.cat(xs).to(device) # (steps * B, T)
+        self.y = torch.cat(ys).to(device)
+
+    def loss(self, model, batch_size, device_type):
+        # every row has T targets, so the row weighted mean equals the mean over the original batches
+        with torch.inference_mode():
+            loss_sum = torch.zeros((), device=self.x.device)
+            for i in range(0, self.x.size(0), batch_size):
+                x, y = self.x[i:i+batch_size], self.y[i:i+batch_size]
+                with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+                    logits, loss = model(x, y)
+                loss_sum += loss.float() * x.size(0)
+            loss_sum = loss_sum / self.x.size(0)
+        return loss_sum.clone() # a normal tensor again, so all_reduce can work on it in place
+
+
+class AsyncValLoss:
+    # val loss of a weight snapshot in a background thread on its own cuda stream, overlapping the next training
+    # steps. collectives stay on the main thread: result() hands back the local loss for the caller to all_reduce
+    def __init__(self, val_set, config, device, device_type, batch_size):
+        self.val_set = val_set
+        self.snapshot = GPT(config).to(device)
+        self.snapshot.eval()
+        self.device_type = device_type
+        self.batch_size = batch_size
+        self.stream = torch.cuda.Stream() if device_type == 'cuda' else None
+        self.thread = None
+        self.step = None
+        self.val_loss = None
+
+    def submit(self, raw_model, step):
+        self.snapshot.load_state_dict(raw_model.state_dict())
+        if self.stream is not None:
+            self.stream.wait_stream(torch.cuda.current_stream())
+        self.step = step
+        self.thread = threading.Thread(target=self._run)
+        self.thread.start()
+
+    def _run(self):
+        if self.stream is not None:
+            with torch.cuda.stream(self.stream):
+                self.val_loss = self.val_set.loss(self.snapshot, self.batch_size, self.device_type)
+            self.stream.synchronize()
+        else:
+            self.val_loss = self.val_set.loss(self.snapshot, self.batch_size, self.device_type)
+
+    def result(self):
+        # (step, val loss) of the last submission, None if nothing is pending
+        if self.thread is None:
+            return None
+        self.thread.join()
+        self.thread = None
+        return self.step, self.val_loss
+
+
+def bucket_length(n, bucket, block_size):
+    # round a length up to a multiple of bucket so the compiled model only ever sees a handful of shapes
+    return min(-(-n // bucket) * bucket, block_size)
+
+
+def hellaswag_batches(examples, batch_examples, bucket, block_size):
+    # (tokens, mask, label) examples -> (tokens, mask, labels, valid) batches of batch_examples*4 rows, right padded
+    # to a bucketed length. padding after a row's end can not change the causal logits before it and has mask 0,
+    # and a short last batch is filled with all-zero dummy examples (valid False), so every batch has a static shape
+    def flush(batch):
+        T = bucket_length(max(t.size(1) for t, m, l in batch), bucket, block_size)
+        tokens = torch.zeros((batch_examples * 4, T), dtype=torch.long)
+        mask = torch.zeros((batch_examples * 4, T), dtype=torch.long)
+        labels = torch.zeros(batch_examples, dtype=torch.long)
+        valid = torch.zeros(batch_examples, dtype=torch.bool)
+        for e, (t, m, l) in enumerate(batch):
+            tokens[e*4:e*4+4, :t.size(1)] = t
+            mask[e*4:e*4+4, :m.size(1)] = m
+            labels[e] = l
+            valid[e] = True
+        return tokens, mask, labels, valid
+    batch = []
+    for example in examples:
+        batch.append(example)
+        if len(batch) == batch_examples:
+            yield flush(batch)
+            batch = []
+    if batch:
+        yield flush(batch)
+
+
+def get_most_likely_rows(tokens, mask, logits, chunk_rows=4):
+    # the ending with the lowest mean loss over its completion tokens, for a batch of examples with 4 rows each
+    # -> (num_examples,) predicted endings. the loss is computed chunk_rows rows at a time, a float32 copy of all
+    # the logits would be rows * T * 50304 * 4 bytes (2.4GB for 64 rows of 192 tokens)
+    shift_losses = torch.cat([
+        F.cross_entropy(logits[i:i+chunk_rows, :-1, :].float().reshape(-1, logits.size(-1)), tokens[i:i+chunk_rows, 1:].reshape(-1), reduction='none')
+        for i in range(0, tokens.size(0), chunk_rows)])
+    shift_mask = mask[..., 1:]
+    shift_losses = shift_losses.view(tokens.size(0), -1) * shift_mask
+    avg_loss = shift_losses.sum(dim=1) / shift_mask.sum(dim=1).clamp(min=1) # dummy rows have an empty mask
+    return avg_loss.view(-1, 4).argmin(dim=1)
+
+
+def compiled_graphs():
+    # number of graphs torch.compile built so far, every new input shape that is not covered triggers another one
+    from torch._dynamo.utils import counters
+    return counters['stats']['unique_graphs']
+
+
+def recompile_limit():
+    # how many shapes dynamo compiles for one function before it runs it eagerly (cache_size_limit in older torch)
+    import torch._dynamo.config as dynamo_config
+    return getattr(dynamo_config, 'recompile_limit', dynamo_config.cache_size_limit)
+
+
+def set_recompile_limit(n):
+    import torch._dynamo.config as dynamo_config
+    for name in ('recompile_limit', 'cache_size_limit'):
+        if hasattr(dynamo_config, name):
+            setattr(dynamo_config, name, n)
+
+
+def curriculum_shape(step, B, T, total_batch_size, world_size, warmup_steps, T_min=128, max_B=None):
+    # sequence length curriculum: T doubles from T_min up to T over the first warmup_steps steps (powers of two, so
+    # only a few shapes), and B / gradient accumulation are adjusted so every step still sees total_batch_size tokens.
+    # a shorter T gets a proportionally bigger micro batch (same tokens per forward), capped at max_B
+    # returns (B, T, gard_accum_steps) for this step
+    T_step = T
+    if warmup_steps > 0 and step < warmup_steps:
+        assert T % T_min == 0 and (T // T_min) & (T // T_min - 1) == 0, f'T {T} must be T_min {T_min} times a power of two'
+        levels = int(math.log2(T // T_min)) + 1 # T_min, 2*T_min, ..., T
+        T_step = T_min * 2 ** int(step * levels / warmup_steps)
+    B_step = B * T // T_step
+    if max_B is not None:
+        B_step = min(B_step, max_B)
+    assert total_batch_size % (B_step * T_step * world_size) == 0, f'total_batch_size {total_batch_size} is not divisible by B*T*world_size = {B_step}*{T_step}*{world_size}'
+    return B_step, T_step, total_batch_size // (B_step * T_step * world_size)
 
-      sum_loss = masked_shift_losses.sum(dim=1)
-      avg_loss = sum_loss / shift_mask.sum(dim=1)
-        
-        # now we have a loss for each of the 4 completions
-        # the one with the lowest loss should be the most likely
-      pred_norm = avg_loss.argmin().item()
-      return pred_norm
 
 def get_lr(it):
     if it < warmup_steps:
@@ -408,10 +606,152 @@ def get_lr(it):
     coeff = 0.5 * (1.0 + math.cos(math.pi * decay_ratio)) # coeff starts at 1 and goes to 0 
     return min_lr + coeff * (max_lr - min_lr) 
 
-ops = raw_model.configure_optimizers(weight_decay=0.1, lr=6e-4, device=device_type)
-enc = tiktoken.get_encoding('gpt2')
 
 if __name__ == "__main__":
+    from helloswag_eval import iterate_rendered # cached download + binary token cache, HELLASWAG_OFFLINE=1 for no network
+    #------------------------------------------
+    ddp = int(os.environ.get('RANK', -1)) != -1
+    if ddp:
+        # nccl on gpus, gloo lets the same script run multi process on cpu to measure the communication
+        init_process_group(backend='nccl' if torch.cuda.is_available() else 'gloo')
+        ddp_rank = int(os.environ['RANK'])
+        ddp_local_rank = int(os.environ['LOCAL_RANK'])
+        ddp_world_size = int(os.environ['WORLD_SIZE'])
+        if torch.cuda.is_available():
+            device = f'cuda:{ddp_local_rank}'
+            torch.cuda.set_device(device)
+        else:
+            device = 'cpu'
+        master_process = ddp_rank == 0 # logging , checkpointing
+    else:
+        ddp_rank = 0
+        ddp_local_rank = 0
+        ddp_world_size = 1
+        master_process = True
+
+        device = 'cpu'
+        if torch.cuda.is_available():
+            device = 'cuda'
+        # elif hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
+        #     device = 'mps'
+            print(f'using devive: {device}') 
+    #------------------------------------------
+    # we need to put B = 0.5 M paramters but our GPU is samll, so below code solves this problem by using gardient accumulation
+    # row x is (B,T) B=5, T=8
+    device_type = 'cuda' if device.startswith('cuda') else 'cpu'
+    torch.manual_seed(1337)
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed(1337)
+
+
+    total_batch_size = 524288 # 2**19, 0.5M number of tokens
+    T = 1024 # GPT2 1024 sequence length
+    # probe the largest micro batch that fits and time a few (B, accumulation) pairs at startup, cached per machine
+    # in autotune_cache.json. False uses the fixed B below
+    autotune_batch = True
+    B = 32 # micro batch size, the chunked lm_head loss leaves room to raise this (the (B,T,50304) logits are never materialized)
+    # sequence length curriculum: T grows 128 -> 1024 over the first seq_len_warmup steps at constant tokens per step.
+    # 0 = off, this run resumes a trained checkpoint; something like 2000 when training from scratch
+    seq_len_warmup = 0
+    seq_len_min = 128
+    max_micro_B = None # cap on the micro batch: the autotuner does not go above it, nor do the short T steps of the curriculum
+    target_val_loss = 3.3 # report the wall clock time until the val loss first drops below this
+
+    torch.set_float32_matmul_precision('high')
+    # create model
+    model = GPT(GPTConfig(vocab_size=50304)) # defualt config using 124M paramters
+    model.to(device)
+    use_compile = False
+    hellaswag_batch_examples = 16 # examples per hellaswag forward (x4 rows)
+    hellaswag_bucket = 64 # hellaswag rows are padded up to a multiple of this, a few shapes instead of one per length
+
+    if autotune_batch:
+        # before torch.compile (every probed B would recompile and use up dynamo's recompile limit) and before the
+        # DDP wrapper so the probes do no all-reduce
+        B, gard_accum_steps = autotune_micro_batch(model, T, total_batch_size, ddp_world_size, device, device_type,
+                                                   max_B=max_micro_B, verbose=master_process)
+    else:
+        # (B * T) = 16384 per forward and backward
+        assert total_batch_size % (B * T * ddp_world_size)  == 0, 'Make sure total_batch_size is devisible by B * T * ddp_world_size'
+        gard_accum_steps = total_batch_size // (B * T * ddp_world_size)
+    # gard_accum_steps = 5
+    if master_process:
+        print(f"total desiered batch size : {total_batch_size}")
+        print(f"=> micro batch {B}, calculated gardient accumulation steps: {gard_accum_steps}")
+    if use_compile:
+        # eval and sampling only use static (bucketed/padded) shapes, so no dynamic shape graphs are needed
+        model = torch.compile(model, dynamic=False)
+    if seq_len_warmup > 0:
+        # every curriculum stage has to divide total_batch_size, fail here and not in the middle of training
+        stages = sorted({curriculum_shape(s, B, T, total_batch_size, ddp_world_size, seq_len_warmup, seq_len_min, max_micro_B)
+                         for s in range(seq_len_warmup + 1)}, key=lambda shape: shape[1])
+        if master_process:
+            print('sequence length curriculum (B, T, accum): ' + ', '.join(str(shape) for shape in stages))
+
+    #------------------------------------------
+    # draw training windows at random across all shards (manifest + memmaps), False walks shards in order like before.
+    # opt in: switching it on changes the data order of a run resumed from a DataloaderLite checkpoint
+    random_windows = False
+    if random_windows:
+        train_loader = RandomWindowLoader(B=B, T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split='train', verbose=master_process)
+    else:
+        train_loader = DataloaderLite(B=B,T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split='train')
+    val_loader = DataloaderLite(B=B,T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split='val')
+    val_loss_steps = 20
+    val_batch_size = 2 * B # no activations are kept for backward, so eval can take bigger batches
+    val_async = False # compute val loss on a weight snapshot in the background while training continues
+    val_set = CachedValSet(val_loader, val_loss_steps, device)
+    # input shapes the compiled model gets, to notice when dynamo stops compiling new ones: train (curriculum
+    # stages), val and the sampling window up front, hellaswag buckets as they show up
+    compiled_shapes = {(B, T), (val_batch_size, T), (4, 32)}
+    if seq_len_warmup > 0:
+        compiled_shapes |= {(b, t) for b, t, accum in stages}
+    if use_compile:
+        # the default limit (8) can be less than that plus every hellaswag bucket, past it dynamo silently falls
+        # back to eager for the new shapes
+        block_size = model.config.block_size
+        shapes = compiled_shapes | {(hellaswag_batch_examples * 4, bucket_length(n, hellaswag_bucket, block_size))
+                                    for n in range(1, block_size + 1, hellaswag_bucket)}
+        if recompile_limit() < len(shapes):
+            set_recompile_limit(len(shapes))
+        if master_process:
+            print(f'torch.compile: up to {len(shapes)} input shapes, recompile limit {recompile_limit()}')
+
+    checkpoint_path = 'log/model_19000.pt'
+    checkpoint = torch.load(checkpoint_path, map_location='cpu') # map_location='cpu' avoids GPU memory exhustion
+    if random_windows and 'train_loader' in checkpoint:
+        train_loader.load_state_dict(checkpoint['train_loader']) # continue the same permutation where it stopped
+        if (train_loader.B, train_loader.T) != (B, T):
+            train_loader.set_shape(B, T) # saved with another micro batch, same point of the epoch with this one
+    grad_comm_dtype = 'fp32' # 'fp32', 'bf16' or 'fp16' gradients on the wire, bf16/fp16 halve the all-reduce bytes (lossy, opt in)
+    bucket_cap_mb = 25 # DDP bucket size, each bucket is all-reduced as soon as backward has filled it
+    if ddp:
+        model, comm_state = wrap_ddp(model, [ddp_local_rank] if device_type == 'cuda' else None, grad_comm_dtype, bucket_cap_mb)
+    raw_model = model.module if ddp else model # always contains the 'raw' unwrapped model
+    raw_model.load_state_dict(checkpoint['model'])
+    max_lr = 6e-4
+    min_lr = max_lr * 0.1
+
+    # warmup_steps = 5
+    # max_steps = 5
+    # detect_step = 5
+
+    warmup_steps = 715
+    saved_step = 19000
+    max_steps = 19073 - saved_step # saved previous step and the model and continue from here to train 
+    detect_step = 500
+
+    print(f'warmup_steps {warmup_steps}')
+    print(f'max_steps {max_steps}')
+    print(f'detect_step {detect_step}')
+
+    # testing on a signle batch and its overfitting well,so next needs to create a data loader to load all the batches
+    # ops = torch.optim.AdamW(model.parameters(), lr=3e-4, betas=(0.9, 0.95), eps=1e-8) # gpt3 hyper params
+    optim_state = 'fp32' # 'bf16' or '8bit' for the low memory optimizer state
+    ops = raw_model.configure_optimizers(weight_decay=0.1, lr=6e-4, device=device_type, optim_state=optim_state)
+    if checkpoint.get('optimizer.type') == type(ops).__name__ and checkpoint.get('optim_state', 'fp32') == optim_state:
+        ops.load_state_dict(checkpoint['optimizer.state_dict'])
+
     
     log_dir = 'log'
     os.makedirs(log_dir, exist_ok=True)
@@ -419,37 +759,59 @@ if __name__ == "__main__":
     with open(log_file, 'w') as f:
         pass
 
+    val_eval = AsyncValLoss(val_set, raw_model.config, device, device_type, val_batch_size) if val_async else None
+
+    t_start = time.time()
+    target_reached = False
+
+    def log_val_loss(step, val_loss_accum):
+        global target_reached
+        if ddp:
+            # SUM / world size, gloo has no ReduceOp.AVG. in place, the caller saves val_loss_accum in the checkpoint
+            dist.all_reduce(val_loss_accum, op=dist.ReduceOp.SUM)
+            val_loss_accum.div_(ddp_world_size)
+
+        # if master_process:
+        print(f'validation loss: {val_loss_accum.item():.4f}')
+        with open(log_file, 'a') as f:
+            f.write(f'{step} val {val_loss_accum.item():.4f}\n')
+        if not target_reached and val_loss_accum.item() < target_val_loss:
+            target_reached = True
+            print(f'val loss {val_loss_accum.item():.4f} < target {target_val_loss} at step {step} after {time.time() - t_start:.1f}s')
+            with open(log_file, 'a') as f:
+                f.write(f'{step} target_time {time.time() - t_start:.1f}\n')
+
 
     for step in range(max_steps):
         t0 = time.time()
         last_step = (step == max_steps -1)
+        if seq_len_warmup > 0:
+            B_step, T_step, gard_accum_steps = curriculum_shape(step, B, T, total_batch_size, ddp_world_size, seq_len_warmup, seq_len_min, max_micro_B)
+            if (B_step, T_step) != (train_loader.B, train_loader.T):
+                train_loader.set_shape(B_step, T_step)
+                if master_process:
+                    print(f'step {step}: sequence length {T_step}, micro batch {B_step}, gradient accumulation {gard_accum_steps}')
 
         # val loss
         if step % 250 == 0 or last_step:
             model.eval()
-            val_loader.reset()
-
-            with torch.no_grad():
-                val_loss_accum = 0.0
-                val_loss_steps = 20
-
-                for _ in range(val_loss_steps):
-                    x, y = val_loader.next_batch()
-                    x, y = x.to(device), y.to(device)
-                    with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
-                        logits, loss = model(x, y)
-                    loss = loss / val_loss_steps
-                    val_loss_accum += loss.detach()
-
-            if ddp:
-                dist.all_reduce(val_loss_accum, op=dist.ReduceOp.AVG)
-
-            # if master_process:
-            print(f'validation loss: {val_loss_accum.item():.4f}')
-            with open(log_file, 'a') as f:
-                f.write(f'{step} val {val_loss_accum.item():.4f}\n')
+            save_checkpoint = (step > 0 and step % detect_step == 0) or last_step
+
+            if val_async:
+                # log the eval submitted at the previous val step, then start this one in the background
+                pending = val_eval.result()
+                if pending is not None:
+                    log_val_loss(*pending)
+                val_eval.submit(raw_model, step)
+                if save_checkpoint:
+                    # the checkpoint records its own val loss, so wait for it here
+                    val_step, val_loss_accum = val_eval.result()
+                    log_val_loss(val_step, val_loss_accum)
+            else:
+                val_loss_accum = val_set.loss(model, val_batch_size, device_type)
+                log_val_loss(step, val_loss_accum)
 
-            if (step > 0 and step % detect_step == 0) or last_step:
+            if save_checkpoint:
                 saved_step += step
                 # optionally write model checkpoints
                 # saving the model after saved_step in case you need to stop the training
@@ -460,36 +822,37 @@ if __name__ == "__main__":
                     'step': step,
                     'val_loss': val_loss_accum.item(),
                     'optimizer.state_dict': ops.state_dict(),
+                    'optimizer.type': type(ops).__name__,
+                    'optim_state': optim_state,
                 }
+                if random_windows:
+                    checkpoint['train_loader'] = train_loader.state_dict()
                 torch.save(checkpoint, checkpoint_path)
                 print(f'------>: model saved to {checkpoint_path} at {saved_step}')
 
 
         # hellaswag eval
-        if (step % 250 == 0 or last_step) and (not use_compile):
+        if step % 250 == 0 or last_step:
             num_correct_norm = 0
             num_total = 0
-            for i, example in enumerate(iterate_example('val')):
-                if i % ddp_world_size != ddp_rank:
-                    continue
-                _, tokens, mask, label = render_example(example)
-                tokens = tokens.to(device)
-                mask = mask.to(device)
+            mine = (example for i, example in enumerate(iterate_rendered('val')) if i % ddp_world_size == ddp_rank)
+            for tokens, mask, labels, valid in hellaswag_batches(mine, hellaswag_batch_examples, hellaswag_bucket, raw_model.config.block_size):
+                tokens, mask, labels, valid = tokens.to(device), mask.to(device), labels.to(device), valid.to(device)
+                if use_compile and tuple(tokens.shape) not in compiled_shapes:
+                    compiled_shapes.add(tuple(tokens.shape))
+                    if len(compiled_shapes) > recompile_limit() and master_process:
+                        print(f'warning: hellaswag shape {tuple(tokens.shape)} is past dynamo\'s recompile limit '
+                              f'{recompile_limit()}, it runs eagerly (raise the limit or hellaswag_bucket)')
                 # get logits
                 with torch.no_grad():
                     with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
                         logits, loss = model(tokens)
-                    pred_norm = get_most_likely_row(tokens,mask, logits)
-                num_total += 1
-                num_correct_norm += int(pred_norm == label)
-            # reduce the stats across all processes
+                    pred_norm = get_most_likely_rows(tokens, mask, logits)
+                num_total += int(valid.sum())
+                num_correct_norm += int(((pred_norm == labels) & valid).sum())
+            # reduce the stats across all processes, both counters in one call
             if ddp:
-                num_total = torch.tensor(num_total, dtype=torch.long, device=device)
-                num_correct_norm = torch.tensor(num_correct_norm, dtype=torch.long, device=device)
-                dist.all_reduce(num_total, op=dist.ReduceOp.SUM)
-                dist.all_reduce(num_correct_norm, op=dist.ReduceOp.SUM)
-                num_total = num_total.item()
-                num_correct_norm = num_correct_norm.item()
+                num_total, num_correct_norm = (int(v) for v in all_reduce_scalars([num_total, num_correct_norm], device=device).tolist())
             acc_norm = num_correct_norm / num_total
 
             if master_process:
@@ -498,32 +861,20 @@ if __name__ == "__main__":
                     f.write(f'{step} hella {acc_norm:.4f}\n')
 
         #  from the model (except step 0, which is noise)
-        if ((step > 0 and step % 250 == 0) or last_step) and (not use_compile):
+        if (step > 0 and step % 250 == 0) or last_step:
             model.eval()
             num_return_sequences = 4
             max_length = 32
             tokens = enc.encode("This is how Tesla's FSD and Autopilot system work: ")
-            tokens = torch.tensor(tokens, dtype=torch.long)
-            tokens = tokens.unsqueeze(0).repeat(num_return_sequences, 1)
-            xgen = tokens.to(device)
-            sample_rng = torch.Generator(device=device)
-            sample_rng.manual_seed(42 + ddp_rank)
-            while xgen.size(1) < max_length:
-                # forward model to get the logits
-                with torch.no_grad():
-                    with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
-
-                        logits, loss = model(xgen) # (B,T,vocab_size)
-                        # take the logits at the last position
-                        logits = logits[:, -1,:] # (B, vocab_size)
-                        # get probailities
-                        probs = F.softmax(logits, dim=-1)
-                        # do top-k sampling of 50 
-                        topk_probs, topk_indices = torch.topk(probs, 50, dim=-1)
-                        ix = torch.multinomial(topk_probs, 1, generator=sample_rng) # (B,1)
-                        xcol = torch.gather(topk_indices,-1,ix) # (B,1)
-                        # append tp the sequence
-                        xgen = torch.cat((xgen, xcol), dim=1)
+            # top-k 50 as before, one seeded rng per sequence, padding tokens masked
+            # the prompt is forwarded once for all num_return_sequences (the weights changed, so no prefix cache across steps)
+            sampler = Sampler(top_k=50, vocab_size=enc.n_vocab)
+            generators = make_generators([42 + ddp_rank * num_return_sequences + i for i in range(num_return_sequences)], device)
+            if use_compile:
+                # one fixed (num_return_sequences, max_length) padded window, the compiled graph never changes shape
+                xgen = generate_static(model, tokens, num_return_sequences, max_length, sampler, generators, device_type)
+            else:
+                xgen = generate_shared(raw_model, tokens, num_return_sequences, max_length, sampler, generators, device_type)
                 
             for i in range(num_return_sequences):
                     tokens = xgen[i, :max_length].tolist()
@@ -531,6 +882,8 @@ if __name__ == "__main__":
                     print(f'rank {ddp_rank} sample {i}: {decoded}')
                     # select a token from the top-k probabilities
                     # note: multinomial does not demand the input to sum to 1
+            if use_compile and master_process:
+                print(f'compiled graphs so far: {compiled_graphs()}')
 
 
         model.train()
@@ -540,7 +893,7 @@ if __name__ == "__main__":
 
             x, y = train_loader.next_batch()
             x,y = x.to(device), y.to(device) 
-            with torch.autocast(device_type=device, dtype=torch.bfloat16):
+            with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
                 logits,loss = model(x,y) 
             loss = loss / gard_accum_steps
             loss_accum += loss.detach() # detach tensor from graph
@@ -551,7 +904,9 @@ if __name__ == "__main__":
             loss.backward()
 
         if ddp:
-            dist.all_reduce(loss_accum, op=dist.ReduceOp.AVG)
+            # only read for logging, so let it run behind the clip and optimizer step
+            # SUM, divided by the world size after the wait: gloo has no ReduceOp.AVG
+            loss_accum, loss_work = all_reduce_scalars([loss_accum], dist.ReduceOp.SUM, device, async_op=True)
 
         norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
 
@@ -559,13 +914,21 @@ if __name__ == "__main__":
         for param_group in ops.param_groups:
             param_group['lr'] = lr
         ops.step()
-        torch.cuda.synchronize()
+        if ddp:
+            loss_work.wait()
+            loss_accum = loss_accum / ddp_world_size
+        if device_type == 'cuda':
+            torch.cuda.synchronize()
         t1 = time.time()
         dt = t1 -t0
         tokens_proccsed = train_loader.B * train_loader.T * gard_accum_steps * ddp_world_size
         token_per_sec = tokens_proccsed / dt
+        comm = ''
+        if ddp:
+            comm = f' | grad comm: {comm_state.bytes / 2**20:.1f}MB in {comm_state.num_calls} calls'
+            comm_state.reset()
         if master_process:
-            print(f'step {step:5d} | loss: {loss_accum.item():.6f} | lr {lr:4e} | norm: {norm:.4f} | dt: {dt*1000:.2f}ms | tok/sec: {token_per_sec:.2f}')
+            print(f'step {step:5d} | loss: {loss_accum.item():.6f} | lr {lr:4e} | norm: {norm:.4f} | dt: {dt*1000:.2f}ms | tok/sec: {token_per_sec:.2f}{comm}')
             with open(log_file, 'a') as f:
                 f.write(f'{step} train {loss_accum.item():.6f}\n')
 
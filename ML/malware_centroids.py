@@ -0,0 +1,221 @@
+import time
+import numpy as np
+import pandas as pd
+
+
+def iter_features(features_path, labels_path=None, columns=None, chunksize=100_000):
+    """
+    Stream malware_data.csv (and optionally malware_label.csv) chunksize rows at a time.
+
+    Inputs:
+    - features_path: CSV without header, one sample per row, e.g. ./T2_data/malware_data.csv
+    - labels_path: CSV without header whose second column is the label, e.g. ./T2_data/malware_label.csv
+    - columns: feature columns to keep, e.g. [0, 1] like the notebook. None keeps all of them.
+
+    Yields:
+    - X: A numpy array of shape (chunk, D), float64.
+    - y: A numpy array of shape (chunk,) of labels, or None without labels_path.
+    """
+    features = pd.read_csv(features_path, header=None, usecols=columns, chunksize=chunksize)
+    if labels_path is None:
+        for chunk in features:
+            yield chunk.to_numpy(dtype=np.float64), None
+        return
+    labels = pd.read_csv(labels_path, header=None, usecols=[1], chunksize=chunksize)
+    for X, y in zip(features, labels):
+        assert len(X) == len(y), 'malware_data.csv and malware_label.csv have a different number of rows'
+        yield X.to_numpy(dtype=np.float64), y[1].to_numpy()
+
+
+def squared_distances(X, centroids):
+    """
+    Squared L2 distance between every sample and every centroid with one matrix multiply,
+    the same expansion as KNearestNeighbor.compute_distances_no_loops.
+
+    Inputs:
+    - X: A numpy array of shape (N, D).
+    - centroids: A numpy array of shape (C, D).
+
+    Returns:
+    - dists: A numpy array of shape (N, C).
+    """
+    dists = np.sum(X**2, axis=1)[:, np.newaxis] + np.sum(centroids**2, axis=1) - 2 * X.dot(centroids.T)
+    return np.maximum(dists, 0) # rounding can push the expansion slightly below 0
+
+
+class NearestCentroid(object):
+    """ classify a sample as the label of the closest class mean (the notebook's find_groups) """
+
+    def __init__(self):
+        self.classes = None
+        self.sums = None
+        self.counts = None
+
+    def partial_fit(self, X, y):
+        """
+        Add a chunk of labelled samples to the running class sums, so the centroids of a file
+        larger than memory can be computed one chunk at a time.
+        """
+        classes, inverse = np.unique(y, return_inverse=True)
+        sums = np.zeros((len(classes), X.shape[1]))
+        np.add.at(sums, inverse, X)
+        counts = np.bincount(inverse, minlength=len(classes))
+        if self.classes is None:
+            self.classes, self.sums, self.counts = classes, sums, counts
+            return self
+        # merge the label sets of the chunks seen so far and of this one
+        merged = np.union1d(self.classes, classes)
+        new_sums = np.zeros((len(merged), X.shape[1]))
+        new_counts = np.zeros(len(merged), dtype=np.int64)
+        for c, s, n in ((self.classes, self.sums, self.counts), (classes, sums, counts)):
+            ix = np.searchsorted(merged, c)
+            new_sums[ix] += s
+            new_counts[ix] += n
+        self.classes, self.sums, self.counts = merged, new_sums, new_counts
+        return self
+
+    def fit(self, X, y):
+        self.classes = None
+        return self.partial_fit(X, y)
+
+    @property
+    def centroids(self):
+        return self.sums / self.counts[:, np.newaxis]
+
+    def predict(self, X):
+        """
+        Inputs:
+        - X: A numpy array of shape (N, D).
+
+        Returns:
+        - y: A numpy array of shape (N,) with the label of the nearest centroid of each sample.
+        """
+        return self.classes[np.argmin(squared_distances(X, self.centroids), axis=1)]
+
+    def score(self, X, y):
+        # number of correctly classified samples, what the notebook prints as score
+        return int(np.sum(self.predict(X) == y))
+
+
+class MiniBatchKMeans(object):
+    """ k-means updated one mini-batch at a time (Sculley 2010, web-scale k-means clustering) """
+
+    def __init__(self, n_clusters=3, batch_size=1024, seed=42):
+        self.n_clusters = n_clusters
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+        self.centroids = None
+        self.counts = None
+
+    def init_centroids(self, X):
+        # k-means++ seeding on the first batch
+        centroids = [X[self.rng.integers(len(X))]]
+        for _ in range(1, self.n_clusters):
+            d = np.min(squared_distances(X, np.array(centroids)), axis=1)
+            p = d / d.sum() if d.sum() > 0 else None
+            centroids.append(X[self.rng.choice(len(X), p=p)])
+        self.centroids = np.array(centroids, dtype=np.float64)
+        self.counts = np.zeros(self.n_clusters, dtype=np.int64)
+
+    def partial_fit(self, X):
+        """
+        Run the mini-batch updates over a chunk of samples of shape (N, D).
+        Every centroid moves towards the mean of its assigned batch samples with a learning rate
+        of 1 / (number of samples it has absorbed so far).
+        """
+        if self.centroids is None:
+            self.init_centroids(X)
+        for start in range(0, len(X), self.batch_size):
+            batch = X[start:start + self.batch_size]
+            assign = self.predict(batch)
+            batch_counts = np.bincount(assign, minlength=self.n_clusters)
+            batch_sums = np.zeros_like(self.centroids)
+            np.add.at(batch_sums, assign, batch)
+            self.counts += batch_counts
+            hit = batch_counts > 0
+            lr = batch_counts[hit] / self.counts[hit]
+            self.centroids[hit] += lr[:, np.newaxis] * (batch_sums[hit] / batch_counts[hit, np.newaxis] - self.centroids[hit])
+        return self
+
+    def fit(self, chunks, epochs=1):
+        """
+        Inputs:
+        - chunks: callable returning an iterable of (N, D) arrays, called once per epoch,
+          e.g. lambda: (X for X, y in iter_features(path)).
+        """
+        for _ in range(epochs):
+            for X in chunks():
+                self.partial_fit(X)
+        return self
+
+    def predict(self, X):
+        return np.argmin(squared_distances(X, self.centroids), axis=1)
+
+    def inertia(self, X):
+        return float(np.sum(np.min(squared_distances(X, self.centroids), axis=1)))
+
+
+def notebook_find_groups(centroids, data, labels):
+    # the per-sample loop of find_groups / accuracy_score in Data-Visualisation-ML.ipynb, kept for the benchmark
+    score = 0
+    for i in range(data.shape[0]):
+        distance1 = [np.sqrt(np.abs(data[i][0] - centroids[0,0]) ** 2 + np.abs(data[i][1] - centroids[0,1]) ** 2)]
+        distance2 = [np.sqrt(np.abs(data[i][0] - centroids[1,0]) ** 2 + np.abs(data[i][1] - centroids[1,1]) ** 2)]
+        distance3 = [np.sqrt(np.abs(data[i][0] - centroids[2,0]) ** 2 + np.abs(data[i][1] - centroids[2,1]) ** 2)]
+        distances = [distance1, distance2, distance3]
+        p = np.argmin(distances)
+        if labels[p] == data[i][2]:
+            score = score + 1
+    return score
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--features", type=str, default="./T2_data/malware_data.csv")
+    parser.add_argument("--labels", type=str, default="./T2_data/malware_label.csv")
+    parser.add_argument("--columns", type=int, nargs='*', default=[0, 1], help="feature columns, the notebook uses 0 1")
+    parser.add_argument("--chunksize", type=int, default=100_000)
+    parser.add_argument("--n_clusters", type=int, default=3)
+    parser.add_argument("--batch_size", type=int, default=1024, help="k-means mini-batch size")
+    parser.add_argument("--epochs", type=int, default=3)
+    args = parser.parse_args()
+    chunks = lambda: iter_features(args.features, args.labels, args.columns, args.chunksize)
+
+    # 1. nearest centroid over the whole file, fitted and scored chunk by chunk
+    t0 = time.time()
+    clf = NearestCentroid()
+    num_rows = 0
+    for X, y in chunks():
+        clf.partial_fit(X, y)
+        num_rows += len(X)
+    t1 = time.time()
+    correct = sum(clf.score(X, y) for X, y in chunks())
+    t2 = time.time()
+    print(f'nearest centroid: {len(clf.classes)} classes | fit {t1 - t0:.2f}s | '
+          f'accuracy {correct / num_rows:.4f} on {num_rows} rows | assign+read {num_rows / (t2 - t1):.0f} rows/sec')
+
+    # 2. assignment throughput against the notebook loop, on the first chunk in memory
+    X, y = next(iter(chunks()))
+    if X.shape[1] == 2 and len(clf.classes) == 3:
+        data = np.empty((len(X), 3), dtype=object)
+        data[:, :2], data[:, 2] = X, y
+        t0 = time.time()
+        loop_score = notebook_find_groups(clf.centroids, data, clf.classes)
+        t_loop = time.time() - t0
+        t0 = time.time()
+        vec_score = clf.score(X, y)
+        t_vec = time.time() - t0
+        # the loop uses sqrt of abs distances, the vectorized path clamped squared distances: near ties can go to
+        # a different centroid, so report the difference instead of requiring equality
+        print(f'assignment of {len(X)} rows | notebook loop {len(X) / t_loop:.0f} rows/sec | '
+              f'vectorized {len(X) / t_vec:.0f} rows/sec | {t_loop / t_vec:.1f}x | '
+              f'correct {loop_score} vs {vec_score} ({abs(loop_score - vec_score)} rows apart)')
+
+    # 3. mini-batch k-means streamed over the file
+    t0 = time.time()
+    km = MiniBatchKMeans(args.n_clusters, args.batch_size).fit(lambda: (X for X, y in chunks()), args.epochs)
+    t1 = time.time()
+    inertia = sum(km.inertia(X) for X, y in chunks())
+    print(f'mini-batch k-means: {args.epochs} epochs over {num_rows} rows in {t1 - t0:.2f}s | inertia {inertia:.4e}')
+    print(km.centroids)
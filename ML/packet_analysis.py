@@ -0,0 +1,261 @@
+"""
+Out-of-core analytics for the Wireshark packet captures used in Security Data Analysis.ipynb.
+
+The CSV export is converted once into a typed parquet cache (Minutes derived at conversion time,
+strings dictionary encoded). Every analysis then streams the cache in record batches with categorical
+columns, so captures larger than RAM only ever hold one batch in memory.
+
+The host communication graph is built from aggregated edges (one row per host pair with packet count,
+total Length and protocols) instead of one edge per packet, and exported as CSR adjacency arrays.
+
+    python packet_analysis.py ./T1_data/2022-task1_data.csv
+    python packet_analysis.py ./T1_data/2022-task1_data.csv --source_contains 10 --graph hosts.npz
+"""
+import os
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+categorical_columns = ['Source', 'Destination', 'Protocol']
+
+csv_dtypes = {
+    'No.': 'int64',
+    'Time': 'float64',
+    'Source': 'string',
+    'Destination': 'string',
+    'Protocol': 'string',
+    'Length': 'int32',
+    'Info': 'string',
+}
+
+cache_schema = pa.schema([
+    ('No.', pa.int64()),
+    ('Time', pa.float64()),
+    ('Minutes', pa.int32()),
+    ('Source', pa.string()),
+    ('Destination', pa.string()),
+    ('Protocol', pa.string()),
+    ('Length', pa.int32()),
+    ('Info', pa.string()),
+])
+
+
+def cache_path_for(csv_path):
+    return os.path.splitext(csv_path)[0] + '.parquet'
+
+
+def convert_capture(csv_path, cache_path=None, chunksize=1_000_000):
+    """
+    Convert a packet capture CSV into the parquet cache, reading it chunksize rows at a time.
+    Skipped when the cache is newer than the CSV.
+
+    Returns:
+    - the path of the parquet cache.
+    """
+    cache_path = cache_path or cache_path_for(csv_path)
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(csv_path):
+        return cache_path
+
+    tmp_path = cache_path + '.tmp'
+    with pq.ParquetWriter(tmp_path, cache_schema, use_dictionary=categorical_columns, compression='snappy') as writer:
+        for chunk in pd.read_csv(csv_path, dtype=csv_dtypes, chunksize=chunksize):
+            # the notebook's Seconds -> Minutes astype chain, done once here
+            chunk['Minutes'] = (chunk['Time'] // 60).astype('int32')
+            table = pa.Table.from_pandas(chunk[cache_schema.names], schema=cache_schema, preserve_index=False)
+            writer.write_table(table)
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+def iter_capture(cache_path, columns=None, batch_size=1_000_000):
+    """
+    Yield the cached capture as pandas DataFrames of at most batch_size rows.
+    Source, Destination and Protocol come back as categoricals.
+    """
+    pf = pq.ParquetFile(cache_path, read_dictionary=categorical_columns)
+    for batch in pf.iter_batches(batch_size=batch_size, columns=columns):
+        yield batch.to_pandas()
+
+
+def contains_mask(series, pattern):
+    # substring match on a categorical: test each category once, then look the codes up
+    hits = series.cat.categories.str.contains(pattern, regex=False)
+    codes = series.cat.codes.to_numpy()
+    return np.append(hits, False)[codes] # code -1 (missing) maps to the trailing False
+
+
+def _add(total, part):
+    return part if total is None else total.add(part, fill_value=0)
+
+
+def capture_summary(cache_path, source_contains=None, batch_size=1_000_000):
+    """
+    All aggregates of the notebook in one streaming pass over the cache.
+
+    Inputs:
+    - cache_path: parquet cache written by convert_capture.
+    - source_contains: optional substring filter on Source for the per-protocol tables,
+      like the notebook's data[data['Source'].str.contains('10')].
+
+    Returns a dict of:
+    - packets_per_minute: Series, number of packets per minute.
+    - length_per_minute: Series, total Length per minute.
+    - protocol_counts: Series, number of packets per protocol, largest first.
+    - packets_per_minute_protocol: DataFrame (minutes x protocols), replaces the per-protocol boolean columns.
+    - length_per_minute_protocol: DataFrame (minutes x protocols) of total Length.
+    """
+    packets_per_minute = length_per_minute = protocol_counts = None
+    packets_per_protocol = length_per_protocol = None
+    columns = ['Minutes', 'Source', 'Protocol', 'Length']
+    for chunk in iter_capture(cache_path, columns=columns, batch_size=batch_size):
+        by_minute = chunk.groupby('Minutes', sort=False)['Length'].agg(['size', 'sum'])
+        packets_per_minute = _add(packets_per_minute, by_minute['size'])
+        length_per_minute = _add(length_per_minute, by_minute['sum'])
+        counts = chunk['Protocol'].value_counts()
+        counts.index = counts.index.astype(str)
+        protocol_counts = _add(protocol_counts, counts)
+
+        if source_contains is not None:
+            chunk = chunk[contains_mask(chunk['Source'], source_contains)]
+        # categories differ between batches, so group on the strings of the observed protocols only
+        by_protocol = chunk.groupby(['Minutes', 'Protocol'], observed=True, sort=False)['Length'].agg(['size', 'sum'])
+        by_protocol.index = by_protocol.index.set_levels(by_protocol.index.levels[1].astype(str), level=1)
+        packets_per_protocol = _add(packets_per_protocol, by_protocol['size'])
+        length_per_protocol = _add(length_per_protocol, by_protocol['sum'])
+
+    return {
+        'packets_per_minute': packets_per_minute.sort_index().astype('int64'),
+        'length_per_minute': length_per_minute.sort_index().astype('int64'),
+        'protocol_counts': protocol_counts[protocol_counts > 0].sort_values(ascending=False).astype('int64'),
+        'packets_per_minute_protocol': packets_per_protocol.unstack(fill_value=0).sort_index().astype('int64'),
+        'length_per_minute_protocol': length_per_protocol.unstack(fill_value=0).sort_index().astype('int64'),
+    }
+
+
+def capture_edges(cache_path, source_contains=None, directed=False, batch_size=1_000_000):
+    """
+    Aggregate the packets into host to host edges in one streaming pass over the cache.
+
+    Inputs:
+    - source_contains: optional substring filter on Source, as in capture_summary.
+    - directed: keep Source -> Destination and Destination -> Source apart. The notebook's nx.Graph is
+      undirected, so by default both directions are merged into one edge.
+
+    Returns:
+    - DataFrame with columns Source, Destination, packets, length, protocols (comma separated, sorted),
+      one row per edge, heaviest first.
+    """
+    per_protocol = None
+    columns = ['Source', 'Destination', 'Protocol', 'Length']
+    for chunk in iter_capture(cache_path, columns=columns, batch_size=batch_size):
+        if source_contains is not None:
+            chunk = chunk[contains_mask(chunk['Source'], source_contains)]
+        part = chunk.groupby(['Source', 'Destination', 'Protocol'], observed=True, sort=False)['Length'].agg(['size', 'sum'])
+        part.index = part.index.set_levels([level.astype(str) for level in part.index.levels])
+        per_protocol = _add(per_protocol, part)
+
+    edges = per_protocol.reset_index()
+    if not directed:
+        swap = edges['Source'].to_numpy() > edges['Destination'].to_numpy()
+        src = np.where(swap, edges['Destination'], edges['Source'])
+        edges['Destination'] = np.where(swap, edges['Source'], edges['Destination'])
+        edges['Source'] = src
+        edges = edges.groupby(['Source', 'Destination', 'Protocol'], sort=False, as_index=False)[['size', 'sum']].sum()
+
+    # the protocol rows are already few (edges x protocols), joining them is cheap
+    grouped = edges.groupby(['Source', 'Destination'], sort=False)
+    edges = pd.DataFrame({
+        'packets': grouped['size'].sum().astype('int64'),
+        'length': grouped['sum'].sum().astype('int64'),
+        'protocols': grouped['Protocol'].agg(lambda p: ','.join(sorted(p))),
+    }).reset_index()
+    return edges.sort_values('packets', ascending=False, ignore_index=True)
+
+
+def adjacency(edges, directed=False):
+    """
+    Compact CSR adjacency arrays of an edge table from capture_edges.
+
+    Returns a dict of:
+    - nodes: (N,) host names, node i is nodes[i].
+    - indptr: (N+1,) int64, the neighbours of node i are indices[indptr[i]:indptr[i+1]].
+    - indices: (E,) int32 neighbour ids.
+    - packets, length: (E,) int64 edge weights aligned with indices.
+    An undirected edge is stored in both directions.
+    """
+    codes, nodes = pd.factorize(pd.concat([edges['Source'], edges['Destination']], ignore_index=True))
+    n_edges = len(edges)
+    src, dst = codes[:n_edges], codes[n_edges:]
+    packets, length = edges['packets'].to_numpy(), edges['length'].to_numpy()
+    if not directed:
+        src, dst = np.concatenate([src, dst]), np.concatenate([dst, src])
+        packets, length = np.concatenate([packets, packets]), np.concatenate([length, length])
+    order = np.argsort(src, kind='stable')
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=len(nodes)), out=indptr[1:])
+    return {
+        'nodes': np.asarray(nodes, dtype=str),
+        'indptr': indptr,
+        'indices': dst[order].astype(np.int32),
+        'packets': packets[order].astype(np.int64),
+        'length': length[order].astype(np.int64),
+    }
+
+
+def degree_table(adj):
+    # degree, degree centrality (nx.degree_centrality) and packet/byte weighted degree straight from the arrays
+    degree = np.diff(adj['indptr'])
+    starts = adj['indptr'][:-1]
+    nonempty = degree > 0
+    packets = np.zeros(len(degree), dtype=np.int64)
+    length = np.zeros(len(degree), dtype=np.int64)
+    packets[nonempty] = np.add.reduceat(adj['packets'], starts[nonempty])
+    length[nonempty] = np.add.reduceat(adj['length'], starts[nonempty])
+    n = len(degree)
+    return pd.DataFrame({
+        'degree': degree,
+        'degree_centrality': degree / max(n - 1, 1),
+        'packets': packets,
+        'length': length,
+    }, index=pd.Index(adj['nodes'], name='host')).sort_values('degree', ascending=False)
+
+
+def to_networkx(edges, directed=False):
+    # the notebook's graph, one edge per host pair with packets/length/protocols as attributes
+    import networkx as nx
+    return nx.from_pandas_edgelist(edges, 'Source', 'Destination', edge_attr=['packets', 'length', 'protocols'],
+                                   create_using=nx.DiGraph if directed else nx.Graph)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv", type=str, help="Wireshark CSV export, e.g. ./T1_data/2022-task1_data.csv")
+    parser.add_argument("--source_contains", type=str, default=None, help="substring filter on Source, e.g. 10")
+    parser.add_argument("--batch_size", type=int, default=1_000_000)
+    parser.add_argument("--graph", type=str, default=None, help="also build the host graph and save its adjacency arrays to this .npz")
+    parser.add_argument("--directed", action="store_true", help="keep both directions of a host pair apart")
+    args = parser.parse_args()
+
+    t0 = time.time()
+    cache_path = convert_capture(args.csv)
+    t1 = time.time()
+    summary = capture_summary(cache_path, args.source_contains, args.batch_size)
+    t2 = time.time()
+    print(f'cache: {cache_path} ({t1 - t0:.2f}s) | analysis: {t2 - t1:.2f}s')
+    print(f"packets: {summary['packets_per_minute'].sum()} over {len(summary['packets_per_minute'])} minutes")
+    print('top protocols:')
+    print(summary['protocol_counts'].head(20).to_string())
+    print('total length per minute per protocol:')
+    print(summary['length_per_minute_protocol'].to_string(max_rows=20, max_cols=10))
+
+    if args.graph:
+        t0 = time.time()
+        edges = capture_edges(cache_path, args.source_contains, args.directed, args.batch_size)
+        adj = adjacency(edges, args.directed)
+        np.savez(args.graph, **adj)
+        print(f'graph: {len(adj["nodes"])} hosts, {len(edges)} edges from {edges["packets"].sum()} packets ({time.time() - t0:.2f}s) -> {args.graph}')
+        print(edges.head(20).to_string())
+        print(degree_table(adj).head(20).to_string())
@@ -0,0 +1,206 @@
+import heapq
+import time
+import numpy as np
+from multiprocessing import Pool
+from multiprocessing import shared_memory
+from k_nearest_neighbor_classifiers import KNearestNeighbor
+
+
+# per worker process state, set by _attach
+_shm = None
+_X_train = None
+
+
+def _attach(name, shape, dtype):
+    # pool initializer: map the training set from shared memory instead of pickling it to every worker
+    global _shm, _X_train
+    _shm = shared_memory.SharedMemory(name=name)
+    _X_train = np.ndarray(shape, dtype=dtype, buffer=_shm.buf)
+
+
+def shard_top_k(X_train, offset, X, k, num_loops):
+    """
+    Exact top-k of one shard of the training set.
+
+    Inputs:
+    - X_train: A numpy array of shape (shard_size, D), rows offset:offset+shard_size of the full set.
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k, num_loops: as in KNearestNeighbor.predict.
+
+    The distances are computed in float64: in float32 the BLAS rounding of the no loop expansion depends on the
+    shape of the block, so a shard and the full matrix can order two nearly tied neighbours differently.
+
+    Returns:
+    - dists: A numpy array of shape (num_test, k') sorted by (distance, training index), k' = min(k, shard_size).
+    - idx: A numpy array of shape (num_test, k') of global training indices.
+    """
+    knn = KNearestNeighbor()
+    knn.train(X_train.astype(np.float64, copy=False), None)
+    X = X.astype(np.float64, copy=False)
+    if num_loops == 0:
+        dists = knn.compute_distances_no_loops(X)
+    elif num_loops == 1:
+        dists = knn.compute_distances_one_loop(X)
+    elif num_loops == 2:
+        dists = knn.compute_distances_two_loops(X)
+    else:
+        raise ValueError("Invalid value %d for num_loops" % num_loops)
+    # the no loop expansion can give nan for a tiny negative, argsort ranks nan last so treat it as inf
+    dists = np.where(np.isnan(dists), np.inf, dists)
+    kk = min(k, dists.shape[1])
+    if kk < dists.shape[1]:
+        # keep every column tied with the k-th distance so the index tie break below stays exact
+        kth = np.partition(dists, kk - 1, axis=1)[:, kk - 1:kk]
+        keep = dists <= kth
+    else:
+        keep = np.ones(dists.shape, dtype=bool)
+    out_d = np.empty((dists.shape[0], kk))
+    out_i = np.empty((dists.shape[0], kk), dtype=np.int64)
+    for i in range(dists.shape[0]):
+        cols = np.nonzero(keep[i])[0]
+        order = np.lexsort((cols, dists[i, cols]))[:kk] # by distance, then training index
+        out_d[i] = dists[i, cols[order]]
+        out_i[i] = cols[order] + offset
+    return out_d, out_i
+
+
+def _worker(args):
+    lo, hi, X, k, num_loops = args
+    return shard_top_k(_X_train[lo:hi], lo, X, k, num_loops)
+
+
+def merge_top_k(shard_results, k):
+    """
+    Merge per-shard top-k lists (each sorted by distance, then index) into the global top-k indices
+    with a k-way heap merge per test point.
+
+    Returns:
+    - idx: A numpy array of shape (num_test, k) of training indices, nearest first.
+    """
+    num_test = shard_results[0][0].shape[0]
+    idx = np.empty((num_test, k), dtype=np.int64)
+    for i in range(num_test):
+        streams = [zip(d[i], ix[i]) for d, ix in shard_results]
+        for j, (dist, ix) in enumerate(heapq.merge(*streams)):
+            if j == k:
+                break
+            idx[i, j] = ix
+    return idx
+
+
+class ShardedKNearestNeighbor(KNearestNeighbor):
+    """
+    KNearestNeighbor with the training set split into contiguous shards, one per worker process.
+    The training set lives in one shared memory segment that all workers map. Each shard returns
+    its local top-k and the lists are merged with a heap. Distances are float64 and distance ties go to
+    the lower training index, vote ties to the smaller label, so predict matches the single process
+    KNearestNeighbor.predict run on float64 data up to neighbours whose distances differ by float64
+    rounding only. On float32 data the single process path ranks in float32 and can disagree on near ties.
+
+        with ShardedKNearestNeighbor(num_workers=4) as knn:
+            knn.train(X_train, y_train)
+            y_pred = knn.predict(X_test, k=5)
+    """
+
+    def __init__(self, num_workers=4, test_batch_size=1024):
+        self.num_workers = num_workers
+        self.test_batch_size = test_batch_size # bounds the (batch, shard_size) distance block of every worker
+        self.pool = None
+        self.shm = None
+
+    def train(self, X, y):
+        self.close()
+        self.y_train = y
+        self.shards = [(s[0], s[-1] + 1) for s in np.array_split(np.arange(X.shape[0]), self.num_workers) if len(s)]
+        if self.num_workers <= 1:
+            self.X_train = X
+            return
+        X = np.ascontiguousarray(X)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+        self.X_train = np.ndarray(X.shape, dtype=X.dtype, buffer=self.shm.buf)
+        self.X_train[:] = X
+        self.pool = Pool(self.num_workers, initializer=_attach, initargs=(self.shm.name, X.shape, X.dtype))
+
+    def nearest(self, X, k=1, num_loops=0):
+        """
+        Returns:
+        - idx: A numpy array of shape (num_test, k) with the indices of the k nearest training points.
+        """
+        k = min(k, self.X_train.shape[0])
+        out = []
+        for start in range(0, X.shape[0], self.test_batch_size):
+            batch = X[start:start + self.test_batch_size]
+            tasks = [(lo, hi, batch, k, num_loops) for lo, hi in self.shards]
+            if self.pool is None:
+                results = [shard_top_k(self.X_train[lo:hi], lo, batch, k, num_loops) for lo, hi, *_ in tasks]
+            else:
+                results = self.pool.map(_worker, tasks)
+            out.append(merge_top_k(results, k))
+        return np.concatenate(out) if out else np.empty((0, k), dtype=np.int64)
+
+    def predict(self, X, k=1, num_loops=0):
+        idx = self.nearest(X, k, num_loops)
+        y_pred = np.zeros(X.shape[0])
+        for i in range(X.shape[0]):
+            values, counts = np.unique(self.y_train[idx[i]], return_counts=True)
+            y_pred[i] = values[np.argmax(counts)]
+        return y_pred
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.shm is not None:
+            self.X_train = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_train", type=int, default=50000)
+    parser.add_argument("--num_test", type=int, default=500)
+    parser.add_argument("--dim", type=int, default=3072, help="3072 = one CIFAR-10 image")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--workers", type=int, nargs='*', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1337)
+    X_train = rng.standard_normal((args.num_train, args.dim)).astype(np.float32)
+    y_train = rng.integers(0, 10, args.num_train)
+    X_test = rng.standard_normal((args.num_test, args.dim)).astype(np.float32)
+
+    def neighbour_dists(idx):
+        # float64 distance of every chosen neighbour, (num_test, k)
+        return np.sqrt(((X_test[:, None, :].astype(np.float64) - X_train[idx].astype(np.float64)) ** 2).sum(-1))
+
+    knn = KNearestNeighbor()
+    knn.train(X_train, y_train)
+    t0 = time.time()
+    dists = knn.compute_distances_no_loops(X_test)
+    expected = knn.predict_labels(dists, k=args.k)
+    base = time.time() - t0
+    expected_dists = neighbour_dists(np.argsort(dists, axis=1, kind='stable')[:, :args.k])
+    print(f'single process: {base:.2f}s | {args.num_test / base:.1f} rows/sec')
+
+    for num_workers in args.workers:
+        with ShardedKNearestNeighbor(num_workers) as sharded:
+            sharded.train(X_train, y_train)
+            t0 = time.time()
+            y_pred = sharded.predict(X_test, k=args.k)
+            dt = time.time() - t0
+            idx = sharded.nearest(X_test, k=args.k)
+        # the single process path ranks in float32, so two neighbours tied up to its rounding may swap:
+        # compare the neighbour distances with a tolerance, the labels can only differ on such near ties
+        assert np.allclose(neighbour_dists(idx), expected_dists, rtol=1e-5), f'{num_workers} workers found other neighbours than the single process path'
+        agree = np.mean(y_pred == expected)
+        print(f'{num_workers} workers: {dt:.2f}s | {args.num_test / dt:.1f} rows/sec | {base / dt:.2f}x | labels agree {agree:.4f}')
@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+# micro benchmarks for the hot paths of the repo, offline on cpu with tiny configs:
+# GPT forward/backward, DataloaderLite.next_batch over synthetic shards, the sampling loops,
+# bigram.generate and the three KNearestNeighbor distance methods
+#
+# python3 benchmarks/run_benchmarks.py --save benchmarks/baseline.json     # record a baseline
+# python3 benchmarks/run_benchmarks.py --compare benchmarks/baseline.json  # exit 1 on a regression
+import os
+import sys
+import json
+import time
+import atexit
+import shutil
+import platform
+import subprocess
+import tempfile
+import importlib.util
+import numpy as np
+import torch
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'LLM', 'GPT-2'))
+
+
+def load_module(name, path):
+    # the scripts live in folders with spaces/dashes and Bigram's is called train.py, so load them by path
+    spec = importlib.util.spec_from_file_location(name, os.path.join(root, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure(fn, repeat, warmup=2):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    times.sort()
+    return times[len(times) // 2], times[0]
+
+
+benchmarks = {}
+
+def benchmark(name, unit, work):
+    # work: units processed per call (tokens, rows, ...), for the throughput column
+    def register(setup):
+        benchmarks[name] = (setup, unit, work)
+        return setup
+    return register
+
+
+# ----------------------------------------------------------------------------- GPT
+
+gpt_config = dict(block_size=128, vocab_size=512, n_layer=2, n_head=4, n_embd=128)
+gpt_B, gpt_T = 4, 128
+
+def tiny_gpt():
+    from train_gpt2 import GPT, GPTConfig
+    torch.manual_seed(1337)
+    return GPT(GPTConfig(**gpt_config))
+
+@benchmark('gpt_forward', 'tok/sec', gpt_B * gpt_T)
+def setup_gpt_forward():
+    model = tiny_gpt().eval()
+    x = torch.randint(gpt_config['vocab_size'], (gpt_B, gpt_T))
+    def run():
+        with torch.no_grad():
+            model(x, x)
+    return run
+
+@benchmark('gpt_forward_backward', 'tok/sec', gpt_B * gpt_T)
+def setup_gpt_forward_backward():
+    model = tiny_gpt().train()
+    x = torch.randint(gpt_config['vocab_size'], (gpt_B, gpt_T))
+    def run():
+        model.zero_grad(set_to_none=True)
+        logits, loss = model(x, x)
+        loss.backward()
+    return run
+
+sample_B, sample_prompt, sample_new = 4, 8, 32
+
+@benchmark('gpt_sample_topk', 'tok/sec', sample_B * sample_new)
+def setup_gpt_sample_topk():
+    # the full-recompute top-k loop used by run() and the training loop
+    from speculative_decoding import sample_topk
+    model = tiny_gpt().eval()
+    x = torch.randint(gpt_config['vocab_size'], (sample_B, sample_prompt))
+    rng = torch.Generator().manual_seed(42)
+    return lambda: sample_topk(model, x, sample_prompt + sample_new, sample_rng=rng, device_type='cpu')
+
+@benchmark('gpt_sample_kv_cache', 'tok/sec', sample_B * sample_new)
+def setup_gpt_sample_kv_cache():
+    # the same sampling with a KVCache, one new token per forward
+    from train_gpt2 import KVCache
+    from speculative_decoding import topk_probs
+    model = tiny_gpt().eval()
+    x = torch.randint(gpt_config['vocab_size'], (sample_B, sample_prompt))
+    rng = torch.Generator().manual_seed(42)
+    def run():
+        with torch.no_grad():
+            cache = KVCache(model.config.n_layer)
+            xcol = x
+            for _ in range(sample_new):
+                logits, loss = model(xcol, kv_cache=cache)
+                xcol = torch.multinomial(topk_probs(logits[:, -1, :]), 1, generator=rng)
+    return run
+
+@benchmark('gpt_generate_shared', 'tok/sec', sample_B * sample_new)
+def setup_gpt_generate_shared():
+    # one prompt for all sample_B rows: prefilled once and its kv cache broadcast, then one token per forward
+    from sampling import Sampler, generate_shared
+    model = tiny_gpt().eval()
+    tokens = torch.randint(gpt_config['vocab_size'], (sample_prompt,)).tolist()
+    sampler = Sampler(top_k=50, vocab_size=gpt_config['vocab_size'])
+    return lambda: generate_shared(model, tokens, sample_B, sample_prompt + sample_new, sampler)
+
+shard_tokens, loader_B, loader_T = 2**20, 8, 256
+
+def synthetic_shards():
+    # the loaders memory map the shards when the benchmark runs, so the directory lives until the process exits
+    tmp = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, tmp, ignore_errors=True)
+    os.makedirs(os.path.join(tmp, 'edu_fineweb10B'))
+    rng = np.random.default_rng(1337)
+    for i in range(3):
+        split = 'val' if i == 0 else 'train'
+        tokens = rng.integers(0, 50257, shard_tokens, dtype=np.uint16)
+        np.save(os.path.join(tmp, 'edu_fineweb10B', f'edufineweb_{split}_{i:06d}'), tokens)
+    return tmp
+
+@benchmark('dataloader_next_batch', 'tok/sec', loader_B * loader_T)
+def setup_dataloader_next_batch():
+    import train_gpt2
+    tmp = synthetic_shards()
+    cwd = os.getcwd()
+    os.chdir(tmp) # DataloaderLite looks for edu_fineweb10B relative to the working dir
+    try:
+        loader = train_gpt2.DataloaderLite(B=loader_B, T=loader_T, process_rank=0, num_processes=1, split='train')
+    finally:
+        os.chdir(cwd)
+    return loader.next_batch
+
+@benchmark('random_window_next_batch', 'tok/sec', loader_B * loader_T)
+def setup_random_window_next_batch():
+    from shard_sampler import RandomWindowLoader
+    tmp = synthetic_shards()
+    loader = RandomWindowLoader(B=loader_B, T=loader_T, process_rank=0, num_processes=1, split='train',
+                                data_root=os.path.join(tmp, 'edu_fineweb10B'), verbose=False)
+    return loader.next_batch
+
+# ----------------------------------------------------------------------------- Bigram
+
+bigram_new = 64
+
+@benchmark('bigram_generate', 'tok/sec', bigram_new)
+def setup_bigram_generate():
+    bigram_train = load_module('bigram_train', os.path.join('LLM', 'Bigram', 'train.py'))
+    # the model reads its sizes from module globals, shrink them before building it
+    bigram_train.block_size, bigram_train.n_embd, bigram_train.n_head, bigram_train.n_layer = 32, 64, 4, 2
+    bigram_train.device = 'cpu'
+    torch.manual_seed(1337)
+    model = bigram_train.bigram(65).eval()
+    context = torch.zeros((1, 1), dtype=torch.long)
+    def run():
+        with torch.no_grad():
+            model.generate(context, max_new_tokens=bigram_new)
+    return run
+
+# ----------------------------------------------------------------------------- kNN
+
+knn_train, knn_test, knn_D = 500, 50, 256
+
+def tiny_knn():
+    knn = load_module('k_nearest_neighbor_classifiers', os.path.join('ML', 'k_nearest_neighbor_classifiers.py'))
+    rng = np.random.default_rng(1337)
+    classifier = knn.KNearestNeighbor()
+    classifier.train(rng.standard_normal((knn_train, knn_D)), rng.integers(0, 10, knn_train))
+    return classifier, rng.standard_normal((knn_test, knn_D))
+
+@benchmark('knn_two_loops', 'rows/sec', knn_test)
+def setup_knn_two_loops():
+    classifier, X = tiny_knn()
+    return lambda: classifier.compute_distances_two_loops(X)
+
+@benchmark('knn_one_loop', 'rows/sec', knn_test)
+def setup_knn_one_loop():
+    classifier, X = tiny_knn()
+    return lambda: classifier.compute_distances_one_loop(X)
+
+@benchmark('knn_no_loops', 'rows/sec', knn_test)
+def setup_knn_no_loops():
+    classifier, X = tiny_knn()
+    return lambda: classifier.compute_distances_no_loops(X)
+
+# -----------------------------------------------------------------------------
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_all(names, repeat):
+    results = {}
+    for name in names:
+        setup, unit, work = benchmarks[name]
+        torch.manual_seed(1337)
+        fn = setup()
+        median, best = measure(fn, repeat)
+        results[name] = {'median_ms': median * 1000, 'min_ms': best * 1000, 'throughput': work / median, 'unit': unit}
+        print(f'{name:24s} | median {median*1000:10.3f}ms | min {best*1000:10.3f}ms | {work / median:14.2f} {unit}')
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # a benchmark regresses when its median got slower than the baseline by more than tolerance
+    regressions = []
+    for name, r in results.items():
+        if name not in baseline['results']:
+            continue
+        ratio = r['median_ms'] / baseline['results'][name]['median_ms']
+        flag = 'REGRESSION' if ratio > 1 + tolerance else ''
+        print(f'{name:24s} | {ratio:6.3f}x baseline {flag}')
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", type=str, nargs='*', default=None, help="subset of benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=1, help="torch threads, 1 keeps numbers comparable across runs")
+    parser.add_argument("--save", type=str, default=None, help="write results to this json file")
+    parser.add_argument("--compare", type=str, default=None, help="baseline json to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed slowdown before flagging, 0.15 = 15%%")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    names = args.only if args.only else list(benchmarks)
+    results = run_all(names, args.repeat)
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'threads': args.threads,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'saved results to {args.save}')
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"comparing against {args.compare} (commit {baseline['meta'].get('commit')})")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+            sys.exit(1)